@@ -4,6 +4,7 @@
 __author__ = "ipetrash"
 
 
+import datetime as DT
 import time
 
 import db
@@ -11,53 +12,119 @@ import db
 from root_common import get_logger
 from app_parser.parser import get_metal_rates, get_pair_dates
 from app_parser.config import DIR_LOGS, TIMEOUT
+from app_web_server.snapshot import publish_snapshot
 
 
 log = get_logger(__file__, DIR_LOGS / "log.txt")
 
 
-while True:
-    log.info("Запуск")
-    try:
-        start_date = db.MetalRate.get_last_date()
-        log.info(f"Поиск от {start_date}\n")
+def process_new_rates(dates: set[DT.date]):
+    """
+    Обновление сводных таблиц для дат dates и проверка оповещений и рекордов
+    для курсов после последней проверенной даты. Отметка проверенной даты
+    сдвигается только после всех шагов, поэтому при ошибке курсы будут обработаны
+    на следующем проходе, а повторная проверка не дублирует оповещения
+    """
 
-        metal_rate_count = db.MetalRate.count()
+    checked_date = db.Settings.get_last_date_of_checked_rates()
 
-        i = 0
-        for date_req1, date_req2 in get_pair_dates(start_date):
-            log.info(f"Поиск за {date_req1} - {date_req2}")
+    # Без отметки курсы загружены в пустую базу. История считается проверенной,
+    # иначе по ней будут созданы тысячи рекордов и сработают все оповещения
+    if not checked_date:
+        checked_date = db.MetalRate.get_last_date()
+        db.Settings.set_last_date_of_checked_rates(checked_date)
 
-            while True:
-                try:
-                    rates = get_metal_rates(date_req1, date_req2)
+    new_metal_rates = db.MetalRate.get_all_after(checked_date)
 
-                    log.info(f"Найдено {len(rates)} записей из API")
-                    for metal_rate in rates:
-                        db.MetalRate.add_from(metal_rate)
+    # Оповещениям не нужны сводные таблицы, поэтому они проверяются первыми
+    alert_ids = db.PriceAlert.check_rates(new_metal_rates)
+    if alert_ids:
+        log.info(f"Сработало оповещений: {len(alert_ids)}")
 
-                except Exception:
-                    log.exception("Ошибка:")
-                    time.sleep(3600 * 4)  # Wait 4 hours
-                    continue
+    # Вместе с датами, которые не попали в сводные таблицы из-за ошибки на прошлом проходе
+    dates = dates | {metal_rate.date for metal_rate in new_metal_rates}
 
-                break
+    for year in sorted({date.year for date in dates}):
+        db.MetalRateYear.refresh(year)
 
-            if i > 0:
-                time.sleep(60)
+    db.MetalRateRollup.refresh_for_dates(dates)
+    db.MetalRateMonth.refresh_for_dates(dates)
 
-            i += 1
+    # Для рекордов за прошлые годы нужна обновленная сводная таблица по годам
+    records = db.MetalRateRecord.check_rates(new_metal_rates)
+    for record in records:
+        log.info(f"Рекорд за {record.date}: {record.get_description()}")
 
-        diff_count = db.MetalRate.count() - metal_rate_count
-        log.info(
-            f"Добавлено записей: {diff_count}" if diff_count else "Новый записей нет"
-        )
+    if new_metal_rates:
+        db.Settings.set_last_date_of_checked_rates(new_metal_rates[-1].date)
 
-    except Exception:
-        log.exception("Ошибка:")
-        time.sleep(60 * 5)
-        continue
 
-    log.info("Завершено.\n")
+def run():
+    # Статическая копия страницы публикуется при запуске и после изменения курсов.
+    # Если публикация не удалась, она повторяется на следующем проходе
+    need_publish = True
 
-    time.sleep(TIMEOUT)
+    while True:
+        log.info("Запуск")
+        try:
+            start_date = db.MetalRate.get_last_date()
+            log.info(f"Поиск от {start_date}\n")
+
+            metal_rate_count = db.MetalRate.count()
+
+            # Без отметки проверяются только курсы, которые будут добавлены после запуска.
+            # Для пустой базы отметку поставит process_new_rates после загрузки истории
+            if metal_rate_count and not db.Settings.get_last_date_of_checked_rates():
+                db.Settings.set_last_date_of_checked_rates(start_date)
+
+            dates = set()
+
+            i = 0
+            for date_req1, date_req2 in get_pair_dates(start_date):
+                log.info(f"Поиск за {date_req1} - {date_req2}")
+
+                while True:
+                    try:
+                        rates = get_metal_rates(date_req1, date_req2)
+
+                        log.info(f"Найдено {len(rates)} записей из API")
+                        for metal_rate in rates:
+                            db.MetalRate.add_from(metal_rate)
+                            dates.add(metal_rate.date)
+                            need_publish = True
+
+                    except Exception:
+                        log.exception("Ошибка:")
+                        time.sleep(3600 * 4)  # Wait 4 hours
+                        continue
+
+                    break
+
+                if i > 0:
+                    time.sleep(60)
+
+                i += 1
+
+            process_new_rates(dates)
+
+            diff_count = db.MetalRate.count() - metal_rate_count
+            log.info(
+                f"Добавлено записей: {diff_count}" if diff_count else "Новый записей нет"
+            )
+
+            if need_publish:
+                log.info(f"Публикация страницы: {publish_snapshot()}")
+                need_publish = False
+
+        except Exception:
+            log.exception("Ошибка:")
+            time.sleep(60 * 5)
+            continue
+
+        log.info("Завершено.\n")
+
+        time.sleep(TIMEOUT)
+
+
+if __name__ == "__main__":
+    run()
@@ -6,6 +6,8 @@ __author__ = "ipetrash"
 
 from threading import Thread
 
+from app_tg_bot.bot import metrics
+from app_tg_bot.bot.backgrounds_tasks.check_active_subscriptions import check_active_subscriptions
 from app_tg_bot.bot.backgrounds_tasks.check_new_metal_rates import check_new_metal_rates
 from app_tg_bot.bot.backgrounds_tasks.run_check_subscriptions import sending_notifications
 
@@ -13,3 +15,5 @@ from app_tg_bot.bot.backgrounds_tasks.run_check_subscriptions import sending_not
 def run():
     Thread(target=check_new_metal_rates).start()
     Thread(target=sending_notifications).start()
+    Thread(target=check_active_subscriptions).start()
+    Thread(target=metrics.run_server, daemon=True).start()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import time
+
+from app_tg_bot.config import DIR_LOGS
+from app_tg_bot.bot.common import caller_name, get_logger
+from db import Subscription
+
+
+log = get_logger(__file__, DIR_LOGS / "subscriptions.txt")
+
+
+def check_active_subscriptions():
+    prefix = f"[{caller_name()}]"
+
+    log.info(f"{prefix} Запуск")
+
+    while True:
+        try:
+            missing, extra = Subscription.check_active_user_ids()
+            if missing or extra:
+                log.warning(
+                    f"{prefix} Кэш активных подписок расходился с базой: "
+                    f"не хватало {sorted(missing)}, лишние {sorted(extra)}"
+                )
+
+        except Exception:
+            log.exception(f"{prefix} Ошибка:")
+
+        finally:
+            time.sleep(10 * 60)
+
+    log.info(f"{prefix} Завершение")
@@ -30,6 +30,7 @@ def check_new_metal_rates():
                 f"{prefix} Дата поменялась {settings_last_date} -> {current_last_date}"
             )
             Settings.set_last_date_of_metals_rate(current_last_date)
+            MetalRate.update_stats_index()
             Subscription.update(was_sending=False).execute()
 
         except Exception:
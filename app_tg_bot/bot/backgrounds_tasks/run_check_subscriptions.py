@@ -9,60 +9,189 @@ import time
 from telegram import Bot, ParseMode
 
 from app_tg_bot.bot.common import caller_name, get_logger
-from app_tg_bot.config import TOKEN, DIR_LOGS
-from db import Subscription, MetalRate
+from app_tg_bot.config import TOKEN, DIR_LOGS, RECORDS_BROADCAST, RECORDS_BROADCAST_KIND_NAMES
+from db import Subscription, MetalRate, MetalRateRecord, PriceAlert
+from root_common import RecordKindEnum, get_date_str
 
 
 log = get_logger(__file__, DIR_LOGS / "notifications.txt")
 
+RECORDS_BROADCAST_KINDS: set[RecordKindEnum] = {
+    RecordKindEnum[name] for name in RECORDS_BROADCAST_KIND_NAMES
+}
 
-def sending_notifications():
-    prefix = f"[{caller_name()}]"
 
-    bot = Bot(TOKEN)
+def is_unavailable_user(e: Exception, user_id: int) -> bool:
+    text_error = str(e)
 
-    log.info(f"{prefix} Запуск")
-    log.debug(f"{prefix} Имя бота {bot.first_name!r} ({bot.name})")
+    if "Chat not found" in text_error:
+        log.info(f"Рассылка невозможна: пользователь #{user_id} не найден")
+        return True
 
-    while True:
+    if "bot was blocked by the user" in text_error:
+        log.info(f"Рассылка невозможна: пользователь #{user_id} заблокировал бота")
+        return True
+
+    return False
+
+
+def send_notifications(bot: Bot, prefix: str = "", delay_secs: float = 0.4) -> int:
+    """
+    Один проход рассылки по активным подпискам, которым она еще не отправлялась.
+    Возвращает количество успешно отправленных сообщений
+    """
+
+    subscriptions = Subscription.get_active_unsent_subscriptions()
+    if not subscriptions:
+        return 0
+
+    log.info(
+        f"{prefix} Выполняется рассылка к {len(subscriptions)} пользователям"
+    )
+
+    sent = 0
+
+    text = f"<b>Рассылка</b>\n{MetalRate.get_last().get_description(show_diff=True)}"
+    for subscription in subscriptions:
+        try:
+            bot.send_message(
+                chat_id=subscription.user_id,  # Для приватных чатов chat_id равен user_id
+                text=text,
+                parse_mode=ParseMode.HTML,
+            )
+
+            subscription.was_sending = True
+            subscription.save()
+
+            sent += 1
+
+        except Exception as e:
+            if is_unavailable_user(e, subscription.user_id):
+                subscription.set_active(False)
+
+        if delay_secs:
+            time.sleep(delay_secs)
+
+    return sent
+
+
+def send_price_alerts(bot: Bot, prefix: str = "", delay_secs: float = 0.4) -> int:
+    """
+    Отправка сработавших оповещений о курсах.
+    Возвращает количество успешно отправленных сообщений
+    """
+
+    alerts = PriceAlert.get_unsent()
+    if not alerts:
+        return 0
+
+    log.info(f"{prefix} Выполняется отправка {len(alerts)} оповещений")
+
+    sent = 0
+
+    for alert in alerts:
         try:
-            subscriptions = Subscription.get_active_unsent_subscriptions()
-            if not subscriptions:
-                continue
+            bot.send_message(
+                chat_id=alert.user_id,
+                text=f"<b>Оповещение</b>\n{alert.get_description()}",
+                parse_mode=ParseMode.HTML,
+            )
+
+            alert.was_sending = True
+            alert.save(only=[PriceAlert.was_sending])
+
+            sent += 1
+
+        except Exception as e:
+            if is_unavailable_user(e, alert.user_id):
+                PriceAlert.deactivate(alert.user_id)
+
+                # Сохраняется только отметка, чтобы не вернуть is_active из устаревшей записи
+                alert.was_sending = True
+                alert.save(only=[PriceAlert.was_sending])
+
+        if delay_secs:
+            time.sleep(delay_secs)
+
+    return sent
+
+
+def send_records(
+    bot: Bot,
+    prefix: str = "",
+    delay_secs: float = 0.4,
+    kinds: set[RecordKindEnum] = None,
+) -> int:
+    """
+    Рассылка активным подпискам о новых рекордах металлов видов kinds
+    (по умолчанию RECORDS_BROADCAST_KINDS). Если рассылка отключена или рекорды
+    других видов, они только помечаются отправленными.
+    Возвращает количество успешно отправленных сообщений
+    """
+
+    records = MetalRateRecord.get_unsent()
+    if not records:
+        return 0
+
+    # Помечаем сразу, чтобы при ошибке рассылка не повторялась всем подписчикам
+    MetalRateRecord.set_sent(records)
+    if not RECORDS_BROADCAST:
+        return 0
+
+    if kinds is None:
+        kinds = RECORDS_BROADCAST_KINDS
+
+    records = [record for record in records if record.get_kind() in kinds]
+    if not records:
+        return 0
 
-            log.info(
-                f"{prefix} Выполняется рассылка к {len(subscriptions)} пользователям"
+    user_ids = sorted(Subscription.get_active_user_ids())
+
+    log.info(
+        f"{prefix} Выполняется рассылка {len(records)} рекордов к {len(user_ids)} пользователям"
+    )
+
+    lines = []
+    for record in records:
+        lines.append(f"{get_date_str(record.date)}. {record.get_description()}")
+    text = "<b>Рекорд</b>\n" + "\n".join(lines)
+
+    sent = 0
+
+    for user_id in user_ids:
+        try:
+            bot.send_message(
+                chat_id=user_id,
+                text=text,
+                parse_mode=ParseMode.HTML,
             )
+            sent += 1
 
-            text = f"<b>Рассылка</b>\n{MetalRate.get_last().get_description(show_diff=True)}"
-            for subscription in subscriptions:
-                try:
-                    bot.send_message(
-                        chat_id=subscription.user_id,  # Для приватных чатов chat_id равен user_id
-                        text=text,
-                        parse_mode=ParseMode.HTML,
-                    )
+        except Exception as e:
+            if is_unavailable_user(e, user_id):
+                subscription = Subscription.get_by_user_id(user_id)
+                if subscription:
+                    subscription.set_active(False)
 
-                    subscription.was_sending = True
-                    subscription.save()
+        if delay_secs:
+            time.sleep(delay_secs)
 
-                except Exception as e:
-                    text_error = str(e)
+    return sent
 
-                    need_deactivate = False
 
-                    if "Chat not found" in text_error:
-                        log.info(f"Рассылка невозможна: пользователь #{subscription.user_id} не найден")
-                        need_deactivate = True
-                    elif "bot was blocked by the user" in text_error:
-                        log.info(f"Рассылка невозможна: пользователь #{subscription.user_id} заблокировал бота")
-                        need_deactivate = True
+def sending_notifications():
+    prefix = f"[{caller_name()}]"
 
-                    if need_deactivate:
-                        subscription.is_active = False
-                        subscription.save()
+    bot = Bot(TOKEN)
+
+    log.info(f"{prefix} Запуск")
+    log.debug(f"{prefix} Имя бота {bot.first_name!r} ({bot.name})")
 
-                time.sleep(0.4)
+    while True:
+        try:
+            send_notifications(bot, prefix)
+            send_price_alerts(bot, prefix)
+            send_records(bot, prefix)
 
         except Exception:
             log.exception(f"{prefix} Ошибка:")
@@ -6,6 +6,9 @@ __author__ = "ipetrash"
 
 import datetime as DT
 
+from decimal import Decimal
+from typing import Optional
+
 from telegram import (
     Update,
     InlineKeyboardMarkup,
@@ -16,13 +19,11 @@ from telegram import (
 from telegram.ext import (
     Dispatcher,
     CallbackContext,
-    MessageHandler,
     CommandHandler,
     Filters,
-    CallbackQueryHandler,
 )
 
-from app_tg_bot.config import USER_NAME_ADMINS
+from app_tg_bot.config import USER_NAME_ADMINS, MAX_PRICE_ALERTS_PER_USER
 from app_tg_bot.bot.common import (
     reply_message,
     log_func,
@@ -34,22 +35,39 @@ from app_tg_bot.bot.common import (
     FORMAT_PREV,
     FORMAT_CURRENT,
     FORMAT_NEXT,
+    CALLBACK_CODE_BY_METAL,
+    get_metal_by_callback_code,
 )
+from app_tg_bot.bot.lanes import run_in_lane, LaneEnum
+from app_tg_bot.bot.router import CallbackQueryRouter, TextRouter
 from app_tg_bot.bot.regexp_patterns import (
     PATTERN_REPLY_ADMIN_STATS,
     COMMAND_ADMIN_STATS,
     PATTERN_REPLY_GET_AS_TEXT,
     PATTERN_INLINE_GET_BY_DATE,
+    PATTERN_INLINE_GET_BY_DATE_LEGACY,
     PATTERN_REPLY_GET_LAST_7_AS_CHART,
     PATTERN_REPLY_GET_LAST_31_AS_CHART,
     PATTERN_REPLY_GET_ALL_AS_CHART,
     PATTERN_REPLY_SUBSCRIBE,
     PATTERN_REPLY_UNSUBSCRIBE,
     PATTERN_INLINE_GET_AS_CHART,
+    PATTERN_INLINE_GET_AS_CHART_LEGACY,
     PATTERN_REPLY_SELECT_DATE,
     PATTERN_INLINE_SELECT_DATE,
+    PATTERN_INLINE_SELECT_DATE_LEGACY,
     PATTERN_INLINE_GET_CHART_METAL_BY_YEAR,
+    PATTERN_INLINE_GET_CHART_METAL_BY_YEAR_LEGACY,
+    PATTERN_REPLY_ALERTS,
+    COMMAND_ALERTS,
+    COMMAND_ALERT,
+    PATTERN_ALERT_ARGS,
+    PATTERN_INLINE_ALERT_DELETE,
+    PATTERN_INLINE_ALERT_DELETE_LEGACY,
+    COMMAND_STATS,
+    PATTERN_STATS_ARGS,
     CALLBACK_IGNORE,
+    CALLBACK_ALL_METALS,
     fill_string_pattern,
 )
 from app_tg_bot.bot.third_party.auto_in_progress_message import (
@@ -58,8 +76,18 @@ from app_tg_bot.bot.third_party.auto_in_progress_message import (
 )
 from app_tg_bot.bot.third_party import telegramcalendar
 
-from db import Subscription, MetalRate
-from root_common import get_date_str, MetalEnum, SubscriptionResultEnum, DEFAULT_METAL
+from db import Subscription, MetalRate, MetalRateYear, MetalRateMonth, PriceAlert
+from utils.analytics import AnalyticsMetricEnum
+from root_config import DATE_FORMAT
+from root_common import (
+    get_date_str,
+    get_start_date,
+    get_end_date,
+    MetalEnum,
+    SubscriptionResultEnum,
+    DEFAULT_METAL,
+    PriceAlertKindEnum,
+)
 
 
 FILTER_BY_ADMIN = Filters.user(username=USER_NAME_ADMINS)
@@ -67,6 +95,12 @@ FILTER_BY_ADMIN = Filters.user(username=USER_NAME_ADMINS)
 TEXT_SHOW_TEMP_MESSAGE = SeverityEnum.INFO.get_text("Пожалуйста, подождите {value}")
 PROGRESS_VALUE = ProgressValue.RECTS_SMALL
 
+# Если график будет готов быстрее, то временное сообщение не появится
+SHOW_TEMP_MESSAGE_DELAY: float = 0.7
+
+# Дополнительные линии на графике за год: скользящая средняя за месяц
+YEAR_CHART_OVERLAYS = ((AnalyticsMetricEnum.SMA, 20),)
+
 
 def get_reply_keyboard(update: Update, context: CallbackContext) -> ReplyKeyboardMarkup:
     is_active = Subscription.has_is_active(update.effective_user.id)
@@ -81,7 +115,10 @@ def get_reply_keyboard(update: Update, context: CallbackContext) -> ReplyKeyboar
             fill_string_pattern(PATTERN_REPLY_GET_LAST_31_AS_CHART),
         ],
         [fill_string_pattern(PATTERN_REPLY_GET_ALL_AS_CHART)],
-        [fill_string_pattern(PATTERN_REPLY_UNSUBSCRIBE) if is_active else fill_string_pattern(PATTERN_REPLY_SUBSCRIBE)]
+        [
+            fill_string_pattern(PATTERN_REPLY_UNSUBSCRIBE) if is_active else fill_string_pattern(PATTERN_REPLY_SUBSCRIBE),
+            fill_string_pattern(PATTERN_REPLY_ALERTS),
+        ]
     ]
     return ReplyKeyboardMarkup(commands, resize_keyboard=True)
 
@@ -128,7 +165,6 @@ def get_inline_keyboard_for_year_pagination(
     buttons: list[list[InlineKeyboardButton]] = [[], []]
 
     for metal in MetalEnum:
-        metal_name = metal.name
         metal_title = metal.singular
         is_current = current_metal == metal
 
@@ -137,19 +173,19 @@ def get_inline_keyboard_for_year_pagination(
                 text=FORMAT_CURRENT.format(metal_title) if is_current else metal_title,
                 callback_data=fill_string_pattern(
                     pattern,
-                    CALLBACK_IGNORE if is_current else metal_name,
+                    CALLBACK_IGNORE if is_current else CALLBACK_CODE_BY_METAL[metal],
                     CALLBACK_IGNORE if is_current else current_year,
                 ),
             )
         )
 
-    prev_year, next_year = MetalRate.get_prev_next_years(year=current_year)
+    prev_year, next_year = MetalRateYear.get_prev_next_years(year=current_year)
     if prev_year:
         buttons[1].append(
             InlineKeyboardButton(
                 text=FORMAT_PREV.format(prev_year),
                 callback_data=fill_string_pattern(
-                    pattern, current_metal.name, prev_year
+                    pattern, CALLBACK_CODE_BY_METAL[current_metal], prev_year
                 ),
             )
         )
@@ -169,7 +205,7 @@ def get_inline_keyboard_for_year_pagination(
             InlineKeyboardButton(
                 text=FORMAT_NEXT.format(next_year),
                 callback_data=fill_string_pattern(
-                    pattern, current_metal.name, next_year
+                    pattern, CALLBACK_CODE_BY_METAL[current_metal], next_year
                 ),
             )
         )
@@ -177,25 +213,66 @@ def get_inline_keyboard_for_year_pagination(
     return InlineKeyboardMarkup(buttons)
 
 
+def get_metal_by_name(name: str) -> Optional[MetalEnum]:
+    name = name.lower()
+    for metal in MetalEnum:
+        if name in (metal.name_lower, metal.singular, metal.plural):
+            return metal
+
+    return None
+
+
+def get_alerts_help_text() -> str:
+    return (
+        f"Добавить оповещение: /{COMMAND_ALERT} металл &gt; значение, "
+        f"/{COMMAND_ALERT} металл &lt; значение или /{COMMAND_ALERT} металл процент%\n"
+        f"Например: /{COMMAND_ALERT} золото &gt; 6000, /{COMMAND_ALERT} palladium 3%"
+    )
+
+
+def get_alerts_text_and_keyboard(user_id: int) -> tuple[str, Optional[InlineKeyboardMarkup]]:
+    alerts = PriceAlert.get_active_by_user_id(user_id)
+
+    text = get_alerts_help_text()
+    if not alerts:
+        return "Оповещений нет\n\n" + text, None
+
+    text = "<b>Оповещения</b>\n" + "\n".join(
+        f"{i}. {alert.get_title()}" for i, alert in enumerate(alerts, 1)
+    ) + "\n\n" + text
+
+    reply_markup = InlineKeyboardMarkup.from_column([
+        InlineKeyboardButton(
+            text=f"❌ {i}. {alert.get_title()}",
+            callback_data=fill_string_pattern(PATTERN_INLINE_ALERT_DELETE, alert.id),
+        )
+        for i, alert in enumerate(alerts, 1)
+    ])
+    return text, reply_markup
+
+
+@run_in_lane(LaneEnum.TEXT)
 @log_func(log)
 def on_start(update: Update, context: CallbackContext):
     reply_message(
         f"Приветствую, {update.effective_user.name}! 🙂\n"
         "Данный бот способен отслеживать курсы драгоценных металлов и отправлять вам уведомление при появлении новых.\n"
-        "С помощью меню вы можете подписаться/отписаться от рассылки, посмотреть курсы текстом или на графике",
+        "С помощью меню вы можете подписаться/отписаться от рассылки, посмотреть курсы текстом или на графике, "
+        "а также настроить оповещения об изменении курсов",
         update=update,
         context=context,
         reply_markup=get_reply_keyboard(update, context),
     )
 
 
+@run_in_lane(LaneEnum.ADMIN)
 @log_func(log)
 def on_admin_stats(update: Update, context: CallbackContext):
     count = MetalRate.select().count()
     first_date = get_date_str(MetalRate.select().first().date)
     last_date = get_date_str(MetalRate.get_last().date)
 
-    subscription_active_count = Subscription.select().where(Subscription.is_active == True).count()
+    subscription_active_count = Subscription.get_active_count()
 
     reply_message(
         f"<b>Статистика админа</b>\n\n"
@@ -211,6 +288,7 @@ def on_admin_stats(update: Update, context: CallbackContext):
     )
 
 
+@run_in_lane(LaneEnum.TEXT)
 @log_func(log)
 def on_get_as_text(update: Update, context: CallbackContext):
     query = update.callback_query
@@ -238,6 +316,7 @@ def on_get_as_text(update: Update, context: CallbackContext):
     )
 
 
+@run_in_lane(LaneEnum.TEXT)
 @log_func(log)
 def on_select_date(update: Update, context: CallbackContext):
     query = update.callback_query
@@ -248,27 +327,38 @@ def on_select_date(update: Update, context: CallbackContext):
             update=update,
             context=context,
             reply_markup=telegramcalendar.create_calendar(
-                year=date.year, month=date.month
+                year=date.year,
+                month=date.month,
+                available_days=MetalRateMonth.get_available_days(date.year, date.month),
             ),
         )
         return
 
     query.answer()
 
+    # Нажатие на заголовок, дни недели или день без курсов
+    action, *_ = telegramcalendar.separate_callback_data(query.data)
+    if action == "IGNORE":
+        return
+
     bot = context.bot
 
-    selected, for_date = telegramcalendar.process_calendar_selection(bot, update)
+    selected, for_date = telegramcalendar.process_calendar_selection(
+        bot, update, get_available_days=MetalRateMonth.get_available_days
+    )
     if selected:
+        for_date = for_date.date()
         msg_not_found_for_date = ""
 
-        metal_rate: MetalRate = MetalRate.get_by(for_date)
-        if not metal_rate:
+        # Дни без курсов в календаре недоступны, но клавиатура могла устареть
+        nearest_date = MetalRateMonth.get_nearest_date(for_date)
+        if nearest_date != for_date:
             msg_not_found_for_date = SeverityEnum.INFO.get_text(
                 f"За {get_date_str(for_date)} нет данных, будет выбрана ближайшая дата"
             )
-            prev_date, next_date = MetalRate.get_prev_next_dates(for_date)
-            for_date = next_date if next_date else prev_date
-            metal_rate: MetalRate = MetalRate.get_by(for_date)
+            for_date = nearest_date
+
+        metal_rate: MetalRate = MetalRate.get_by(for_date)
 
         text = metal_rate.get_description(show_diff=True)
         if msg_not_found_for_date:
@@ -282,10 +372,12 @@ def on_select_date(update: Update, context: CallbackContext):
         )
 
 
+@run_in_lane(LaneEnum.CHART)
 @log_func(log)
 @show_temp_message_decorator(
     text=TEXT_SHOW_TEMP_MESSAGE,
     progress_value=PROGRESS_VALUE,
+    show_delay=SHOW_TEMP_MESSAGE_DELAY,
 )
 def on_get_last_7_as_chart(update: Update, context: CallbackContext):
     reply_or_edit_plot_with_keyboard(
@@ -295,10 +387,12 @@ def on_get_last_7_as_chart(update: Update, context: CallbackContext):
     )
 
 
+@run_in_lane(LaneEnum.CHART)
 @log_func(log)
 @show_temp_message_decorator(
     text=TEXT_SHOW_TEMP_MESSAGE,
     progress_value=PROGRESS_VALUE,
+    show_delay=SHOW_TEMP_MESSAGE_DELAY,
 )
 def on_get_last_31_as_chart(update: Update, context: CallbackContext):
     reply_or_edit_plot_with_keyboard(
@@ -308,10 +402,12 @@ def on_get_last_31_as_chart(update: Update, context: CallbackContext):
     )
 
 
+@run_in_lane(LaneEnum.CHART)
 @log_func(log)
 @show_temp_message_decorator(
     text=TEXT_SHOW_TEMP_MESSAGE,
     progress_value=PROGRESS_VALUE,
+    show_delay=SHOW_TEMP_MESSAGE_DELAY,
 )
 def on_get_all_as_chart(update: Update, context: CallbackContext):
     reply_or_edit_plot_with_keyboard(
@@ -322,22 +418,24 @@ def on_get_all_as_chart(update: Update, context: CallbackContext):
             InlineKeyboardButton(
                 text="Посмотреть за определенный год",
                 callback_data=fill_string_pattern(
-                    PATTERN_INLINE_GET_CHART_METAL_BY_YEAR, DEFAULT_METAL.name, -1
+                    PATTERN_INLINE_GET_CHART_METAL_BY_YEAR, CALLBACK_CODE_BY_METAL[DEFAULT_METAL], -1
                 ),
             ),
         ],
     )
 
 
+@run_in_lane(LaneEnum.CHART)
 @log_func(log)
 @show_temp_message_decorator(
     text=TEXT_SHOW_TEMP_MESSAGE,
     progress_value=PROGRESS_VALUE,
+    show_delay=SHOW_TEMP_MESSAGE_DELAY,
 )
 def on_callback_get_as_chart(update: Update, context: CallbackContext):
-    number_str, metal_name = context.match.groups()
+    number_str, metal_code = context.match.groups()
     number = int(number_str)
-    metal = MetalEnum[metal_name]
+    metal = None if metal_code == CALLBACK_ALL_METALS else get_metal_by_callback_code(metal_code)
 
     reply_or_edit_plot_with_keyboard(
         update=update,
@@ -346,24 +444,26 @@ def on_callback_get_as_chart(update: Update, context: CallbackContext):
     )
 
 
+@run_in_lane(LaneEnum.CHART)
 @log_func(log)
 @show_temp_message_decorator(
     text=TEXT_SHOW_TEMP_MESSAGE,
     progress_value=PROGRESS_VALUE,
+    show_delay=SHOW_TEMP_MESSAGE_DELAY,
 )
 def on_get_all_by_year(update: Update, context: CallbackContext):
     query = update.callback_query
     if query:
         query.answer()
 
-    metal_name, year_str = context.match.groups()
-    if metal_name == CALLBACK_IGNORE:
+    metal_code, year_str = context.match.groups()
+    if metal_code == CALLBACK_IGNORE:
         return
 
-    metal = MetalEnum[metal_name]
+    metal = get_metal_by_callback_code(metal_code)
     year = int(year_str)
     if year == -1:
-        year = MetalRate.get_last_date().year
+        year = MetalRateYear.get_last_year()
 
     reply_or_edit_plot_with_keyboard(
         update=update,
@@ -371,9 +471,11 @@ def on_get_all_by_year(update: Update, context: CallbackContext):
         year=year,
         need_answer=False,
         reply_markup=get_inline_keyboard_for_year_pagination(metal, year),
+        overlays=YEAR_CHART_OVERLAYS,
     )
 
 
+@run_in_lane(LaneEnum.TEXT)
 @log_func(log)
 def on_subscribe(update: Update, context: CallbackContext):
     message = update.effective_message
@@ -397,6 +499,7 @@ def on_subscribe(update: Update, context: CallbackContext):
     )
 
 
+@run_in_lane(LaneEnum.TEXT)
 @log_func(log)
 def on_unsubscribe(update: Update, context: CallbackContext):
     message = update.effective_message
@@ -420,78 +523,231 @@ def on_unsubscribe(update: Update, context: CallbackContext):
     )
 
 
+@run_in_lane(LaneEnum.TEXT)
 @log_func(log)
-def on_request(update: Update, context: CallbackContext):
+def on_alerts(update: Update, context: CallbackContext):
+    query = update.callback_query
+    user_id = update.effective_user.id
+
+    if query:
+        query.answer()
+        PriceAlert.deactivate(user_id, int(context.match.group(1)))
+
+    text, reply_markup = get_alerts_text_and_keyboard(user_id)
+
+    if query:
+        query.edit_message_text(
+            text=text,
+            parse_mode=ParseMode.HTML,
+            reply_markup=reply_markup,
+        )
+        return
+
     reply_message(
-        "Неизвестная команда",
+        text=text,
         update=update,
         context=context,
-        reply_markup=get_reply_keyboard(update, context),
-        severity=SeverityEnum.ERROR,
-        quote=True,
+        parse_mode=ParseMode.HTML,
+        reply_markup=reply_markup,
     )
 
 
-def on_error(update: Update, context: CallbackContext):
-    process_error(log, update, context)
-
+@run_in_lane(LaneEnum.TEXT)
+@log_func(log)
+def on_alert_add(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
 
-def setup(dp: Dispatcher):
-    dp.add_handler(CommandHandler("start", on_start))
+    m = PATTERN_ALERT_ARGS.match(" ".join(context.args))
+    metal = get_metal_by_name(m.group(1)) if m else None
+    if not metal:
+        reply_message(
+            text=get_alerts_help_text(),
+            update=update,
+            context=context,
+            parse_mode=ParseMode.HTML,
+            severity=SeverityEnum.ERROR,
+        )
+        return
 
-    dp.add_handler(CommandHandler(COMMAND_ADMIN_STATS, on_admin_stats, FILTER_BY_ADMIN))
-    dp.add_handler(
-        MessageHandler(
-            Filters.regex(PATTERN_REPLY_ADMIN_STATS) & FILTER_BY_ADMIN, on_admin_stats
+    if len(PriceAlert.get_active_by_user_id(user_id)) >= MAX_PRICE_ALERTS_PER_USER:
+        reply_message(
+            text=f"Нельзя добавить больше {MAX_PRICE_ALERTS_PER_USER} оповещений",
+            update=update,
+            context=context,
+            severity=SeverityEnum.ERROR,
         )
-    )
+        return
 
-    dp.add_handler(
-        MessageHandler(Filters.regex(PATTERN_REPLY_GET_AS_TEXT), on_get_as_text)
-    )
-    dp.add_handler(
-        CallbackQueryHandler(on_get_as_text, pattern=PATTERN_INLINE_GET_BY_DATE)
-    )
+    _, sign, value_str, percent = m.groups()
+    value = Decimal(value_str.replace(",", "."))
+
+    if percent:
+        kind = PriceAlertKindEnum.CHANGE
+    elif sign:
+        kind = PriceAlertKindEnum.UP if sign == ">" else PriceAlertKindEnum.DOWN
+    else:
+        # Направление определяется по текущему курсу
+        metal_rate = MetalRate.get_last()
+        current_value = getattr(metal_rate, metal.name_lower) if metal_rate else None
+        if current_value is None:
+            reply_message(
+                text=f"{metal.singular.title()}: нет текущего курса, укажите направление > или <",
+                update=update,
+                context=context,
+                severity=SeverityEnum.ERROR,
+            )
+            return
 
-    dp.add_handler(
-        MessageHandler(Filters.regex(PATTERN_REPLY_SELECT_DATE), on_select_date)
-    )
-    dp.add_handler(
-        CallbackQueryHandler(on_select_date, pattern=PATTERN_INLINE_SELECT_DATE)
-    )
+        kind = PriceAlertKindEnum.UP if value > current_value else PriceAlertKindEnum.DOWN
 
-    dp.add_handler(
-        MessageHandler(
-            Filters.regex(PATTERN_REPLY_GET_LAST_7_AS_CHART), on_get_last_7_as_chart
-        )
-    )
-    dp.add_handler(
-        MessageHandler(
-            Filters.regex(PATTERN_REPLY_GET_LAST_31_AS_CHART), on_get_last_31_as_chart
-        )
-    )
-    dp.add_handler(
-        MessageHandler(
-            Filters.regex(PATTERN_REPLY_GET_ALL_AS_CHART), on_get_all_as_chart
-        )
+    alert = PriceAlert.add(user_id, metal, kind, value)
+
+    reply_message(
+        text=f"Оповещение добавлено: {alert.get_title()}",
+        update=update,
+        context=context,
+        severity=SeverityEnum.INFO,
+        reply_markup=get_reply_keyboard(update, context),
     )
-    dp.add_handler(
-        CallbackQueryHandler(
-            on_callback_get_as_chart, pattern=PATTERN_INLINE_GET_AS_CHART
+
+
+def get_stats_period(args: list[str]) -> Optional[tuple[DT.date, DT.date]]:
+    if not args:
+        year = MetalRateYear.get_last_year() or DT.date.today().year
+        return get_start_date(year), get_end_date(year)
+
+    m = PATTERN_STATS_ARGS.match(" ".join(args))
+    if not m:
+        return None
+
+    year_str, start_date_str, end_date_str = m.groups()
+    if year_str:
+        year = int(year_str)
+        return get_start_date(year), get_end_date(year)
+
+    try:
+        start_date = DT.datetime.strptime(start_date_str, DATE_FORMAT).date()
+        end_date = DT.datetime.strptime(end_date_str, DATE_FORMAT).date()
+    except ValueError:
+        return None
+
+    return start_date, end_date
+
+
+@run_in_lane(LaneEnum.TEXT)
+@log_func(log)
+def on_stats(update: Update, context: CallbackContext):
+    period = get_stats_period(context.args)
+    if not period:
+        date_example = get_date_str(MetalRate.get_last_date())
+        reply_message(
+            text=(
+                f"Статистика за год или за период: /{COMMAND_STATS} 2021 "
+                f"или /{COMMAND_STATS} 01/01/2021 {date_example}"
+            ),
+            update=update,
+            context=context,
+            severity=SeverityEnum.ERROR,
         )
-    )
+        return
 
-    dp.add_handler(
-        CallbackQueryHandler(
-            on_get_all_by_year, pattern=PATTERN_INLINE_GET_CHART_METAL_BY_YEAR
+    start_date, end_date = period
+
+    # Фактический диапазон дат, за которые есть курсы хотя бы одного металла
+    actual_start_date = actual_end_date = None
+
+    lines = []
+    for metal in MetalEnum:
+        stats = MetalRate.get_range_stats(metal, start_date, end_date)
+        if not stats:
+            continue
+
+        if not actual_start_date or stats.start_date < actual_start_date:
+            actual_start_date = stats.start_date
+        if not actual_end_date or stats.end_date > actual_end_date:
+            actual_end_date = stats.end_date
+
+        lines.append(
+            f"{metal.singular.title()}: "
+            f"мин. {stats.min_value:.2f} ({get_date_str(stats.min_date)}), "
+            f"макс. {stats.max_value:.2f} ({get_date_str(stats.max_date)}), "
+            f"сред. {stats.avg_value:.2f}"
         )
+
+    if not lines:
+        lines.append("Нет данных")
+    else:
+        start_date, end_date = actual_start_date, actual_end_date
+
+    title = f"<b>Статистика за {get_date_str(start_date)} - {get_date_str(end_date)}</b>"
+
+    reply_message(
+        text=title + "\n" + "\n".join(lines),
+        update=update,
+        context=context,
+        parse_mode=ParseMode.HTML,
+        reply_markup=get_reply_keyboard(update, context),
     )
 
-    dp.add_handler(MessageHandler(Filters.regex(PATTERN_REPLY_SUBSCRIBE), on_subscribe))
-    dp.add_handler(
-        MessageHandler(Filters.regex(PATTERN_REPLY_UNSUBSCRIBE), on_unsubscribe)
+
+@run_in_lane(LaneEnum.TEXT)
+@log_func(log)
+def on_request(update: Update, context: CallbackContext):
+    reply_message(
+        "Неизвестная команда",
+        update=update,
+        context=context,
+        reply_markup=get_reply_keyboard(update, context),
+        severity=SeverityEnum.ERROR,
+        quote=True,
     )
 
-    dp.add_handler(MessageHandler(Filters.text, on_request))
+
+def on_error(update: Update, context: CallbackContext):
+    process_error(log, update, context)
+
+
+def setup(dp: Dispatcher):
+    dp.add_handler(CommandHandler("start", on_start))
+    dp.add_handler(CommandHandler(COMMAND_ADMIN_STATS, on_admin_stats, FILTER_BY_ADMIN))
+    dp.add_handler(CommandHandler(COMMAND_ALERTS, on_alerts))
+    dp.add_handler(CommandHandler(COMMAND_ALERT, on_alert_add))
+    dp.add_handler(CommandHandler(COMMAND_STATS, on_stats))
+
+    # Обработчики кнопок выбираются по словарю, а не перебором регулярных выражений
+    text_router = TextRouter(default_callback=on_request)
+    text_router.add(
+        PATTERN_REPLY_ADMIN_STATS,
+        on_admin_stats,
+        texts=["admin stats", "admin_stats", "статистика админа", "статистика_админа"],
+        filters=FILTER_BY_ADMIN,
+    )
+    for pattern, callback in [
+        (PATTERN_REPLY_GET_AS_TEXT, on_get_as_text),
+        (PATTERN_REPLY_SELECT_DATE, on_select_date),
+        (PATTERN_REPLY_GET_LAST_7_AS_CHART, on_get_last_7_as_chart),
+        (PATTERN_REPLY_GET_LAST_31_AS_CHART, on_get_last_31_as_chart),
+        (PATTERN_REPLY_GET_ALL_AS_CHART, on_get_all_as_chart),
+        (PATTERN_REPLY_SUBSCRIBE, on_subscribe),
+        (PATTERN_REPLY_UNSUBSCRIBE, on_unsubscribe),
+        (PATTERN_REPLY_ALERTS, on_alerts),
+    ]:
+        text_router.add(pattern, callback, texts=[fill_string_pattern(pattern)])
+    dp.add_handler(text_router)
+
+    callback_router = CallbackQueryRouter()
+    for pattern, callback, legacy_pattern in [
+        (PATTERN_INLINE_GET_BY_DATE, on_get_as_text, PATTERN_INLINE_GET_BY_DATE_LEGACY),
+        (PATTERN_INLINE_SELECT_DATE, on_select_date, PATTERN_INLINE_SELECT_DATE_LEGACY),
+        (PATTERN_INLINE_GET_AS_CHART, on_callback_get_as_chart, PATTERN_INLINE_GET_AS_CHART_LEGACY),
+        (
+            PATTERN_INLINE_GET_CHART_METAL_BY_YEAR,
+            on_get_all_by_year,
+            PATTERN_INLINE_GET_CHART_METAL_BY_YEAR_LEGACY,
+        ),
+        (PATTERN_INLINE_ALERT_DELETE, on_alerts, PATTERN_INLINE_ALERT_DELETE_LEGACY),
+    ]:
+        callback_router.add(pattern, callback, legacy_pattern)
+    dp.add_handler(callback_router)
 
     dp.add_error_handler(on_error)
@@ -9,7 +9,10 @@ import functools
 import inspect
 import json
 import logging
-from typing import Union, Optional
+import threading
+import time
+from io import BytesIO
+from typing import Hashable, Union, Optional
 
 from telegram import (
     Update,
@@ -25,17 +28,42 @@ from telegram.ext import CallbackContext
 from telegram.utils.types import FileInput
 from telegram.files.photosize import PhotoSize
 
-from app_tg_bot.bot.regexp_patterns import PATTERN_INLINE_GET_AS_CHART
+from app_tg_bot.bot import metrics
+from app_tg_bot.bot.regexp_patterns import PATTERN_INLINE_GET_AS_CHART, CALLBACK_ALL_METALS
 from app_tg_bot.bot.third_party.regexp import fill_string_pattern
-from app_tg_bot.config import DIR_LOGS, MAX_MESSAGE_LENGTH, ERROR_TEXT
-from root_common import get_logger, MetalEnum
+from app_tg_bot.config import DIR_LOGS, MAX_MESSAGE_LENGTH, ERROR_TEXT, CHART_PRESET_NAME
+from db import db
+from root_common import get_logger, MetalEnum, RollupPeriodEnum
 from utils import draw_plot
+from utils.analytics import AnalyticsMetricEnum
+from utils.single_flight import SingleFlight
 
 
 FORMAT_PREV = "❮ {}"
 FORMAT_CURRENT = "· {} ·"
 FORMAT_NEXT = "{} ❯"
 
+# Короткие коды металлов (химические символы) для данных inline-кнопок, т.к. размер
+# данных ограничен 64 байтами
+CALLBACK_CODE_BY_METAL: dict[MetalEnum, str] = {
+    MetalEnum.GOLD: "au",
+    MetalEnum.SILVER: "ag",
+    MetalEnum.PLATINUM: "pt",
+    MetalEnum.PALLADIUM: "pd",
+}
+_METAL_BY_CALLBACK_CODE: dict[str, MetalEnum] = {
+    code: metal for metal, code in CALLBACK_CODE_BY_METAL.items()
+}
+
+
+def get_metal_by_callback_code(code: str) -> MetalEnum:
+    """
+    Металл по коду из данных inline-кнопки. В кнопках уже отправленных
+    сообщений вместо кода указано название металла
+    """
+
+    return _METAL_BY_CALLBACK_CODE.get(code) or MetalEnum[code]
+
 
 # SOURCE: https://github.com/gil9red/telegram__random_bashim_bot/blob/e9d705a52223597c6965ef82f0b0d55fa11722c2/bot/parsers.py#L37
 def caller_name() -> str:
@@ -47,7 +75,9 @@ def log_func(log: logging.Logger):
     def actual_decorator(func):
         @functools.wraps(func)
         def wrapper(update: Update, context: CallbackContext):
-            if update:
+            # Поля собираются только если DEBUG включен, а форматирование строки
+            # выполняется при записи лога, а не в потоке обработчика
+            if update and log.isEnabledFor(logging.DEBUG):
                 chat_id = user_id = first_name = last_name = username = language_code = None
 
                 if update.effective_chat:
@@ -70,23 +100,142 @@ def log_func(log: logging.Logger):
                 except:
                     query_data = ""
 
-                msg = (
-                    f"[chat_id={chat_id}, user_id={user_id}, "
-                    f"first_name={first_name!r}, last_name={last_name!r}, "
-                    f"username={username!r}, language_code={language_code}, "
-                    f"message={message!r}, query_data={query_data!r}]"
+                log.debug(
+                    "%s[chat_id=%s, user_id=%s, "
+                    "first_name=%r, last_name=%r, "
+                    "username=%r, language_code=%s, "
+                    "message=%r, query_data=%r]",
+                    func.__name__, chat_id, user_id,
+                    first_name, last_name,
+                    username, language_code,
+                    message, query_data,
                 )
-                msg = func.__name__ + msg
 
-                log.debug(msg)
-
-            return func(update, context)
+            start_time = time.perf_counter()
+            query_count = db.get_query_count()
+            try:
+                return func(update, context)
+            finally:
+                handler = func.__name__
+                metrics.HANDLER_DURATION.observe(
+                    time.perf_counter() - start_time, handler=handler
+                )
+                metrics.HANDLER_DB_QUERIES.observe(
+                    db.get_query_count() - query_count, handler=handler
+                )
 
         return wrapper
 
     return actual_decorator
 
 
+CHART_SINGLE_FLIGHT = SingleFlight()
+
+CHART_PRESET = draw_plot.ChartPresetEnum[CHART_PRESET_NAME]
+
+
+def get_plot_for_metal(
+    metal: Optional[MetalEnum],
+    number: int = -1,
+    year: int = None,
+    period: RollupPeriodEnum = None,
+    overlays: tuple[tuple[AnalyticsMetricEnum, Optional[int]], ...] = (),
+) -> bytes:
+    """
+    Если metal не задан, то рисуется график сравнения всех металлов
+    """
+
+    def _draw() -> bytes:
+        with metrics.CHART_RENDER_DURATION.time():
+            if metal is None:
+                photo = draw_plot.get_plot_for_metals(
+                    number=number, year=year, period=period, preset=CHART_PRESET
+                )
+            else:
+                photo = draw_plot.get_plot_for_metal(
+                    metal=metal,
+                    number=number,
+                    year=year,
+                    period=period,
+                    overlays=overlays,
+                    preset=CHART_PRESET,
+                )
+            return photo.read()
+
+    metrics.CHART_REQUESTS.inc()
+
+    data, is_shared = CHART_SINGLE_FLIGHT.do(
+        (metal, number, year, period, overlays), _draw
+    )
+    if is_shared:
+        metrics.CHART_REQUESTS_COALESCED.inc()
+
+    return data
+
+
+class LatestWins:
+    """
+    Для каждого ключа актуален только последний начатый запрос,
+    результаты предыдущих запросов отбрасываются
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._key_by_generation: dict[Hashable, int] = dict()
+        self._key_by_lock: dict[Hashable, threading.Lock] = dict()
+
+    def start(self, key: Hashable) -> int:
+        """
+        Возвращает поколение запроса. Поколение 1 означает, что других
+        запросов с этим ключом сейчас нет
+        """
+
+        with self._condition:
+            generation = self._key_by_generation.get(key, 0) + 1
+            self._key_by_generation[key] = generation
+            if key not in self._key_by_lock:
+                self._key_by_lock[key] = threading.Lock()
+
+            # Ожидающие предыдущие запросы сразу узнают, что они устарели
+            self._condition.notify_all()
+            return generation
+
+    def is_latest(self, key: Hashable, generation: int) -> bool:
+        with self._condition:
+            return self._key_by_generation.get(key) == generation
+
+    def wait_superseded(self, key: Hashable, generation: int, timeout: float) -> bool:
+        """
+        Ожидание более нового запроса с этим ключом. Возвращает True, если он появился
+        """
+
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self._key_by_generation.get(key) != generation,
+                timeout=timeout,
+            )
+
+    def lock(self, key: Hashable) -> threading.Lock:
+        with self._condition:
+            return self._key_by_lock.setdefault(key, threading.Lock())
+
+    def finish(self, key: Hashable, generation: int):
+        # Последний запрос убирает за собой, чтобы словари не росли
+        with self._condition:
+            if self._key_by_generation.get(key) == generation:
+                self._key_by_generation.pop(key)
+
+            if key not in self._key_by_generation:
+                self._key_by_lock.pop(key, None)
+
+
+# Сколько ждать следующего нажатия, если кнопки сообщения нажимают быстро: запрос
+# ждет, только если для этого сообщения уже выполняется предыдущий запрос
+CHART_DEBOUNCE_DELAY_SECS: float = 0.2
+
+CHART_LATEST_WINS = LatestWins()
+
+
 class SeverityEnum(enum.Enum):
     NONE = "{text}"
     INFO = "ℹ️ {text}"
@@ -181,13 +330,14 @@ def reply_text_or_edit_with_keyboard(
 
 def reply_or_edit_plot_with_keyboard(
     update: Update,
-    metal: MetalEnum,
+    metal: Optional[MetalEnum],
     number: int = -1,
     year: int = None,
     quote: bool = True,
     need_answer: bool = True,
     reply_markup: ReplyMarkup = None,
     reply_buttons_bottom: list[InlineKeyboardButton] = None,
+    overlays: tuple[tuple[AnalyticsMetricEnum, Optional[int]], ...] = (),
     **kwargs,
 ):
     message = update.effective_message
@@ -195,8 +345,6 @@ def reply_or_edit_plot_with_keyboard(
     if query and need_answer:
         query.answer()
 
-    photo = draw_plot.get_plot_for_metal(metal=metal, number=number, year=year)
-
     if not reply_markup:
         # TODO: Вынести за функцию, пусть явно передается reply_markup
         reply_markup = get_inline_keyboard_for_metal_switch_in_chart(
@@ -206,53 +354,103 @@ def reply_or_edit_plot_with_keyboard(
     if reply_markup and reply_buttons_bottom:
         reply_markup.inline_keyboard.append(reply_buttons_bottom)
 
-    # Для запросов CallbackQuery нужно менять текущее сообщение
-    if query:
-        # Fix error: "telegram.error.BadRequest: Message is not modified"
-        if is_equal_inline_keyboards(reply_markup, query.message.reply_markup):
-            return
+    # Для графика за все данные достаточно значений по неделям
+    period = RollupPeriodEnum.WEEK if number == -1 and not year else None
 
-        try:
-            message.edit_media(
-                media=InputMediaPhoto(media=photo),
+    if not query:
+        photo = BytesIO(
+            get_plot_for_metal(
+                metal=metal, number=number, year=year, period=period, overlays=overlays
+            )
+        )
+        with metrics.CHART_UPLOAD_DURATION.time():
+            message.reply_photo(
+                photo=photo,
                 reply_markup=reply_markup,
+                quote=quote,
                 **kwargs,
             )
-        except BadRequest as e:
-            if "Message is not modified" in str(e):
-                return
+        return
 
-            raise e
+    # Для запросов CallbackQuery нужно менять текущее сообщение
 
-    else:
-        message.reply_photo(
-            photo=photo,
-            reply_markup=reply_markup,
-            quote=quote,
-            **kwargs,
+    # Fix error: "telegram.error.BadRequest: Message is not modified"
+    if is_equal_inline_keyboards(reply_markup, query.message.reply_markup):
+        return
+
+    # При быстрых нажатиях на кнопки одного сообщения нужен только последний запрос
+    key = message.chat_id, message.message_id
+    generation = CHART_LATEST_WINS.start(key)
+    try:
+        # Одиночное нажатие рисуется сразу, а при серии нажатий промежуточные
+        # запросы отбрасываются, если за время задержки пришел более новый
+        if generation > 1 and CHART_LATEST_WINS.wait_superseded(
+            key, generation, timeout=CHART_DEBOUNCE_DELAY_SECS
+        ):
+            metrics.CHART_REQUESTS_SUPERSEDED.inc()
+            return
+
+        # Байты общие для одинаковых одновременных запросов, а файловый объект у каждого свой
+        photo = BytesIO(
+            get_plot_for_metal(
+                metal=metal, number=number, year=year, period=period, overlays=overlays
+            )
         )
 
+        # Изменение сообщения только для последнего запроса, иначе более старый
+        # запрос может перезаписать результат более нового
+        with CHART_LATEST_WINS.lock(key):
+            if not CHART_LATEST_WINS.is_latest(key, generation):
+                metrics.CHART_REQUESTS_SUPERSEDED.inc()
+                return
+
+            try:
+                with metrics.CHART_UPLOAD_DURATION.time():
+                    message.edit_media(
+                        media=InputMediaPhoto(media=photo),
+                        reply_markup=reply_markup,
+                        **kwargs,
+                    )
+            except BadRequest as e:
+                if "Message is not modified" in str(e):
+                    return
+
+                raise e
+
+    finally:
+        CHART_LATEST_WINS.finish(key, generation)
+
 
 # SOURCE: https://github.com/gil9red/telegram__random_bashim_bot/blob/e9c98248f10c4a74f0e26dcf5a949bf2260f57d4/common.py#L147
 def get_inline_keyboard_for_metal_switch_in_chart(
-    current_metal: MetalEnum,
+    current_metal: Optional[MetalEnum],
     number: Union[str, int],
 ) -> InlineKeyboardMarkup:
+    """
+    Если current_metal не задан, то текущим выбран график сравнения всех металлов
+    """
+
     pattern = PATTERN_INLINE_GET_AS_CHART
 
     buttons = []
     for metal in MetalEnum:
-        metal_name = metal.name
         metal_title = metal.singular
 
         buttons.append(
             InlineKeyboardButton(
                 text=FORMAT_CURRENT.format(metal_title) if current_metal == metal else metal_title,
-                callback_data=fill_string_pattern(pattern, number, metal_name),
+                callback_data=fill_string_pattern(pattern, number, CALLBACK_CODE_BY_METAL[metal]),
             )
         )
 
-    return InlineKeyboardMarkup.from_row(buttons)
+    # Все металлы на одном графике вместо переключения между ними
+    compare_title = "Сравнить все"
+    compare_button = InlineKeyboardButton(
+        text=FORMAT_CURRENT.format(compare_title) if current_metal is None else compare_title,
+        callback_data=fill_string_pattern(pattern, number, CALLBACK_ALL_METALS),
+    )
+
+    return InlineKeyboardMarkup([buttons, [compare_button]])
 
 
 def is_equal_inline_keyboards(
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import enum
+import functools
+import queue
+import threading
+import time
+
+from typing import Callable
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+from app_tg_bot.bot import metrics
+from app_tg_bot.bot.common import log, reply_message, SeverityEnum
+from app_tg_bot.config import (
+    LANE_TEXT_WORKERS,
+    LANE_TEXT_QUEUE_SIZE,
+    LANE_CHART_WORKERS,
+    LANE_CHART_QUEUE_SIZE,
+    LANE_ADMIN_WORKERS,
+    LANE_ADMIN_QUEUE_SIZE,
+    BUSY_TEXT,
+)
+
+
+class LaneEnum(enum.Enum):
+    TEXT = ("text", LANE_TEXT_WORKERS, LANE_TEXT_QUEUE_SIZE)
+    CHART = ("chart", LANE_CHART_WORKERS, LANE_CHART_QUEUE_SIZE)
+    ADMIN = ("admin", LANE_ADMIN_WORKERS, LANE_ADMIN_QUEUE_SIZE)
+
+    def __init__(self, title: str, workers: int, queue_size: int):
+        self.title = title
+        self.workers = workers
+        self.queue_size = queue_size
+
+
+class Lane:
+    """
+    Отдельный пул потоков с ограниченной очередью, чтобы медленные обработчики
+    (например, рисование графиков) не задерживали быстрые
+    """
+
+    def __init__(self, lane: LaneEnum):
+        self.title = lane.title
+
+        self._queue: queue.Queue[tuple[float, Callable[[], None]]] = queue.Queue(
+            maxsize=lane.queue_size
+        )
+        for i in range(lane.workers):
+            threading.Thread(
+                target=self._run,
+                name=f"Lane_{self.title}_{i}",
+                daemon=True,
+            ).start()
+
+    def submit(self, func: Callable[[], None]) -> bool:
+        try:
+            self._queue.put_nowait((time.perf_counter(), func))
+        except queue.Full:
+            metrics.LANE_REJECTED.inc(lane=self.title)
+            return False
+
+        metrics.LANE_QUEUE_DEPTH.set(self._queue.qsize(), lane=self.title)
+        return True
+
+    def _run(self):
+        while True:
+            put_time, func = self._queue.get()
+
+            metrics.LANE_WAIT_DURATION.observe(
+                time.perf_counter() - put_time, lane=self.title
+            )
+            metrics.LANE_QUEUE_DEPTH.set(self._queue.qsize(), lane=self.title)
+
+            try:
+                func()
+            except Exception:
+                log.exception(f"Ошибка в очереди {self.title!r}:")
+
+
+_LANE_BY_ENUM: dict[LaneEnum, Lane] = dict()
+_LANE_LOCK = threading.Lock()
+
+
+def get_lane(lane: LaneEnum) -> Lane:
+    with _LANE_LOCK:
+        if lane not in _LANE_BY_ENUM:
+            _LANE_BY_ENUM[lane] = Lane(lane)
+
+        return _LANE_BY_ENUM[lane]
+
+
+def run_in_lane(lane: LaneEnum):
+    def actual_decorator(func):
+        @functools.wraps(func)
+        def wrapper(update: Update, context: CallbackContext):
+            def run():
+                try:
+                    func(update, context)
+                except Exception as e:
+                    # Ошибка передается в обработчики ошибок диспетчера
+                    context.dispatcher.dispatch_error(update, e)
+
+            if not get_lane(lane).submit(run):
+                if update and update.callback_query:
+                    update.callback_query.answer(BUSY_TEXT)
+                elif update and update.effective_message:
+                    reply_message(BUSY_TEXT, update, context, severity=SeverityEnum.ERROR)
+
+        return wrapper
+
+    return actual_decorator
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import json
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Union
+
+from app_tg_bot.config import METRICS_HOST, METRICS_PORT
+
+
+# Границы корзин гистограмм для времени (в секундах)
+BUCKETS_SECONDS: tuple[float, ...] = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+)
+
+# Границы корзин гистограмм для количества запросов к базе
+BUCKETS_QUERIES: tuple[float, ...] = (0, 1, 2, 3, 5, 10, 20, 50)
+
+
+def get_labels_str(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: tuple[float, ...]):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+
+        self._lock = threading.Lock()
+
+        # Значения по набору меток: счетчики корзин, сумма и количество
+        self._label_by_counts: dict[tuple, list[int]] = dict()
+        self._label_by_sum: dict[tuple, float] = dict()
+        self._label_by_count: dict[tuple, int] = dict()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+
+        with self._lock:
+            if key not in self._label_by_counts:
+                self._label_by_counts[key] = [0] * len(self.buckets)
+                self._label_by_sum[key] = 0.0
+                self._label_by_count[key] = 0
+
+            counts = self._label_by_counts[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+
+            self._label_by_sum[key] += value
+            self._label_by_count[key] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def get_count(self) -> int:
+        with self._lock:
+            return sum(self._label_by_count.values())
+
+    def get_quantile(self, q: float) -> float:
+        """
+        Оценка квантиля по всем меткам с линейной интерполяцией внутри корзины,
+        как у histogram_quantile в Prometheus
+        """
+
+        with self._lock:
+            total = sum(self._label_by_count.values())
+            counts = [0] * len(self.buckets)
+            for label_counts in self._label_by_counts.values():
+                for i, value in enumerate(label_counts):
+                    counts[i] += value
+
+        if not total:
+            return 0.0
+
+        rank = q * total
+        prev_bound, prev_count = 0.0, 0
+        for bound, count in zip(self.buckets, counts):
+            if count >= rank:
+                if count == prev_count:
+                    return bound
+                return prev_bound + (bound - prev_bound) * (rank - prev_count) / (count - prev_count)
+
+            prev_bound, prev_count = bound, count
+
+        # Значение больше границы последней корзины
+        return self.buckets[-1]
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            items = []
+            for key, counts in self._label_by_counts.items():
+                count = self._label_by_count[key]
+                total = self._label_by_sum[key]
+                items.append({
+                    "labels": dict(key),
+                    "buckets": dict(zip(map(str, self.buckets), counts)),
+                    "count": count,
+                    "sum": total,
+                    "avg": total / count if count else 0.0,
+                })
+
+        return {
+            "name": self.name,
+            "description": self.description,
+            "items": items,
+        }
+
+    def to_prometheus(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for item in self.to_dict()["items"]:
+            labels: dict = item["labels"]
+            for bound, value in item["buckets"].items():
+                labels_str = get_labels_str(labels | {"le": bound})
+                lines.append(f"{self.name}_bucket{labels_str} {value}")
+
+            labels_str = get_labels_str(labels | {"le": "+Inf"})
+            lines.append(f"{self.name}_bucket{labels_str} {item['count']}")
+
+            labels_str = get_labels_str(labels)
+            lines.append(f"{self.name}_sum{labels_str} {item['sum']}")
+            lines.append(f"{self.name}_count{labels_str} {item['count']}")
+
+        return "\n".join(lines)
+
+
+class Counter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+
+        self._lock = threading.Lock()
+        self._label_by_value: dict[tuple, int] = dict()
+
+    def inc(self, value: int = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._label_by_value[key] = self._label_by_value.get(key, 0) + value
+
+    def get(self, **labels) -> int:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            return self._label_by_value.get(key, 0)
+
+    def get_total(self) -> int:
+        with self._lock:
+            return sum(self._label_by_value.values())
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            items = [
+                {"labels": dict(key), "value": value}
+                for key, value in self._label_by_value.items()
+            ]
+
+        return {
+            "name": self.name,
+            "description": self.description,
+            "items": items,
+        }
+
+    def to_prometheus(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
+        ]
+        for item in self.to_dict()["items"]:
+            labels_str = get_labels_str(item["labels"])
+            lines.append(f"{self.name}{labels_str} {item['value']}")
+
+        return "\n".join(lines)
+
+
+class Gauge(Counter):
+    def set(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._label_by_value[key] = value
+
+    def to_prometheus(self) -> str:
+        return super().to_prometheus().replace(
+            f"# TYPE {self.name} counter", f"# TYPE {self.name} gauge"
+        )
+
+
+HANDLER_DURATION = Histogram(
+    "bot_handler_duration_seconds",
+    "Время выполнения обработчика",
+    BUCKETS_SECONDS,
+)
+HANDLER_DB_QUERIES = Histogram(
+    "bot_handler_db_queries",
+    "Количество запросов к базе за обработку одного обновления",
+    BUCKETS_QUERIES,
+)
+CHART_RENDER_DURATION = Histogram(
+    "bot_chart_render_seconds",
+    "Время рисования графика",
+    BUCKETS_SECONDS,
+)
+CHART_UPLOAD_DURATION = Histogram(
+    "bot_chart_upload_seconds",
+    "Время отправки графика в Telegram",
+    BUCKETS_SECONDS,
+)
+
+CHART_REQUESTS = Counter(
+    "bot_chart_requests_total",
+    "Количество запросов графиков",
+)
+CHART_REQUESTS_COALESCED = Counter(
+    "bot_chart_requests_coalesced_total",
+    "Количество запросов графиков, дождавшихся уже выполняющегося рисования",
+)
+CHART_REQUESTS_SUPERSEDED = Counter(
+    "bot_chart_requests_superseded_total",
+    "Количество запросов графиков, отброшенных из-за более нового нажатия",
+)
+
+LANE_WAIT_DURATION = Histogram(
+    "bot_lane_wait_seconds",
+    "Время ожидания обработчика в очереди",
+    BUCKETS_SECONDS,
+)
+LANE_QUEUE_DEPTH = Gauge(
+    "bot_lane_queue_depth",
+    "Количество обработчиков, ожидающих в очереди",
+)
+LANE_REJECTED = Counter(
+    "bot_lane_rejected_total",
+    "Количество обработчиков, не попавших в переполненную очередь",
+)
+
+METRICS: list[Union[Histogram, Counter]] = [
+    HANDLER_DURATION,
+    HANDLER_DB_QUERIES,
+    CHART_RENDER_DURATION,
+    CHART_UPLOAD_DURATION,
+    CHART_REQUESTS,
+    CHART_REQUESTS_COALESCED,
+    CHART_REQUESTS_SUPERSEDED,
+    LANE_WAIT_DURATION,
+    LANE_QUEUE_DEPTH,
+    LANE_REJECTED,
+]
+
+
+def get_metrics_as_prometheus() -> str:
+    return "\n\n".join(metric.to_prometheus() for metric in METRICS) + "\n"
+
+
+def get_metrics_as_json() -> str:
+    return json.dumps(
+        [metric.to_dict() for metric in METRICS],
+        ensure_ascii=False,
+        indent=4,
+    )
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        match self.path:
+            case "/metrics":
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+                data = get_metrics_as_prometheus()
+            case "/metrics.json":
+                content_type = "application/json; charset=utf-8"
+                data = get_metrics_as_json()
+            case _:
+                self.send_error(404)
+                return
+
+        body = data.encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Запросы к метрикам не логируются
+        pass
+
+
+def run_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    with ThreadingHTTPServer((host, port), MetricsRequestHandler) as server:
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    HANDLER_DURATION.observe(0.3, handler="on_start")
+    HANDLER_DB_QUERIES.observe(2, handler="on_start")
+    with CHART_RENDER_DURATION.time():
+        time.sleep(0.01)
+
+    print(get_metrics_as_prometheus())
+    print(get_metrics_as_json())
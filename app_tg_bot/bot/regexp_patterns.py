@@ -14,23 +14,47 @@ PATTERN_REPLY_ADMIN_STATS = re.compile(
 COMMAND_ADMIN_STATS = "admin_stats"
 
 PATTERN_REPLY_GET_AS_TEXT = re.compile(r"^Последняя запись$", flags=re.IGNORECASE)
-PATTERN_INLINE_GET_BY_DATE = re.compile(r"^get_by_date=(.+)$")
+# NOTE: Данные inline-кнопок начинаются с кода обработчика и ":", см. router.py.
+#       Шаблоны *_LEGACY - старые форматы для кнопок в уже отправленных сообщениях
+PATTERN_INLINE_GET_BY_DATE = re.compile(r"^d:(.+)$")
+PATTERN_INLINE_GET_BY_DATE_LEGACY = re.compile(r"^get_by_date=(.+)$")
 
 PATTERN_REPLY_SELECT_DATE = re.compile(r"^Выбрать дату", flags=re.IGNORECASE)
-PATTERN_INLINE_SELECT_DATE = re.compile(r".+;\d+;\d+;\d+")  # NOTE: Формат telegramcalendar.py
+# NOTE: Формат telegramcalendar.py
+PATTERN_INLINE_SELECT_DATE = re.compile(r"^k:(.+;\d+;\d+;\d+)$")
+PATTERN_INLINE_SELECT_DATE_LEGACY = re.compile(r"(.+;\d+;\d+;\d+)")
 
 PATTERN_REPLY_GET_LAST_7_AS_CHART = re.compile(r"^График за 7$", flags=re.IGNORECASE)
 PATTERN_REPLY_GET_LAST_31_AS_CHART = re.compile(r"^График за 31$", flags=re.IGNORECASE)
 PATTERN_REPLY_GET_ALL_AS_CHART = re.compile(
     r"^График за все данные$", flags=re.IGNORECASE
 )
-PATTERN_INLINE_GET_AS_CHART = re.compile(r"^get_last_(.+)_as_chart=(.+)$")
+PATTERN_INLINE_GET_AS_CHART = re.compile(r"^c:(.+):(.+)$")
+# Вместо кода металла (см. CALLBACK_CODE_BY_METAL в common.py) в PATTERN_INLINE_GET_AS_CHART -
+# график сравнения всех металлов
+CALLBACK_ALL_METALS = "ALL"
+PATTERN_INLINE_GET_AS_CHART_LEGACY = re.compile(r"^get_last_(.+)_as_chart=(.+)$")
 
-PATTERN_INLINE_GET_CHART_METAL_BY_YEAR = re.compile(r"^get_chart metal=(.+) year=(.+)$")
+PATTERN_INLINE_GET_CHART_METAL_BY_YEAR = re.compile(r"^y:(.+):(.+)$")
+PATTERN_INLINE_GET_CHART_METAL_BY_YEAR_LEGACY = re.compile(r"^get_chart metal=(.+) year=(.+)$")
 
 PATTERN_REPLY_SUBSCRIBE = re.compile(r"^Подписаться$", flags=re.IGNORECASE)
 PATTERN_REPLY_UNSUBSCRIBE = re.compile(r"^Отписаться$", flags=re.IGNORECASE)
 
+PATTERN_REPLY_ALERTS = re.compile(r"^Оповещения$", flags=re.IGNORECASE)
+COMMAND_ALERTS = "alerts"
+COMMAND_ALERT = "alert"
+# Аргументы команды оповещения, например: "gold > 6000", "золото < 5000", "palladium 3%"
+PATTERN_ALERT_ARGS = re.compile(
+    r"^(\w+)\s*([<>])?\s*(\d+(?:[.,]\d+)?)\s*(%)?$", flags=re.IGNORECASE
+)
+PATTERN_INLINE_ALERT_DELETE = re.compile(r"^a:(.+)$")
+PATTERN_INLINE_ALERT_DELETE_LEGACY = re.compile(r"^alert_delete=(.+)$")
+
+COMMAND_STATS = "stats"
+# Аргументы команды статистики: год или две даты, например: "2021", "01/01/2021 31/03/2021"
+PATTERN_STATS_ARGS = re.compile(r"^(\d{4})$|^(\S+)\s+(\S+)$")
+
 CALLBACK_IGNORE = "IGNORE"
 
 
@@ -39,16 +63,20 @@ if __name__ == "__main__":
 
     assert (
         fill_string_pattern(PATTERN_INLINE_GET_BY_DATE, DT.date(2022, 4, 1))
+        == "d:2022-04-01"
+    )
+    assert (
+        fill_string_pattern(PATTERN_INLINE_GET_BY_DATE_LEGACY, DT.date(2022, 4, 1))
         == "get_by_date=2022-04-01"
     )
     assert fill_string_pattern(PATTERN_REPLY_GET_AS_TEXT) == "Последняя запись"
 
     assert (
         fill_string_pattern(PATTERN_INLINE_GET_AS_CHART, -1, "gold")
-        == "get_last_-1_as_chart=gold"
+        == "c:-1:gold"
     )
     assert (
-        fill_string_pattern(PATTERN_INLINE_GET_AS_CHART, 31, "gold")
+        fill_string_pattern(PATTERN_INLINE_GET_AS_CHART_LEGACY, 31, "gold")
         == "get_last_31_as_chart=gold"
     )
 
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import re
+
+from typing import Any, Callable, Iterable, Optional
+
+from telegram import Update
+from telegram.ext import CallbackContext, Dispatcher, Handler
+from telegram.ext.filters import BaseFilter
+
+
+# Разделитель между кодом обработчика и аргументами в данных inline-кнопок
+CALLBACK_SEPARATOR = ":"
+
+
+def get_callback_code(pattern: re.Pattern) -> str:
+    """
+    Код обработчика из шаблона данных inline-кнопки, например, "c" для "^c:(.+):(.+)$"
+    """
+
+    code, sep, _ = pattern.pattern.lstrip("^").partition(CALLBACK_SEPARATOR)
+    if not sep or not code:
+        raise ValueError(f"В шаблоне {pattern.pattern!r} нет кода обработчика")
+    return code
+
+
+class _RouterHandler(Handler):
+    """
+    Обработчик, который сам выбирает функцию для обновления. check_update возвращает
+    пару (функция, совпадение с шаблоном), а совпадение, как и у обработчиков
+    с регулярными выражениями, доступно в context.match
+    """
+
+    def __init__(self):
+        super().__init__(callback=self._not_routed)
+
+    @staticmethod
+    def _not_routed(update: Update, context: CallbackContext):
+        raise RuntimeError("Обновление должно обрабатываться через handle_update")
+
+    def collect_additional_context(
+        self,
+        context: CallbackContext,
+        update: Update,
+        dispatcher: Dispatcher,
+        check_result: tuple[Callable, Optional[re.Match]],
+    ):
+        _, match = check_result
+        context.matches = [match] if match else None
+
+    def handle_update(
+        self,
+        update: Update,
+        dispatcher: Dispatcher,
+        check_result: tuple[Callable, Optional[re.Match]],
+        context: CallbackContext = None,
+    ) -> Any:
+        callback, _ = check_result
+        self.collect_additional_context(context, update, dispatcher, check_result)
+        return callback(update, context)
+
+
+class CallbackQueryRouter(_RouterHandler):
+    """
+    Маршрутизация inline-кнопок по коду в начале данных (до первого ":") через словарь,
+    поэтому стоимость выбора обработчика не зависит от их количества.
+    Данные старого формата, без кода, проверяются по списку шаблонов, но только если
+    код не найден
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self._code_by_route: dict[str, tuple[re.Pattern, Callable]] = dict()
+        self._legacy_routes: list[tuple[re.Pattern, Callable]] = []
+
+    def add(self, pattern: re.Pattern, callback: Callable, legacy_pattern: re.Pattern = None):
+        """
+        Шаблон старого формата должен содержать те же группы, что и основной шаблон
+        """
+
+        code = get_callback_code(pattern)
+        if code in self._code_by_route:
+            raise ValueError(f"Код обработчика {code!r} уже используется")
+
+        self._code_by_route[code] = pattern, callback
+        if legacy_pattern:
+            self._legacy_routes.append((legacy_pattern, callback))
+
+    def check_update(self, update: object) -> Optional[tuple[Callable, re.Match]]:
+        if not isinstance(update, Update) or not update.callback_query:
+            return None
+
+        data = update.callback_query.data
+        if not data:
+            return None
+
+        code, sep, _ = data.partition(CALLBACK_SEPARATOR)
+        route = self._code_by_route.get(code) if sep else None
+        if route:
+            pattern, callback = route
+            match = pattern.match(data)
+            return (callback, match) if match else None
+
+        for pattern, callback in self._legacy_routes:
+            match = pattern.match(data)
+            if match:
+                return callback, match
+
+        return None
+
+
+class TextRouter(_RouterHandler):
+    """
+    Маршрутизация текстовых сообщений (кнопок обычной клавиатуры) по тексту через словарь.
+    Текст сравнивается без учета регистра. Если текста нет в словаре, то, как и
+    у Filters.regex, шаблоны ищутся в тексте по порядку добавления, например,
+    "Выбрать дату" с дополнительными символами. Если обработчик не найден или сообщение
+    не прошло его фильтр, то вызывается default_callback
+    """
+
+    def __init__(self, default_callback: Callable = None):
+        super().__init__()
+
+        self.default_callback = default_callback
+        self._text_by_route: dict[str, tuple[re.Pattern, Callable, Optional[BaseFilter]]] = dict()
+        self._routes: list[tuple[re.Pattern, Callable, Optional[BaseFilter]]] = []
+
+    def add(
+        self,
+        pattern: re.Pattern,
+        callback: Callable,
+        texts: Iterable[str],
+        filters: BaseFilter = None,
+    ):
+        for text in texts:
+            if not pattern.match(text):
+                raise ValueError(f"Текст {text!r} не подходит под шаблон {pattern.pattern!r}")
+
+            self._text_by_route[text.lower()] = pattern, callback, filters
+
+        self._routes.append((pattern, callback, filters))
+
+    def check_update(self, update: object) -> Optional[tuple[Callable, Optional[re.Match]]]:
+        # Как и у MessageHandler, учитываются и отредактированные сообщения
+        if not isinstance(update, Update) or update.callback_query or not update.effective_message:
+            return None
+
+        text = update.effective_message.text
+        if not text:
+            return None
+
+        route = self._text_by_route.get(text.lower())
+        if route:
+            pattern, callback, filters = route
+            if not filters or filters(update):
+                return callback, pattern.match(text)
+
+        for pattern, callback, filters in self._routes:
+            match = pattern.search(text)
+            if match and (not filters or filters(update)):
+                return callback, match
+
+        if self.default_callback:
+            return self.default_callback, None
+
+        return None
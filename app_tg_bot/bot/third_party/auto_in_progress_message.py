@@ -6,10 +6,12 @@ __author__ = 'ipetrash'
 
 import enum
 import functools
+import heapq
 import threading
 import time
 
-from itertools import cycle
+from itertools import count, cycle
+from typing import Optional
 
 # pip install python-telegram-bot
 from telegram import Update, ReplyMarkup, Message, ParseMode
@@ -49,51 +51,65 @@ class ProgressValue(enum.Enum):
         )
 
 
-class InfinityProgressIndicatorThread(threading.Thread):
+class _ProgressItem:
     def __init__(
             self,
-            text_fmt: str,
-            message: Message,
-            progress_value: ProgressValue = ProgressValue.POINTS,
+            text: str,
+            update: Update,
+            progress_value: ProgressValue = None,
             parse_mode: ParseMode = None,
             reply_markup: ReplyMarkup = None,
+            quote: bool = True,
             skip_progress: int = 1,
-            init_seconds: int = 0,
-            *args,
-            **kwargs
+            **kwargs,
     ):
-        super().__init__(*args, **kwargs)
-
-        self.daemon = True
+        self.text = text
+        self.update = update
+        self.progress_value = progress_value
+        self.parse_mode = parse_mode
+        self.reply_markup = reply_markup
+        self.quote = quote
+        self.kwargs: dict = kwargs
 
-        self._stop = threading.Event()
-        self._progress_bar = cycle(progress_value.value)
+        self.chat_id: int = update.effective_chat.id if update.effective_chat else None
+        self.message: Message = None
 
-        for _ in range(skip_progress):
-            next(self._progress_bar)
+        self._progress_bar = cycle(progress_value.value) if progress_value else None
+        if self._progress_bar:
+            for _ in range(skip_progress):
+                next(self._progress_bar)
 
-        self.text_fmt = text_fmt
-        self.message = message
-        self.parse_mode = parse_mode
-        self.reply_markup = reply_markup
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._post_time: float = None
 
-        self._seconds: int = init_seconds
-        self.init_seconds: int = init_seconds
+    def post(self):
+        text = self.text
+        if self.progress_value:
+            text = self.progress_value.get_init_text(self.text)
 
-    def run(self):
-        self._seconds = self.init_seconds
+        with self._lock:
+            if self._stopped:
+                return
 
-        while True:
-            time.sleep(1)
-            if self.is_stopped():
-                break
+            self.message = self.update.effective_message.reply_text(
+                text=text,
+                parse_mode=self.parse_mode,
+                reply_markup=self.reply_markup,
+                quote=self.quote,
+                **self.kwargs,
+            )
+            self._post_time = time.monotonic()
 
-            self._seconds += 1
+    def edit(self):
+        with self._lock:
+            if self._stopped or not self.message:
+                return
 
             text = ProgressValue.get_text(
-                text_fmt=self.text_fmt,
+                text_fmt=self.text,
                 value=next(self._progress_bar),
-                seconds=self._seconds,
+                seconds=int(time.monotonic() - self._post_time),
             )
 
             try:
@@ -105,11 +121,133 @@ class InfinityProgressIndicatorThread(threading.Thread):
             except BadRequest:
                 pass
 
+    def has_progress(self) -> bool:
+        return self._progress_bar is not None
+
+    def is_posted(self) -> bool:
+        return self.message is not None
+
     def stop(self):
-        self._stop.set()
+        with self._lock:
+            self._stopped = True
+            message = self.message
+
+        if message:
+            message.delete()
 
     def is_stopped(self) -> bool:
-        return self._stop.is_set()
+        return self._stopped
+
+
+class ProgressTicker(threading.Thread):
+    """
+    Один поток на все сообщения о прогрессе: отложенная отправка сообщений и их
+    периодическое изменение с учетом ограничений Telegram на частоту запросов
+    """
+
+    def __init__(
+            self,
+            interval: float = 1.0,
+            chat_interval: float = 1.0,
+            global_interval: float = 1 / 30,
+    ):
+        super().__init__(daemon=True)
+
+        # Пауза между изменениями одного сообщения, одного чата и между любыми изменениями
+        self.interval = interval
+        self.chat_interval = chat_interval
+        self.global_interval = global_interval
+
+        self._heap: list[tuple[float, int, _ProgressItem]] = []
+        self._counter = count()
+        self._condition = threading.Condition()
+
+        self._chat_by_last_edit: dict[int, float] = dict()
+        self._last_edit: float = float('-inf')
+
+    def add(self, item: _ProgressItem, delay: float):
+        with self._condition:
+            heapq.heappush(
+                self._heap, (time.monotonic() + delay, next(self._counter), item)
+            )
+            self._condition.notify()
+
+    def _get_next_item(self) -> _ProgressItem:
+        with self._condition:
+            while True:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+
+                timeout = self._heap[0][0] - time.monotonic()
+                if timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
+
+                return heapq.heappop(self._heap)[2]
+
+    def _process(self, item: _ProgressItem) -> Optional[float]:
+        """
+        Возвращает через сколько секунд нужно снова обработать элемент
+        или None, если больше не нужно
+        """
+
+        if not item.is_posted():
+            item.post()
+            return self.interval if item.has_progress() else None
+
+        now = time.monotonic()
+        wait = max(
+            self._chat_by_last_edit.get(item.chat_id, float('-inf')) + self.chat_interval - now,
+            self._last_edit + self.global_interval - now,
+        )
+        if wait > 0:
+            return wait
+
+        item.edit()
+
+        self._last_edit = now
+        self._chat_by_last_edit[item.chat_id] = now
+        if len(self._chat_by_last_edit) > 1000:
+            self._chat_by_last_edit = {
+                chat_id: last_edit
+                for chat_id, last_edit in self._chat_by_last_edit.items()
+                if last_edit + self.chat_interval > now
+            }
+
+        return self.interval
+
+    def _handle(self, item: _ProgressItem):
+        # Завершенные элементы просто выбрасываются из очереди
+        if item.is_stopped():
+            return
+
+        try:
+            delay = self._process(item)
+        except Exception:
+            delay = None
+
+        if delay is not None and not item.is_stopped():
+            self.add(item, delay)
+
+    def run(self):
+        while True:
+            self._handle(self._get_next_item())
+
+
+_TICKER: ProgressTicker = None
+_TICKER_LOCK = threading.Lock()
+
+
+def get_ticker() -> ProgressTicker:
+    global _TICKER
+
+    with _TICKER_LOCK:
+        if not _TICKER:
+            _TICKER = ProgressTicker()
+            _TICKER.start()
+
+        return _TICKER
 
 
 class show_temp_message:
@@ -122,6 +260,7 @@ class show_temp_message:
             reply_markup: ReplyMarkup = None,
             quote: bool = True,
             progress_value: ProgressValue = None,
+            show_delay: float = 0.0,
             **kwargs,
     ):
         self.text = text
@@ -131,42 +270,42 @@ class show_temp_message:
         self.reply_markup = reply_markup
         self.quote = quote
         self.kwargs: dict = kwargs
-        self.message: Message = None
 
         self.progress_value = progress_value
-        self.thread_progress: InfinityProgressIndicatorThread = None
 
-    def __enter__(self):
-        text = self.text
-        if self.progress_value:
-            text = self.progress_value.get_init_text(self.text)
+        # Если операция завершится быстрее, то сообщение не будет отправлено
+        self.show_delay = show_delay
+
+        self.item: _ProgressItem = None
 
-        self.message = self.update.effective_message.reply_text(
-            text=text,
+    @property
+    def message(self) -> Optional[Message]:
+        return self.item.message if self.item else None
+
+    def __enter__(self):
+        self.item = _ProgressItem(
+            text=self.text,
+            update=self.update,
+            progress_value=self.progress_value,
             parse_mode=self.parse_mode,
             reply_markup=self.reply_markup,
             quote=self.quote,
             **self.kwargs,
         )
 
-        if self.progress_value:
-            self.thread_progress = InfinityProgressIndicatorThread(
-                text_fmt=self.text,
-                message=self.message,
-                progress_value=self.progress_value,
-                parse_mode=self.parse_mode,
-                reply_markup=self.reply_markup,
-            )
-            self.thread_progress.start()
+        ticker = get_ticker()
+        if self.show_delay > 0:
+            ticker.add(self.item, self.show_delay)
+        else:
+            self.item.post()
+            if self.item.has_progress():
+                ticker.add(self.item, ticker.interval)
 
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if self.thread_progress:
-            self.thread_progress.stop()
-
-        if self.message:
-            self.message.delete()
+        if self.item:
+            self.item.stop()
 
 
 def show_temp_message_decorator(
@@ -174,6 +313,7 @@ def show_temp_message_decorator(
         parse_mode: ParseMode = None,
         reply_markup: ReplyMarkup = None,
         progress_value: ProgressValue = None,
+        show_delay: float = 0.0,
         **kwargs,
 ):
     def actual_decorator(func):
@@ -186,6 +326,7 @@ def show_temp_message_decorator(
                 reply_markup=reply_markup,
                 parse_mode=parse_mode,
                 progress_value=progress_value,
+                show_delay=show_delay,
                 **kwargs,
             ):
                 return func(update, context)
@@ -12,20 +12,25 @@ from telegram import InlineKeyboardButton, InlineKeyboardMarkup,ReplyKeyboardRem
 import datetime
 import calendar
 
+# Prefix of the callback data for the bot router, data without the prefix is also supported
+CALLBACK_PREFIX = "k:"
+
 def create_callback_data(action,year,month,day):
     """ Create the callback data associated to each button"""
-    return ";".join([action,str(year),str(month),str(day)])
+    return CALLBACK_PREFIX + ";".join([action,str(year),str(month),str(day)])
 
 def separate_callback_data(data):
     """ Separate the callback data"""
-    return data.split(";")
+    return data.removeprefix(CALLBACK_PREFIX).split(";")
 
 
-def create_calendar(year=None,month=None):
+def create_calendar(year=None,month=None,available_days=None):
     """
     Create an inline keyboard with the provided year and month
     :param int year: Year to use in the calendar, if None the current year is used.
     :param int month: Month to use in the calendar, if None the current month is used.
+    :param available_days: Days of the month that can be selected, if None all days are available.
+                Other days are shown as "·" and are ignored on press.
     :return: Returns the InlineKeyboardMarkup object with the calendar.
     """
     now = datetime.datetime.now()
@@ -49,6 +54,8 @@ def create_calendar(year=None,month=None):
         for day in week:
             if(day==0):
                 row.append(InlineKeyboardButton(" ",callback_data=data_ignore))
+            elif available_days is not None and day not in available_days:
+                row.append(InlineKeyboardButton("·",callback_data=data_ignore))
             else:
                 row.append(InlineKeyboardButton(str(day),callback_data=create_callback_data("DAY",year,month,day)))
         keyboard.append(row)
@@ -62,12 +69,14 @@ def create_calendar(year=None,month=None):
     return InlineKeyboardMarkup(keyboard)
 
 
-def process_calendar_selection(bot,update):
+def process_calendar_selection(bot,update,get_available_days=None):
     """
     Process the callback_query. This method generates a new calendar if forward or
     backward is pressed. This method should be called inside a CallbackQueryHandler.
     :param telegram.Bot bot: The bot, as provided by the CallbackQueryHandler
     :param telegram.Update update: The update, as provided by the CallbackQueryHandler
+    :param get_available_days: Function (year, month) -> available days for the new calendar,
+                if None all days are available.
     :return: Returns a tuple (Boolean,datetime.datetime), indicating if a date is selected
                 and returning the date if so.
     """
@@ -88,13 +97,15 @@ def process_calendar_selection(bot,update):
         bot.edit_message_text(text=query.message.text,
             chat_id=query.message.chat_id,
             message_id=query.message.message_id,
-            reply_markup=create_calendar(int(pre.year),int(pre.month)))
+            reply_markup=create_calendar(int(pre.year),int(pre.month),
+                get_available_days(pre.year,pre.month) if get_available_days else None))
     elif action == "NEXT-MONTH":
         ne = curr + datetime.timedelta(days=31)
         bot.edit_message_text(text=query.message.text,
             chat_id=query.message.chat_id,
             message_id=query.message.message_id,
-            reply_markup=create_calendar(int(ne.year),int(ne.month)))
+            reply_markup=create_calendar(int(ne.year),int(ne.month),
+                get_available_days(ne.year,ne.month) if get_available_days else None))
     else:
         bot.answer_callback_query(callback_query_id= query.id,text="Something went wrong!")
         # UNKNOWN
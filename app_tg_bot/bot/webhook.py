@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import hmac
+import json
+import re
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+from app_tg_bot.config import (
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET_TOKEN,
+)
+
+
+# SOURCE: https://core.telegram.org/bots/api#setwebhook
+HEADER_SECRET_TOKEN = "X-Telegram-Bot-Api-Secret-Token"
+
+# Допустимый секретный токен по документации setWebhook
+PATTERN_SECRET_TOKEN = re.compile(r"^[A-Za-z0-9_-]{1,256}$")
+
+
+def is_valid_secret_token(secret_token: str) -> bool:
+    return bool(secret_token and PATTERN_SECRET_TOKEN.match(secret_token))
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    server: "WebhookServer"
+
+    def _send(self, code: int):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        if self.path != self.server.url_path:
+            self._send(404)
+            return
+
+        # Проверка, что запрос пришел от Telegram
+        secret_token = self.headers.get(HEADER_SECRET_TOKEN, "")
+        if not hmac.compare_digest(secret_token.encode(), self.server.secret_token.encode()):
+            self._send(403)
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            data = json.loads(self.rfile.read(length))
+            update = Update.de_json(data, self.server.dispatcher.bot)
+        except Exception:
+            self._send(400)
+            return
+
+        self.server.dispatcher.update_queue.put(update)
+        self._send(200)
+
+    def log_message(self, format, *args):
+        # Каждое обновление и так логируется в обработчиках
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        listen: str = WEBHOOK_LISTEN,
+        port: int = WEBHOOK_PORT,
+        url_path: str = WEBHOOK_PATH,
+        secret_token: str = WEBHOOK_SECRET_TOKEN,
+    ):
+        # Без секрета любой, кто знает адрес, сможет отправлять боту обновления
+        if not is_valid_secret_token(secret_token):
+            raise ValueError(
+                "Для режима webhook нужен секретный токен: 1-256 символов A-Z, a-z, 0-9, _ и -"
+            )
+
+        super().__init__((listen, port), WebhookRequestHandler)
+
+        self.dispatcher = dispatcher
+        self.url_path = url_path
+        self.secret_token = secret_token
+
+    def start_dispatcher(self):
+        if self.dispatcher.running:
+            return
+
+        ready = threading.Event()
+        threading.Thread(
+            target=self.dispatcher.start,
+            kwargs=dict(ready=ready),
+            name="Dispatcher",
+            daemon=True,
+        ).start()
+        ready.wait()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.dispatcher.stop()
@@ -35,3 +35,51 @@ USER_NAME_ADMINS = [
 ERROR_TEXT = "Возникла какая-то проблема. Попробуйте повторить запрос или попробовать чуть позже..."
 
 MAX_MESSAGE_LENGTH = 4096
+
+MAX_PRICE_ALERTS_PER_USER = 10
+
+# Формат графиков, название из utils.draw_plot.ChartPresetEnum: DEFAULT, TELEGRAM, WEB или WEB_WEBP
+CHART_PRESET_NAME: str = os.environ.get("CHART_PRESET", "TELEGRAM")
+
+# Рассылка подписчикам о рекордных значениях металлов, по умолчанию выключена
+RECORDS_BROADCAST: bool = os.environ.get("RECORDS_BROADCAST", "0") != "0"
+
+# Названия видов рекордов из RecordKindEnum, о которых будет рассылка. Рекорды
+# с начала года случаются часто, поэтому по умолчанию рассылаются только значимые
+RECORDS_BROADCAST_KIND_NAMES: list[str] = [
+    name.strip().upper()
+    for name in os.environ.get("RECORDS_BROADCAST_KINDS", "ALL_TIME,WEEKS_52").split(",")
+    if name.strip()
+]
+
+# Адрес, на котором доступны метрики бота (/metrics и /metrics.json)
+METRICS_HOST: str = "127.0.0.1"
+METRICS_PORT: int = 12001
+
+# Количество потоков и размер очереди для каждой группы обработчиков, задаются
+# независимо от количества процессоров. Можно переопределить через переменные окружения
+LANE_TEXT_WORKERS: int = int(os.environ.get("LANE_TEXT_WORKERS", 4))
+LANE_TEXT_QUEUE_SIZE: int = int(os.environ.get("LANE_TEXT_QUEUE_SIZE", 200))
+LANE_CHART_WORKERS: int = int(os.environ.get("LANE_CHART_WORKERS", 2))
+LANE_CHART_QUEUE_SIZE: int = int(os.environ.get("LANE_CHART_QUEUE_SIZE", 50))
+LANE_ADMIN_WORKERS: int = int(os.environ.get("LANE_ADMIN_WORKERS", 1))
+LANE_ADMIN_QUEUE_SIZE: int = int(os.environ.get("LANE_ADMIN_QUEUE_SIZE", 10))
+
+BUSY_TEXT = "Сейчас слишком много запросов. Попробуйте повторить чуть позже..."
+
+# Обработчики выполняются в своих очередях (см. bot/lanes.py), поэтому пулу потоков
+# диспетчера остаются только обработчики с run_async, ему достаточно пары потоков
+DISPATCHER_WORKERS: int = int(os.environ.get("DISPATCHER_WORKERS", 2))
+
+# Режим webhook: если задан публичный адрес, то обновления принимаются встроенным
+# HTTP-сервером, иначе используется long polling
+WEBHOOK_URL: str = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_LISTEN: str = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT: int = int(os.environ.get("WEBHOOK_PORT", 12002))
+WEBHOOK_PATH: str = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET_TOKEN: str = os.environ.get("WEBHOOK_SECRET_TOKEN", "")
+
+# Telegram передает секрет в заголовке каждого запроса, без него webhook не проверить
+if WEBHOOK_URL and not WEBHOOK_SECRET_TOKEN:
+    print("Для режима webhook нужно в переменную окружения WEBHOOK_SECRET_TOKEN добавить секретный токен")
+    sys.exit()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+"""
+Локальная замена Telegram Bot API для нагрузочного тестирования бота.
+Поддерживает методы, которые использует бот, с настраиваемой задержкой
+ответов и ошибками 429 (Too Many Requests) с retry_after.
+"""
+
+
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+
+from collections import Counter
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Any, Optional
+
+DIR = Path(__file__).resolve().parent
+sys.path.append(str(DIR.parent.parent))
+
+from app_tg_bot.fake_telegram.updates import get_chat
+
+
+BOT_USER = {
+    "id": 123456,
+    "is_bot": True,
+    "first_name": "FakeBot",
+    "username": "fake_bot",
+}
+
+
+def parse_params(content_type: str, body: bytes) -> dict[str, Any]:
+    if not body:
+        return dict()
+
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser().parsebytes(
+            b"Content-Type: " + content_type.encode("utf-8") + b"\r\n\r\n" + body
+        )
+
+        params = dict()
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename():  # Содержимое файлов не нужно
+                params[name] = f"<file {part.get_filename()}>"
+            else:
+                params[name] = part.get_payload(decode=True).decode("utf-8")
+
+        return params
+
+    return dict()
+
+
+class FakeBotApiRequestHandler(BaseHTTPRequestHandler):
+    server: "FakeBotApiServer"
+
+    def _send_json(self, code: int, data: dict):
+        body = json.dumps(data).encode("utf-8")
+
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        # Формат: /bot<token>/<method>
+        method = self.path.rsplit("/", maxsplit=1)[-1]
+
+        length = int(self.headers.get("Content-Length", 0))
+        params = parse_params(
+            self.headers.get("Content-Type", ""), self.rfile.read(length)
+        )
+
+        code, data = self.server.process(method, params)
+        self._send_json(code, data)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeBotApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # Методы, которые не считаются ответами бота на обновления
+    SERVICE_METHODS = {"getMe", "getUpdates", "deleteWebhook", "setWebhook"}
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency_secs: float = 0.0,
+        rate_429: float = 0.0,
+        retry_after: int = 1,
+    ):
+        super().__init__((host, port), FakeBotApiRequestHandler)
+
+        # Задержка ответа на методы бота и доля ответов с ошибкой 429
+        self.latency_secs = latency_secs
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+
+        self.method_by_count: Counter[str] = Counter()
+        self.count_429: int = 0
+        self._lock = threading.Lock()
+
+        self._updates: list[dict] = []
+        self._updates_condition = threading.Condition()
+        self._message_ids = itertools.count(1_000_000)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address
+        return f"http://{host}:{port}/bot"
+
+    def start(self) -> "FakeBotApiServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def add_update(self, update: dict):
+        with self._updates_condition:
+            self._updates.append(update)
+            self._updates_condition.notify_all()
+
+    def get_api_calls(self) -> int:
+        with self._lock:
+            return sum(
+                count
+                for method, count in self.method_by_count.items()
+                if method not in self.SERVICE_METHODS
+            )
+
+    def _get_updates(self, params: dict) -> list[dict]:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+
+        with self._updates_condition:
+            # Подтвержденные обновления больше не нужны
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            if not self._updates and timeout:
+                self._updates_condition.wait(timeout)
+
+            return self._updates[:limit]
+
+    def _get_message(self, params: dict, **kwargs) -> dict:
+        chat_id = int(params.get("chat_id") or 0)
+        message = {
+            "message_id": int(params.get("message_id") or next(self._message_ids)),
+            "date": int(time.time()),
+            "chat": get_chat(chat_id),
+            "from": BOT_USER,
+        }
+        message.update(kwargs)
+
+        reply_markup: Optional[str | dict] = params.get("reply_markup")
+        if isinstance(reply_markup, str):
+            reply_markup = json.loads(reply_markup)
+        if reply_markup and "inline_keyboard" in reply_markup:
+            message["reply_markup"] = reply_markup
+
+        return message
+
+    def process(self, method: str, params: dict) -> tuple[int, dict]:
+        with self._lock:
+            self.method_by_count[method] += 1
+
+        if method not in self.SERVICE_METHODS:
+            if self.latency_secs:
+                time.sleep(self.latency_secs)
+
+            if self.rate_429 and random.random() < self.rate_429:
+                with self._lock:
+                    self.count_429 += 1
+
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+
+        photo = [{"file_id": "photo", "file_unique_id": "photo", "width": 640, "height": 480}]
+
+        match method:
+            case "getMe":
+                result = BOT_USER
+            case "getUpdates":
+                result = self._get_updates(params)
+            case "deleteWebhook" | "setWebhook" | "answerCallbackQuery" | "deleteMessage":
+                result = True
+            case "sendMessage" | "editMessageText":
+                result = self._get_message(params, text=params.get("text", ""))
+            case "sendPhoto" | "editMessageMedia":
+                result = self._get_message(params, photo=photo)
+            case _:
+                return 404, {
+                    "ok": False,
+                    "error_code": 404,
+                    "description": f"Not Found: method {method!r} not supported",
+                }
+
+        return 200, {"ok": True, "result": result}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=12003)
+    parser.add_argument("--latency", type=float, default=0.05, help="Задержка ответа, секунды")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Доля ответов с ошибкой 429")
+    args = parser.parse_args()
+
+    server = FakeBotApiServer(
+        port=args.port, latency_secs=args.latency, rate_429=args.rate_429
+    )
+    print(f"Base url: {server.base_url}")
+    server.serve_forever()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+"""
+Нагрузочное тестирование бота на локальной замене Telegram Bot API.
+
+Бот получает обновления через getUpdates от FakeBotApiServer, обработчики
+настраиваются через commands.setup, после чего выполняется рассылка
+через send_notifications. Подписки хранятся во временной базе в памяти.
+"""
+
+
+import argparse
+import datetime as DT
+import logging
+import os
+import random
+import sys
+import time
+
+from pathlib import Path
+
+DIR = Path(__file__).resolve().parent
+sys.path.append(str(DIR.parent.parent))
+
+# Токен в правильном формате, запросы к настоящему API не выполняются
+FAKE_TOKEN = "123456:local-fake-token"
+os.environ.setdefault("TOKEN", FAKE_TOKEN)
+
+from peewee import SqliteDatabase
+from telegram import Bot
+from telegram.ext import Updater
+
+from app_tg_bot.bot import commands, metrics
+from app_tg_bot.bot.backgrounds_tasks.run_check_subscriptions import send_notifications
+from app_tg_bot.bot.common import CALLBACK_CODE_BY_METAL, log
+from app_tg_bot.config import DISPATCHER_WORKERS
+from app_tg_bot.bot.regexp_patterns import (
+    PATTERN_REPLY_GET_AS_TEXT,
+    PATTERN_INLINE_GET_BY_DATE,
+    PATTERN_REPLY_GET_LAST_7_AS_CHART,
+    PATTERN_REPLY_GET_LAST_31_AS_CHART,
+    PATTERN_REPLY_GET_ALL_AS_CHART,
+    PATTERN_INLINE_GET_AS_CHART,
+    PATTERN_INLINE_GET_CHART_METAL_BY_YEAR,
+    PATTERN_REPLY_SUBSCRIBE,
+    PATTERN_REPLY_UNSUBSCRIBE,
+)
+from app_tg_bot.bot.third_party.regexp import fill_string_pattern
+from app_tg_bot.fake_telegram.bot_api_server import FakeBotApiServer
+from app_tg_bot.fake_telegram.updates import get_message_update, get_callback_query_update
+from db import MetalRate, MetalRateYear, Subscription, Settings
+from root_common import MetalEnum
+
+
+def get_update_factories() -> list[tuple[int, callable]]:
+    """
+    Типичный набор обновлений: вес и функция, создающая обновление для пользователя
+    """
+
+    # Как и в календаре, выбираются только даты, для которых есть курсы
+    dates: list[DT.date] = MetalRate.get_last_dates(60)
+    years: list[int] = MetalRateYear.get_years()
+
+    def get_random_date() -> DT.date:
+        return random.choice(dates)
+
+    def get_random_metal_code() -> str:
+        return CALLBACK_CODE_BY_METAL[random.choice(list(MetalEnum))]
+
+    def text(pattern):
+        return lambda user_id: get_message_update(user_id, fill_string_pattern(pattern))
+
+    def callback(get_data):
+        return lambda user_id: get_callback_query_update(user_id, get_data())
+
+    return [
+        (5, lambda user_id: get_message_update(user_id, "/start")),
+        (25, text(PATTERN_REPLY_GET_AS_TEXT)),
+        (15, callback(lambda: fill_string_pattern(PATTERN_INLINE_GET_BY_DATE, get_random_date()))),
+        (12, text(PATTERN_REPLY_GET_LAST_7_AS_CHART)),
+        (8, text(PATTERN_REPLY_GET_LAST_31_AS_CHART)),
+        (3, text(PATTERN_REPLY_GET_ALL_AS_CHART)),
+        (
+            12,
+            callback(
+                lambda: fill_string_pattern(
+                    PATTERN_INLINE_GET_AS_CHART,
+                    random.choice([7, 31]),
+                    get_random_metal_code(),
+                )
+            ),
+        ),
+        (
+            5,
+            callback(
+                lambda: fill_string_pattern(
+                    PATTERN_INLINE_GET_CHART_METAL_BY_YEAR,
+                    get_random_metal_code(),
+                    random.choice(years),
+                )
+            ),
+        ),
+        (10, text(PATTERN_REPLY_SUBSCRIBE)),
+        (5, text(PATTERN_REPLY_UNSUBSCRIBE)),
+    ]
+
+
+def get_processed_count() -> int:
+    # Обработчики, отработавшие через log_func, и не попавшие в очередь
+    return metrics.HANDLER_DURATION.get_count() + metrics.LANE_REJECTED.get_total()
+
+
+def print_percentiles(title: str, histogram: metrics.Histogram):
+    print(
+        f"{title}: "
+        + ", ".join(
+            f"p{int(q * 100)}={histogram.get_quantile(q) * 1000:.1f}ms"
+            for q in (0.5, 0.95, 0.99)
+        )
+    )
+
+
+def run(
+    count: int,
+    users: int,
+    rate: float,
+    latency_secs: float,
+    rate_429: float,
+    subscribers: int,
+    broadcast_delay_secs: float,
+):
+    # Подписки и настройки во временной базе, курсы металлов - из основной.
+    # Общий кэш нужен, чтобы потоки обработчиков видели одну и ту же базу в памяти
+    models = [Subscription, Settings]
+    test_db = SqliteDatabase(
+        "file:load_test?mode=memory&cache=shared", uri=True, check_same_thread=False
+    )
+    test_db.bind(models, bind_refs=False, bind_backrefs=False)
+    test_db.connect()
+    test_db.create_tables(models)
+    Subscription.reset_active_user_ids()
+
+    server = FakeBotApiServer(latency_secs=latency_secs, rate_429=rate_429).start()
+    print(f"Fake Bot API: {server.base_url}")
+
+    bot = Bot(FAKE_TOKEN, base_url=server.base_url)
+    updater = Updater(bot=bot, workers=DISPATCHER_WORKERS)
+    commands.setup(updater.dispatcher)
+
+    factories = get_update_factories()
+    weights = [weight for weight, _ in factories]
+
+    updater.start_polling(poll_interval=0, timeout=1)
+
+    start_time = time.perf_counter()
+    for i in range(count):
+        user_id = 1000 + random.randrange(users)
+        _, factory = random.choices(factories, weights)[0]
+        server.add_update(factory(user_id))
+
+        if rate:
+            time.sleep(1 / rate)
+
+    while get_processed_count() < count and time.perf_counter() - start_time < 300:
+        time.sleep(0.05)
+
+    elapsed = time.perf_counter() - start_time
+    api_calls = server.get_api_calls()
+
+    print()
+    print(f"Updates: {count} ({get_processed_count()} processed), users: {users}")
+    print(f"Elapsed: {elapsed:.2f}s, throughput: {count / elapsed:.1f} updates/s")
+    print_percentiles("Handler latency", metrics.HANDLER_DURATION)
+    print_percentiles("Lane wait", metrics.LANE_WAIT_DURATION)
+    print_percentiles("Chart render", metrics.CHART_RENDER_DURATION)
+    print(f"API calls: {api_calls}, per update: {api_calls / count:.2f}")
+    print(f"API calls by method: {dict(server.method_by_count.most_common())}")
+    print(f"429 responses: {server.count_429}")
+    print(
+        f"Charts: requests={metrics.CHART_REQUESTS.get_total()}, "
+        f"coalesced={metrics.CHART_REQUESTS_COALESCED.get_total()}, "
+        f"superseded={metrics.CHART_REQUESTS_SUPERSEDED.get_total()}"
+    )
+    print(f"Lanes rejected: {metrics.LANE_REJECTED.get_total()}")
+
+    updater.stop()
+
+    # Рассылка
+    for i in range(subscribers):
+        Subscription.subscribe(100_000 + i)
+    Subscription.update(was_sending=False).execute()
+
+    api_calls = server.get_api_calls()
+    start_time = time.perf_counter()
+    sent = send_notifications(bot, delay_secs=broadcast_delay_secs)
+    elapsed = time.perf_counter() - start_time
+
+    print()
+    # Кроме созданных подписок есть оформленные во время теста
+    print(
+        f"Broadcast: sent {sent} of {Subscription.get_active_count()} in {elapsed:.2f}s, "
+        f"{sent / elapsed:.1f} messages/s"
+    )
+    print(f"Broadcast API calls: {server.get_api_calls() - api_calls}")
+
+    server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=500, help="Количество обновлений")
+    parser.add_argument("--users", type=int, default=50, help="Количество пользователей")
+    parser.add_argument("--rate", type=float, default=0, help="Обновлений в секунду, 0 - все сразу")
+    parser.add_argument("--latency", type=float, default=0.05, help="Задержка ответов API, секунды")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Доля ответов API с ошибкой 429")
+    parser.add_argument("--subscribers", type=int, default=200, help="Количество подписчиков для рассылки")
+    parser.add_argument(
+        "--broadcast-delay",
+        type=float,
+        default=0.0,
+        help="Пауза между сообщениями рассылки, в боте 0.4 секунды",
+    )
+    args = parser.parse_args()
+
+    # Логирование каждого обновления исказит результаты
+    log.setLevel(logging.WARNING)
+
+    run(
+        count=args.count,
+        users=args.users,
+        rate=args.rate,
+        latency_secs=args.latency,
+        rate_429=args.rate_429,
+        subscribers=args.subscribers,
+        broadcast_delay_secs=args.broadcast_delay,
+    )
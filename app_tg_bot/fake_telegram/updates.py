@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import itertools
+import time
+
+
+# Генераторы идентификаторов, как у Telegram - возрастающие числа
+_UPDATE_IDS = itertools.count(1)
+_MESSAGE_IDS = itertools.count(1)
+_CALLBACK_QUERY_IDS = itertools.count(1)
+
+
+def get_user(user_id: int) -> dict:
+    return {
+        "id": user_id,
+        "is_bot": False,
+        "first_name": f"User{user_id}",
+        "username": f"user_{user_id}",
+        "language_code": "ru",
+    }
+
+
+def get_chat(user_id: int) -> dict:
+    # Для приватных чатов chat_id равен user_id
+    return {
+        "id": user_id,
+        "type": "private",
+        "first_name": f"User{user_id}",
+        "username": f"user_{user_id}",
+    }
+
+
+def get_message(user_id: int, text: str, message_id: int = None, from_bot: bool = False) -> dict:
+    message = {
+        "message_id": message_id or next(_MESSAGE_IDS),
+        "date": int(time.time()),
+        "chat": get_chat(user_id),
+        "from": get_user(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        command = text.split()[0]
+        message["entities"] = [
+            {"type": "bot_command", "offset": 0, "length": len(command)}
+        ]
+    if from_bot:
+        message["from"] = {"id": 1, "is_bot": True, "first_name": "Bot", "username": "bot"}
+
+    return message
+
+
+def get_message_update(user_id: int, text: str) -> dict:
+    return {
+        "update_id": next(_UPDATE_IDS),
+        "message": get_message(user_id, text),
+    }
+
+
+def get_callback_query_update(
+    user_id: int,
+    data: str,
+    message_id: int = None,
+    message_text: str = "",
+) -> dict:
+    message = get_message(user_id, message_text, message_id=message_id, from_bot=True)
+
+    # Сообщения с inline-кнопками всегда содержат клавиатуру
+    message["reply_markup"] = {"inline_keyboard": []}
+
+    return {
+        "update_id": next(_UPDATE_IDS),
+        "callback_query": {
+            "id": str(next(_CALLBACK_QUERY_IDS)),
+            "from": get_user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": message,
+        },
+    }
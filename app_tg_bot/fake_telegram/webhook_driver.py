@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+"""
+Отправка синтетических обновлений на webhook бота, как это делает Telegram.
+
+Режимы:
+ * --url: обновления отправляются на уже запущенный webhook, считается время ответа на POST
+ * без --url: локально запускается webhook с диспетчером и пустым обработчиком,
+   дополнительно считается время от отправки обновления до его обработки
+"""
+
+
+import argparse
+import json
+import os
+import queue
+import statistics
+import sys
+import threading
+import time
+import urllib.request
+import warnings
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+DIR = Path(__file__).resolve().parent
+sys.path.append(str(DIR.parent.parent))
+
+# Токен в правильном формате, запросы к настоящему API не выполняются
+FAKE_TOKEN = "123456:local-fake-token"
+os.environ.setdefault("TOKEN", FAKE_TOKEN)
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, CallbackContext, TypeHandler
+
+from app_tg_bot.bot.webhook import WebhookServer, HEADER_SECRET_TOKEN
+from app_tg_bot.fake_telegram.updates import get_message_update
+
+
+def get_percentile(values: list[float], percent: int) -> float:
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def print_stats(title: str, values: list[float]):
+    print(
+        f"{title}: "
+        f"avg={statistics.mean(values) * 1000:.2f}ms, "
+        f"p50={get_percentile(values, 50) * 1000:.2f}ms, "
+        f"p95={get_percentile(values, 95) * 1000:.2f}ms, "
+        f"p99={get_percentile(values, 99) * 1000:.2f}ms"
+    )
+
+
+def post_update(url: str, data: dict, secret_token: str = "") -> int:
+    rq = urllib.request.Request(
+        url,
+        data=json.dumps(data).encode("utf-8"),
+        headers={
+            "Content-Type": "application/json",
+            HEADER_SECRET_TOKEN: secret_token,
+        },
+        method="POST",
+    )
+    with urllib.request.urlopen(rq) as rs:
+        return rs.status
+
+
+def run(
+    url: str,
+    count: int,
+    concurrency: int,
+    secret_token: str = "",
+    text: str = "/start",
+    update_id_by_processed: dict[int, float] = None,
+    processed_event: threading.Event = None,
+):
+    update_id_by_sent: dict[int, float] = dict()
+    post_times: list[float] = []
+
+    def send(i: int):
+        data = get_message_update(user_id=1000 + i % 100, text=text)
+
+        start_time = time.perf_counter()
+        update_id_by_sent[data["update_id"]] = start_time
+        post_update(url, data, secret_token)
+        post_times.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, range(count)))
+
+    if processed_event:
+        processed_event.wait(timeout=30)
+
+    elapsed = time.perf_counter() - start_time
+
+    print(f"Updates: {count}, concurrency: {concurrency}, elapsed: {elapsed:.2f}s")
+    print(f"Throughput: {count / elapsed:.1f} updates/s")
+    print_stats("POST", post_times)
+
+    if update_id_by_processed:
+        print_stats(
+            "End-to-end",
+            [
+                update_id_by_processed[update_id] - sent
+                for update_id, sent in update_id_by_sent.items()
+                if update_id in update_id_by_processed
+            ],
+        )
+
+
+def run_local(count: int, concurrency: int):
+    secret_token = "local-secret"
+
+    bot = Bot(FAKE_TOKEN)
+    # Без пула потоков диспетчера, иначе при запуске будет запрос getMe
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        dispatcher = Dispatcher(bot, queue.Queue(), workers=0)
+
+    update_id_by_processed: dict[int, float] = dict()
+    processed_event = threading.Event()
+
+    def on_update(update: Update, context: CallbackContext):
+        update_id_by_processed[update.update_id] = time.perf_counter()
+        if len(update_id_by_processed) >= count:
+            processed_event.set()
+
+    dispatcher.add_handler(TypeHandler(Update, on_update))
+
+    server = WebhookServer(
+        dispatcher,
+        listen="127.0.0.1",
+        port=0,  # Любой свободный порт
+        url_path="/webhook",
+        secret_token=secret_token,
+    )
+    server.start_dispatcher()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    host, port = server.server_address
+    url = f"http://{host}:{port}/webhook"
+
+    # Запрос без секрета должен отклоняться
+    try:
+        post_update(url, get_message_update(1, "/start"), secret_token="wrong")
+        raise Exception("Запрос с неправильным секретом не был отклонен!")
+    except urllib.error.HTTPError as e:
+        assert e.code == 403
+
+    try:
+        run(
+            url,
+            count,
+            concurrency,
+            secret_token=secret_token,
+            update_id_by_processed=update_id_by_processed,
+            processed_event=processed_event,
+        )
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", help="Адрес webhook, например http://127.0.0.1:12002/webhook")
+    parser.add_argument(
+        "--secret-token",
+        default=os.environ.get("WEBHOOK_SECRET_TOKEN", ""),
+        help="Секретный токен webhook, по умолчанию из WEBHOOK_SECRET_TOKEN",
+    )
+    parser.add_argument("--text", default="/start", help="Текст сообщений")
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.url:
+        if not args.secret_token:
+            parser.error("для --url нужен --secret-token, без него webhook отвечает 403")
+
+        run(args.url, args.count, args.concurrency, args.secret_token, args.text)
+    else:
+        run_local(args.count, args.concurrency)
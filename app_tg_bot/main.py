@@ -4,37 +4,67 @@
 __author__ = "ipetrash"
 
 
-import os
 import time
 
 # pip install python-telegram-bot
-from telegram.ext import Updater, Defaults
+from telegram.ext import Updater
 
 from bot import backgrounds_tasks, commands
 from bot.common import log
-from config import TOKEN
+from bot.lanes import LaneEnum
+from bot.webhook import WebhookServer
+from db import Subscription
+from config import (
+    TOKEN,
+    DISPATCHER_WORKERS,
+    WEBHOOK_URL,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET_TOKEN,
+)
 
 
 def main():
     log.debug("Start")
 
-    cpu_count = os.cpu_count()
-    workers = cpu_count
-    log.debug(f"System: CPU_COUNT={cpu_count}, WORKERS={workers}")
+    log.debug(
+        f"System: LANES={[(lane.title, lane.workers, lane.queue_size) for lane in LaneEnum]}"
+    )
 
     updater = Updater(
         TOKEN,
-        workers=workers,
-        defaults=Defaults(run_async=True),
+        workers=DISPATCHER_WORKERS,
     )
     bot = updater.bot
     log.debug(f"Bot name {bot.first_name!r} ({bot.name})")
 
+    # Кэш подписок загружается заранее, а не при первом сообщении пользователя
+    log.debug(f"Active subscriptions: {len(Subscription.load_active_user_ids())}")
+
     dp = updater.dispatcher
     commands.setup(dp)
 
-    updater.start_polling()
-    updater.idle()
+    if WEBHOOK_URL:
+        log.debug(f"Webhook mode: {WEBHOOK_URL} (listen {WEBHOOK_LISTEN}:{WEBHOOK_PORT})")
+
+        server = WebhookServer(dp)
+        server.start_dispatcher()
+
+        bot.set_webhook(
+            url=WEBHOOK_URL,
+            api_kwargs=dict(secret_token=WEBHOOK_SECRET_TOKEN),
+        )
+        try:
+            server.serve_forever()
+        finally:
+            server.stop()
+
+    else:
+        # Если до этого был режим webhook, то его нужно отключить, иначе getUpdates не будет работать
+        bot.delete_webhook()
+
+        updater.start_polling()
+        updater.idle()
 
     log.debug("Finish")
 
@@ -5,38 +5,24 @@ __author__ = "ipetrash"
 
 
 import logging
-import sys
-from logging.handlers import RotatingFileHandler
 
 from flask import Flask
 
-from app_web_server.config import DIR_LOGS
+from app_web_server.config import DIR, DIR_LOGS
+from root_common import get_log_handlers, setup_logger
 
 
-app = Flask("web__get_metal_rates")
+# Явный путь, чтобы шаблоны и static находились при запуске из любой папки,
+# например, при публикации статической копии из парсера
+app = Flask("web__get_metal_rates", root_path=str(DIR))
 
 log: logging.Logger = app.logger
 log.handlers.clear()
 
-formatter = logging.Formatter(
-    "[%(asctime)s] %(filename)s:%(lineno)d %(levelname)-8s %(message)s"
-)
+# Общие обработчики для логгеров приложения и werkzeug
+handlers = get_log_handlers(DIR_LOGS / "log.txt")
 
-file_handler = RotatingFileHandler(
-    DIR_LOGS / "log.txt", maxBytes=10_000_000, backupCount=5, encoding="utf-8"
-)
-file_handler.setLevel(logging.DEBUG)
-file_handler.setFormatter(formatter)
-
-stream_handler = logging.StreamHandler(stream=sys.stdout)
-stream_handler.setLevel(logging.DEBUG)
-stream_handler.setFormatter(formatter)
-
-log.setLevel(logging.DEBUG)
-log.addHandler(file_handler)
-log.addHandler(stream_handler)
+setup_logger(log, handlers)
 
 log_werkzeug = logging.getLogger("werkzeug")
-log_werkzeug.setLevel(logging.DEBUG)
-log_werkzeug.addHandler(file_handler)
-log_werkzeug.addHandler(stream_handler)
+setup_logger(log_werkzeug, handlers)
@@ -4,6 +4,7 @@
 __author__ = "ipetrash"
 
 
+import os
 from pathlib import Path
 
 
@@ -13,3 +14,34 @@ DIR_LOGS: Path = DIR / "logs"
 DIR_LOGS.mkdir(parents=True, exist_ok=True)
 
 PORT_WEB: int = 12000
+
+# Папка статической копии страницы: index.html, data.json и static. Публикуется
+# парсером после добавления курсов, ее может раздавать любой статический веб-сервер
+DIR_SNAPSHOT: Path = Path(os.environ.get("WEB_SNAPSHOT_DIR", DIR / "snapshot"))
+
+# Отдавать главную страницу из статической копии, если она есть, без запросов к базе данных
+SERVE_SNAPSHOT: bool = os.environ.get("WEB_SERVE_SNAPSHOT", "1") != "0"
+
+# Кэш графиков /chart/<metal>.png: количество графиков в памяти, одновременных
+# рисований и время ожидания свободного слота, после которого возвращается 503
+CHART_CACHE_MAX_ITEMS: int = int(os.environ.get("CHART_CACHE_MAX_ITEMS", 128))
+CHART_MAX_RENDERS: int = int(os.environ.get("CHART_MAX_RENDERS", 2))
+CHART_RENDER_TIMEOUT_SECS: float = float(os.environ.get("CHART_RENDER_TIMEOUT_SECS", 10))
+
+# Время кэширования графиков в браузерах и прокси, секунды
+CHART_MAX_AGE_SECS: int = 300
+
+# Оповещение открытых страниц о новых курсах (Server-Sent Events) отдельным сервером
+# в одном потоке. Если задан адрес EVENTS_URL (например, /events при проксировании
+# через nginx), страница подключается к нему, иначе - к порту EVENTS_PORT того же хоста
+EVENTS_HOST: str = os.environ.get("EVENTS_HOST", "0.0.0.0")
+EVENTS_PORT: int = int(os.environ.get("EVENTS_PORT", 12004))
+EVENTS_URL: str = os.environ.get("WEB_EVENTS_URL", "")
+
+# Период проверки базы данных, период пустых сообщений для поддержания соединения,
+# максимум одновременных подключений и время жизни подключения, после которого
+# браузер переподключается сам
+EVENTS_POLL_SECS: float = float(os.environ.get("EVENTS_POLL_SECS", 30))
+EVENTS_HEARTBEAT_SECS: float = float(os.environ.get("EVENTS_HEARTBEAT_SECS", 15))
+EVENTS_MAX_CLIENTS: int = int(os.environ.get("EVENTS_MAX_CLIENTS", 1000))
+EVENTS_STREAM_MAX_SECS: float = float(os.environ.get("EVENTS_STREAM_MAX_SECS", 600))
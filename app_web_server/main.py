@@ -4,47 +4,106 @@
 __author__ = "ipetrash"
 
 
-import datetime as DT
 import os.path
 
 from app_web_server.app import app
-from flask import render_template, send_from_directory
+from app_web_server.rates_events import RatesEventsServer
+from app_web_server.snapshot import (
+    FILE_NAME_DATA,
+    FILE_NAME_INDEX,
+    get_index_context,
+    has_snapshot,
+)
+from flask import abort, jsonify, make_response, render_template, request, send_from_directory
 
-import config
-from db import MetalRate
-from root_common import MetalEnum
+from app_web_server import config
+from db import MetalRate, MetalRateYear
+from root_common import MetalEnum, RollupPeriodEnum
+from utils.chart_cache import ChartCache, ChartRenderBusyError
+from utils.draw_plot import ChartPresetEnum, NoDataError, get_plot_for_metal
+
+
+CHART_PRESET = ChartPresetEnum.WEB
+
+CHART_CACHE = ChartCache(
+    max_items=config.CHART_CACHE_MAX_ITEMS,
+    max_renders=config.CHART_MAX_RENDERS,
+    render_timeout_secs=config.CHART_RENDER_TIMEOUT_SECS,
+)
 
 
 @app.route("/")
 def index():
-    items = []
-    for metal_rate in MetalRate.get_last_rates(number=-1):
-        items.append({
-            "date": metal_rate.get_date_title(),
-            "date_iso": metal_rate.date.isoformat(),
-            "gold": float(metal_rate.gold),
-            "silver": float(metal_rate.silver),
-            "platinum": float(metal_rate.platinum),
-            "palladium": float(metal_rate.palladium),
-        })
-
-    start_date, end_date = MetalRate.get_range_dates()
-    filter_date = end_date - DT.timedelta(days=365)
-
-    return render_template(
-        "index.html",
-        title="Цены драгоценных металлов",
-        items=items,
-        start_date=str(start_date),
-        end_date=str(end_date),
-        filter_date=str(filter_date),
-        metals={
-            metal.name_lower: {
-                k: v for k, v in vars(metal).items() if not k.startswith("_")
-            }
-            for metal in MetalEnum
-        },
-    )
+    # Готовая страница из статической копии, без запросов к базе данных
+    if config.SERVE_SNAPSHOT and has_snapshot():
+        return send_from_directory(config.DIR_SNAPSHOT, FILE_NAME_INDEX)
+
+    return render_template("index.html", **get_index_context())
+
+
+@app.route("/data.json")
+def data():
+    if config.SERVE_SNAPSHOT and has_snapshot():
+        return send_from_directory(config.DIR_SNAPSHOT, FILE_NAME_DATA)
+
+    context = get_index_context()
+    return jsonify(last_date=context["end_date"], items=context["items"])
+
+
+@app.route("/chart/<metal_name>.png")
+def chart(metal_name: str):
+    """
+    График металла для встраивания на другие сайты: ?days=N (-1 - все данные) или ?year=Y
+    """
+
+    try:
+        metal = MetalEnum[metal_name.upper()]
+    except KeyError:
+        abort(404)
+
+    days = request.args.get("days", type=int)
+    year = request.args.get("year", type=int)
+    if ("days" in request.args and days is None) or ("year" in request.args and year is None):
+        abort(400)
+
+    if days is not None and year is not None:
+        abort(400)
+
+    if year is not None:
+        if year not in MetalRateYear.get_years():
+            abort(404)
+        days = -1
+    elif days is None:
+        days = -1
+    elif days == 0 or days < -1:
+        abort(400)
+
+    # Для графика за все данные достаточно значений по неделям
+    period = RollupPeriodEnum.WEEK if days == -1 and not year else None
+
+    try:
+        image = CHART_CACHE.get(
+            key=(metal, days, year),
+            version=MetalRate.get_last_date(),
+            render=lambda: get_plot_for_metal(
+                metal=metal, number=days, year=year, period=period, preset=CHART_PRESET
+            ).read(),
+        )
+    except ChartRenderBusyError:
+        response = make_response("Слишком много запросов, попробуйте позже", 503)
+        response.headers["Retry-After"] = "5"
+        return response
+    except NoDataError:
+        abort(404)
+
+    response = make_response(image.data)
+    response.mimetype = CHART_PRESET.encoding.mime_type
+    response.set_etag(image.etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = config.CHART_MAX_AGE_SECS
+
+    # Для запроса с совпадающим If-None-Match будет 304 без тела
+    return response.make_conditional(request)
 
 
 @app.route("/favicon.ico")
@@ -58,6 +117,17 @@ def favicon():
 if __name__ == "__main__":
     # app.debug = True
 
+    # Подключения к /events обслуживает отдельный сервер в одном потоке
+    events_server = RatesEventsServer(
+        host=config.EVENTS_HOST,
+        port=config.EVENTS_PORT,
+        poll_secs=config.EVENTS_POLL_SECS,
+        heartbeat_secs=config.EVENTS_HEARTBEAT_SECS,
+        max_clients=config.EVENTS_MAX_CLIENTS,
+        stream_max_secs=config.EVENTS_STREAM_MAX_SECS,
+    )
+    events_server.start()
+
     app.run(
         host="0.0.0.0",
         port=config.PORT_WEB,
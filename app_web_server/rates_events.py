@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+"""
+Оповещение открытых страниц о новых курсах через Server-Sent Events.
+
+Подключения обслуживает отдельный небольшой HTTP-сервер на selectors в одном потоке:
+открытое подключение - это только сокет и буфер, а не поток веб-сервера. Курсы добавляет
+парсер в отдельном процессе, поэтому появление новых данных определяется периодической
+проверкой последней даты в базе данных в том же потоке.
+"""
+
+
+import datetime as DT
+import json
+import random
+import selectors
+import socket
+import threading
+import time
+
+from dataclasses import dataclass, field
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+from app_web_server.app import log
+from app_web_server.snapshot import get_item
+from db import MetalRate
+
+
+PATH_EVENTS = "/events"
+
+# Через сколько миллисекунд браузер переподключится после разрыва соединения
+RETRY_MS = 5000
+
+# Через сколько миллисекунд переподключаться, если подключений слишком много.
+# Ответ с ошибкой EventSource не повторяет, поэтому вместо него отдается пустой поток
+# с увеличенной задержкой и разбросом, чтобы клиенты не возвращались одновременно
+RETRY_BUSY_MS = 60_000
+
+# Запрос клиента: максимальный размер заголовков и время на их отправку
+MAX_REQUEST_SIZE = 8192
+REQUEST_TIMEOUT_SECS = 10
+
+# Клиент, который не успевает читать события, отключается
+MAX_CLIENT_BUFFER_SIZE = 1024 * 1024
+
+HEADERS_STREAM = (
+    "HTTP/1.1 200 OK\r\n"
+    "Content-Type: text/event-stream; charset=utf-8\r\n"
+    "Cache-Control: no-cache\r\n"
+    "X-Accel-Buffering: no\r\n"  # Для nginx: без буферизации ответа
+    "Access-Control-Allow-Origin: *\r\n"  # Страница может быть открыта с другого порта
+    "Connection: close\r\n"
+    "\r\n"
+)
+
+
+def format_event(event: str, data, event_id: str = None) -> str:
+    lines = []
+    if event_id:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def format_response(status: str, text: str) -> bytes:
+    body = text.encode("utf-8")
+    return (
+        f"HTTP/1.1 {status}\r\n"
+        "Content-Type: text/plain; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n"
+        "\r\n"
+    ).encode("utf-8") + body
+
+
+class RatesSource:
+    """
+    Курсы из базы данных. Записи кэшируются для последнего диапазона дат:
+    все клиенты с одинаковой датой получают их одним запросом к базе данных
+    """
+
+    def __init__(self):
+        self._items_key: Optional[tuple[DT.date, DT.date]] = None
+        self._items: list[dict] = []
+
+    def get_last_date(self) -> DT.date:
+        return MetalRate.get_last_date()
+
+    def get_items_after(self, date: DT.date, end_date: DT.date) -> list[dict]:
+        key = date, end_date
+        if self._items_key != key:
+            self._items = [
+                get_item(row)
+                for row in MetalRate.get_rates_rows_after(date)
+                if row.date <= end_date
+            ]
+            self._items_key = key
+
+        return self._items
+
+
+@dataclass
+class _Client:
+    sock: socket.socket
+    deadline: float
+    request: bytes = b""
+    buffer: bytearray = field(default_factory=bytearray)
+    events: int = selectors.EVENT_READ
+    is_streaming: bool = False
+    close_after_write: bool = False
+    last_date: Optional[DT.date] = None
+
+
+class RatesEventsServer:
+    """
+    Сервер событий /events. Все подключения, проверка новых курсов и пустые сообщения
+    для поддержания соединения обрабатываются в одном потоке
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        source: RatesSource = None,
+        poll_secs: float = 30,
+        heartbeat_secs: float = 15,
+        max_clients: int = 1000,
+        stream_max_secs: float = 600,
+    ):
+        self.host = host
+        self.port = port
+        self.source = source or RatesSource()
+        self.poll_secs = poll_secs
+        self.heartbeat_secs = heartbeat_secs
+        self.max_clients = max_clients
+        self.stream_max_secs = stream_max_secs
+
+        self.last_date: Optional[DT.date] = None
+
+        # Количество подключений, получающих события
+        self.clients: int = 0
+
+        self._sock_by_client: dict[socket.socket, _Client] = dict()
+        self._selector = selectors.DefaultSelector()
+        self._server_sock: Optional[socket.socket] = None
+        self._wakeup_sock, self._wakeup_sock_write = socket.socketpair()
+        self._is_stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self._server_sock.getsockname()[:2]
+
+    def start(self):
+        self._server_sock = socket.create_server((self.host, self.port))
+        self._server_sock.setblocking(False)
+        self._selector.register(self._server_sock, selectors.EVENT_READ, self._accept)
+
+        self._wakeup_sock.setblocking(False)
+        self._selector.register(self._wakeup_sock, selectors.EVENT_READ, self._wakeup)
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+        log.info(f"Сервер событий запущен на {self.address}")
+
+    def stop(self):
+        self._is_stopped = True
+        self._wakeup_sock_write.send(b"\0")
+        self._thread.join()
+
+        for client in list(self._sock_by_client.values()):
+            self._close(client)
+
+        self._selector.close()
+        self._server_sock.close()
+        self._wakeup_sock.close()
+        self._wakeup_sock_write.close()
+
+    def _run(self):
+        next_poll_time = next_heartbeat_time = time.monotonic()
+
+        while not self._is_stopped:
+            now = time.monotonic()
+            if now >= next_poll_time:
+                self._check()
+                next_poll_time = now + self.poll_secs
+
+            if now >= next_heartbeat_time:
+                self._heartbeat(now)
+                next_heartbeat_time = now + self.heartbeat_secs
+
+            timeout = max(min(next_poll_time, next_heartbeat_time) - time.monotonic(), 0)
+            for key, mask in self._selector.select(timeout):
+                try:
+                    key.data(key.fileobj, mask)
+                except Exception:
+                    log.exception("Ошибка при обработке подключения:")
+                    client = self._sock_by_client.get(key.fileobj)
+                    if client:
+                        self._close(client)
+
+    def _wakeup(self, sock: socket.socket, mask: int):
+        sock.recv(1024)
+
+    def _check(self):
+        """
+        Проверка последней даты в базе данных, при изменении подключенным клиентам
+        отправляются новые записи
+        """
+
+        try:
+            last_date = self.source.get_last_date()
+        except Exception:
+            log.exception("Ошибка при проверке новых курсов:")
+            return
+
+        if not last_date or (self.last_date and last_date <= self.last_date):
+            return
+
+        self.last_date = last_date
+        log.info(f"Новые курсы за {last_date}, клиентов: {self.clients}")
+
+        for client in list(self._sock_by_client.values()):
+            if client.is_streaming:
+                self._send_new_items(client)
+
+    def _heartbeat(self, now: float):
+        """
+        Пустые сообщения нужны, чтобы прокси не закрывали соединение, а сервер узнавал
+        об отключении клиента. Подключения после stream_max_secs закрываются, браузер
+        переподключится сам
+        """
+
+        for client in list(self._sock_by_client.values()):
+            if now >= client.deadline:
+                self._close(client)
+            elif client.is_streaming:
+                self._write(client, b": ping\n\n")
+
+    def _accept(self, server_sock: socket.socket, mask: int):
+        while True:
+            try:
+                sock, _ = server_sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+
+            sock.setblocking(False)
+            client = _Client(sock=sock, deadline=time.monotonic() + REQUEST_TIMEOUT_SECS)
+            self._sock_by_client[sock] = client
+            self._selector.register(sock, client.events, self._process)
+
+    def _process(self, sock: socket.socket, mask: int):
+        client = self._sock_by_client[sock]
+
+        if mask & selectors.EVENT_WRITE:
+            self._flush(client)
+            if sock not in self._sock_by_client:
+                return
+
+        if mask & selectors.EVENT_READ:
+            try:
+                data = sock.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                data = b""
+
+            if not data:
+                self._close(client)
+                return
+
+            # После запроса EventSource ничего не отправляет
+            if client.is_streaming or client.close_after_write:
+                return
+
+            client.request += data
+            if b"\r\n\r\n" in client.request:
+                self._process_request(client)
+            elif len(client.request) > MAX_REQUEST_SIZE:
+                self._reply(client, "431 Request Header Fields Too Large", "Слишком большой запрос")
+
+    def _process_request(self, client: _Client):
+        head = client.request.split(b"\r\n\r\n", 1)[0].decode("latin-1")
+        request_line, *header_lines = head.split("\r\n")
+
+        parts = request_line.split()
+        if len(parts) != 3:
+            self._reply(client, "400 Bad Request", "Некорректный запрос")
+            return
+
+        method, target, _ = parts
+        url = urlsplit(target)
+        if url.path != PATH_EVENTS:
+            self._reply(client, "404 Not Found", "Не найдено")
+            return
+
+        if method != "GET":
+            self._reply(client, "405 Method Not Allowed", "Поддерживается только GET")
+            return
+
+        headers = dict()
+        for line in header_lines:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        # При переподключении браузер передает дату последнего события в Last-Event-ID
+        value = headers.get("last-event-id") or parse_qs(url.query).get("last_date", [None])[0]
+        try:
+            last_date = DT.date.fromisoformat(value) if value else None
+        except ValueError:
+            self._reply(client, "400 Bad Request", "Некорректная дата")
+            return
+
+        if self.clients >= self.max_clients:
+            retry_ms = RETRY_BUSY_MS + random.randint(0, RETRY_BUSY_MS)
+            client.close_after_write = True
+            self._write(client, (HEADERS_STREAM + f"retry: {retry_ms}\n\n").encode("utf-8"))
+            return
+
+        self.clients += 1
+        client.is_streaming = True
+        client.deadline = time.monotonic() + self.stream_max_secs
+        client.last_date = last_date or self.last_date
+
+        self._write(client, (HEADERS_STREAM + f"retry: {RETRY_MS}\n\n").encode("utf-8"))
+
+        # Отстающий клиент сразу получает все пропущенные записи
+        self._send_new_items(client)
+
+    def _send_new_items(self, client: _Client):
+        if not self.last_date or not client.last_date or client.last_date >= self.last_date:
+            return
+
+        try:
+            items = self.source.get_items_after(client.last_date, self.last_date)
+        except Exception:
+            log.exception("Ошибка при получении новых курсов:")
+            return
+
+        client.last_date = self.last_date
+        if items:
+            event = format_event("rates", items, event_id=self.last_date.isoformat())
+            self._write(client, event.encode("utf-8"))
+
+    def _reply(self, client: _Client, status: str, text: str):
+        client.close_after_write = True
+        self._write(client, format_response(status, text))
+
+    def _write(self, client: _Client, data: bytes):
+        client.buffer += data
+        if len(client.buffer) > MAX_CLIENT_BUFFER_SIZE:
+            log.info("Клиент не успевает читать события и будет отключен")
+            self._close(client)
+            return
+
+        self._flush(client)
+
+    def _flush(self, client: _Client):
+        try:
+            sent = client.sock.send(client.buffer)
+            del client.buffer[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self._close(client)
+            return
+
+        if not client.buffer and client.close_after_write:
+            self._close(client)
+            return
+
+        # Ожидание возможности записи нужно только пока в буфере есть данные
+        events = selectors.EVENT_READ
+        if client.buffer:
+            events |= selectors.EVENT_WRITE
+
+        if events != client.events:
+            client.events = events
+            self._selector.modify(client.sock, events, self._process)
+
+    def _close(self, client: _Client):
+        if self._sock_by_client.pop(client.sock, None) is None:
+            return
+
+        if client.is_streaming:
+            self.clients -= 1
+
+        self._selector.unregister(client.sock)
+        client.sock.close()
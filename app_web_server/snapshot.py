@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+"""
+Статическая копия главной страницы: index.html с уже подставленными данными,
+data.json и папка static. Каждый файл записывается во временный файл и атомарно
+заменяет предыдущий, поэтому веб-сервер никогда не отдаст недописанный файл.
+
+Публикует копию парсер, поэтому модуль не импортирует Flask-приложение: шаблон
+рисуется отдельным окружением Jinja2, а логи веб-сервера не открываются в парсере.
+"""
+
+
+import datetime as DT
+import json
+import os
+import shutil
+import tempfile
+
+from pathlib import Path
+
+# pip install jinja2
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+from app_web_server.config import DIR, DIR_SNAPSHOT, EVENTS_PORT, EVENTS_URL
+from db import MetalRate
+from root_common import get_date_str, MetalEnum
+
+
+FILE_NAME_INDEX = "index.html"
+FILE_NAME_DATA = "data.json"
+
+DIR_TEMPLATES: Path = DIR / "templates"
+DIR_STATIC: Path = DIR / "static"
+
+
+def get_item(row) -> dict:
+    return {
+        "date": get_date_str(row.date),
+        "date_iso": row.date.isoformat(),
+        "gold": float(row.gold),
+        "silver": float(row.silver),
+        "platinum": float(row.platinum),
+        "palladium": float(row.palladium),
+    }
+
+
+def get_index_context() -> dict:
+    items = [get_item(row) for row in MetalRate.get_last_rates_rows(number=-1)]
+
+    start_date, end_date = MetalRate.get_range_dates()
+    filter_date = end_date - DT.timedelta(days=365)
+
+    return dict(
+        title="Цены драгоценных металлов",
+        items=items,
+        start_date=str(start_date),
+        end_date=str(end_date),
+        filter_date=str(filter_date),
+        metals={
+            metal.name_lower: {
+                k: v for k, v in vars(metal).items() if not k.startswith("_")
+            }
+            for metal in MetalEnum
+        },
+        events_url=EVENTS_URL,
+        events_port=EVENTS_PORT,
+    )
+
+
+def write_atomic(path: Path, data: str):
+    # Временный файл в той же папке, чтобы os.replace не переносил файл между дисками
+    fd, temp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(data)
+
+        # mkstemp создает файл, доступный только владельцу
+        os.chmod(temp_name, 0o644)
+        os.replace(temp_name, path)
+    except BaseException:
+        Path(temp_name).unlink(missing_ok=True)
+        raise
+
+
+def url_for(endpoint: str, filename: str) -> str:
+    """
+    Замена url_for из Flask для шаблона, в котором есть ссылки только на static
+    """
+
+    if endpoint != "static":
+        raise ValueError(f"Неподдерживаемый endpoint: {endpoint!r}")
+
+    return f"/static/{filename}"
+
+
+def render_index(context: dict) -> str:
+    # Как у Flask: экранирование в html-шаблонах
+    env = Environment(
+        loader=FileSystemLoader(DIR_TEMPLATES),
+        autoescape=select_autoescape(["html"]),
+    )
+    env.globals["url_for"] = url_for
+    return env.get_template(FILE_NAME_INDEX).render(**context)
+
+
+def has_snapshot(dir_snapshot: Path = DIR_SNAPSHOT) -> bool:
+    return (dir_snapshot / FILE_NAME_INDEX).is_file()
+
+
+def publish_snapshot(dir_snapshot: Path = DIR_SNAPSHOT) -> Path:
+    context = get_index_context()
+    html = render_index(context)
+
+    dir_snapshot.mkdir(parents=True, exist_ok=True)
+
+    # Сначала файлы, на которые ссылается страница, и только потом сама страница
+    shutil.copytree(DIR_STATIC, dir_snapshot / "static", dirs_exist_ok=True)
+    write_atomic(
+        dir_snapshot / FILE_NAME_DATA,
+        json.dumps(
+            dict(last_date=context["end_date"], items=context["items"]),
+            ensure_ascii=False,
+        ),
+    )
+    write_atomic(dir_snapshot / FILE_NAME_INDEX, html)
+
+    return dir_snapshot
+
+
+if __name__ == "__main__":
+    print(publish_snapshot())
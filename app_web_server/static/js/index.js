@@ -4,6 +4,13 @@ const SELECTOR_TO_DATE = "#to_date";
 const SELECTOR_CHART_ID = "lineChart";
 const SELECTOR_SELECT_METAL = "#select_metal";
 const SELECTOR_USE_FOR_UPDATES_CHART = '.use_for_updates_chart';
+const URL_DATA = "/data.json";
+
+// Если поток событий недоступен, новые записи загружаются из URL_DATA,
+// а переподключение выполняется с увеличивающейся задержкой
+const EVENTS_RETRY_MIN_MS = 5 * 1000;
+const EVENTS_RETRY_MAX_MS = 10 * 60 * 1000;
+const POLL_DATA_INTERVAL_MS = 10 * 60 * 1000;
 
 
 function date_render(data, type, row, meta) {
@@ -46,18 +53,142 @@ function fill_table() {
     });
 }
 
+// Начиная с этого количества точек на графике не рисуются маркеры и сглаживание
+// линии - для плотных данных они не видны, но замедляют отрисовку
+const MAX_POINTS_WITH_MARKERS = 100;
+
+// Индекс курсов для графика: отсортированные даты и значения металлов в типизированных
+// массивах. Диапазон дат ищется бинарным поиском, а выборка - это представление
+// (subarray) без копирования и без создания Date для каждой записи
+class RatesIndex {
+    constructor(items, metal_names) {
+        this.metal_names = metal_names;
+        this.length = 0;
+        this._allocate(Math.max(items.length, 16));
+        this.append(items);
+    }
+
+    _allocate(capacity) {
+        let timestamps = new Float64Array(capacity);
+        if (this.timestamps) {
+            timestamps.set(this.timestamps.subarray(0, this.length));
+        }
+        this.timestamps = timestamps;
+
+        let columns = {};
+        for (let metal of this.metal_names) {
+            columns[metal] = new Float64Array(capacity);
+            if (this.columns) {
+                columns[metal].set(this.columns[metal].subarray(0, this.length));
+            }
+        }
+        this.columns = columns;
+    }
+
+    // Записи должны идти по возрастанию даты и быть новее уже добавленных
+    append(items) {
+        if (this.length + items.length > this.timestamps.length) {
+            this._allocate(Math.max(this.length + items.length, this.timestamps.length * 2));
+        }
+
+        for (let row of items) {
+            this.timestamps[this.length] = Date.parse(row.date_iso);
+            for (let metal of this.metal_names) {
+                this.columns[metal][this.length] = row[metal];
+            }
+            this.length++;
+        }
+    }
+
+    // Индекс первой даты, не меньшей timestamp
+    lower_bound(timestamp) {
+        let low = 0;
+        let high = this.length;
+        while (low < high) {
+            let middle = (low + high) >>> 1;
+            if (this.timestamps[middle] < timestamp) {
+                low = middle + 1;
+            } else {
+                high = middle;
+            }
+        }
+        return low;
+    }
+
+    // Представления дат и значений металла в диапазоне [from_timestamp, to_timestamp]
+    get_range(metal, from_timestamp, to_timestamp) {
+        let start = this.lower_bound(from_timestamp);
+        let end = Math.max(start, this.lower_bound(to_timestamp + 1));
+        return {
+            timestamps: this.timestamps.subarray(start, end),
+            values: this.columns[metal].subarray(start, end),
+        };
+    }
+}
+
+// Прореживание min/max: диапазон делится на max_buckets частей и от каждой остаются
+// минимум и максимум в порядке следования, поэтому пики не теряются.
+// В Chart.js 2.9 нет встроенного прореживания (decimation появилось в 3.0)
+function decimate(timestamps, values, max_buckets) {
+    let length = timestamps.length;
+    let points = [];
+    let add_point = i => points.push({ x: timestamps[i], y: values[i] });
+
+    if (length <= max_buckets * 2) {
+        for (let i = 0; i < length; i++) {
+            add_point(i);
+        }
+        return points;
+    }
+
+    let bucket_size = length / max_buckets;
+    for (let bucket = 0; bucket < max_buckets; bucket++) {
+        let start = Math.floor(bucket * bucket_size);
+        let end = Math.min(length, Math.floor((bucket + 1) * bucket_size));
+
+        let min_i = start;
+        let max_i = start;
+        for (let i = start + 1; i < end; i++) {
+            if (values[i] < values[min_i]) {
+                min_i = i;
+            }
+            if (values[i] > values[max_i]) {
+                max_i = i;
+            }
+        }
+
+        add_point(Math.min(min_i, max_i));
+        if (min_i !== max_i) {
+            add_point(Math.max(min_i, max_i));
+        }
+    }
+
+    // Последний курс должен быть на графике всегда
+    if (points[points.length - 1].x !== timestamps[length - 1]) {
+        add_point(length - 1);
+    }
+    return points;
+}
+
+function get_chart_width() {
+    if (window.chart && window.chart.chartArea) {
+        return Math.round(window.chart.chartArea.right - window.chart.chartArea.left);
+    }
+    return document.getElementById(SELECTOR_CHART_ID).clientWidth || 1000;
+}
+
+// Пустое или некорректное значение поля даты не ограничивает диапазон
+function parse_date(value, default_timestamp) {
+    let timestamp = Date.parse(value);
+    return isNaN(timestamp) ? default_timestamp : timestamp;
+}
+
 function fill_chart(chart_data) {
     let ctx = document.getElementById(SELECTOR_CHART_ID).getContext("2d");
-    return new Chart(ctx, {
+    let config = {
         type: 'line',
         data: {
-            labels: chart_data.labels,
-            datasets: [
-                {
-                    data: chart_data.data,
-                    borderColor: chart_data.color,
-                }
-            ],
+            datasets: [{}],
         },
         options: {
             legend: {
@@ -76,8 +207,15 @@ function fill_chart(chart_data) {
                     distribution: 'linear'
                 }]
             },
+            // Количество точек после прореживания зависит от ширины графика,
+            // после onResize Chart.js сам обновит график
+            onResize: (chart, size) => set_chart_data(chart, get_chart_data(size.width)),
         }
-    });
+    };
+
+    // У настроек та же структура, что и у графика: data и options
+    set_chart_data(config, chart_data);
+    return new Chart(ctx, config);
 }
 
 function get_metal_color(metal_name) {
@@ -89,56 +227,136 @@ function get_metal_color(metal_name) {
     throw new Error('Неизвестный металл ' + metal_name);
 }
 
-function get_chart_data() {
+function get_chart_data(width = get_chart_width()) {
     let metal = $(SELECTOR_SELECT_METAL).val();
     let from_date_val = $(SELECTOR_FROM_DATE).val();
     let to_date_val = $(SELECTOR_TO_DATE).val();
     console.log(`[get_chart_data] ${metal}, ${from_date_val} - ${to_date_val}`);
 
-    let from_date = new Date(from_date_val);
-    let to_date = new Date(to_date_val);
-
     let color = get_metal_color(metal);
 
-    let labels = [];
-    let data = [];
-
-    window.items.forEach(row => {
-        let date = new Date(row.date_iso);
-        if (date < from_date || date > to_date) {
-            return;
-        }
-
-        labels.push(row.date_iso);
-        data.push({
-            x: row.date_iso,
-            y: row[metal],
-        });
-    });
+    let range = window.rates_index.get_range(
+        metal, parse_date(from_date_val, -Infinity), parse_date(to_date_val, Infinity)
+    );
+    let data = decimate(range.timestamps, range.values, width);
 
-    let time_unit = labels.length > 365 ? 'year' : 'month';
+    let time_unit = range.timestamps.length > 365 ? 'year' : 'month';
 
     return {
-        labels: labels,
         data: data,
         color: color,
         time_unit: time_unit,
     };
 }
 
+function set_chart_data(chart, chart_data) {
+    // Набор данных изменяется на месте, а не заменяется новым объектом, чтобы
+    // Chart.js не пересоздавал его внутреннее состояние
+    let dataset = chart.data.datasets[0];
+    let has_markers = chart_data.data.length <= MAX_POINTS_WITH_MARKERS;
+
+    dataset.data = chart_data.data;
+    dataset.borderColor = chart_data.color;
+    dataset.pointRadius = has_markers ? 3 : 0;
+    dataset.lineTension = has_markers ? 0.4 : 0;
+
+    chart.options.scales.xAxes[0].time.unit = chart_data.time_unit;
+}
+
 function update_chart() {
-    let chart_data = get_chart_data()
+    if (!window.chart) {
+        return;
+    }
 
-    window.chart.data.datasets[0] = {
-        data: chart_data.data,
-        borderColor: chart_data.color,
-    };
-    window.chart.options.scales.xAxes[0].time.unit = chart_data.time_unit;
+    set_chart_data(window.chart, get_chart_data());
     window.chart.update();
 }
 
+function get_last_item() {
+    return window.items.length ? window.items[window.items.length - 1] : null;
+}
+
+function append_items(items) {
+    let last_item = get_last_item();
+    let new_items = items.filter(row => !last_item || row.date_iso > last_item.date_iso);
+    if (!new_items.length) {
+        return;
+    }
+    console.log(`[append_items] ${new_items.length}, ${new_items[new_items.length - 1].date_iso}`);
+
+    let to_date = $(SELECTOR_TO_DATE);
+
+    // Если был выбран диапазон до последней даты, то он продлевается на новые даты
+    let is_to_last_date = last_item && to_date.val() === last_item.date_iso;
+
+    window.items.push(...new_items);
+    window.rates_index.append(new_items);
+    window.table.rows.add(new_items).draw(false);  // Без сброса страницы и сортировки
+
+    let new_last_date = get_last_item().date_iso;
+    $(SELECTOR_FROM_DATE + ", " + SELECTOR_TO_DATE).attr("max", new_last_date);
+    if (is_to_last_date) {
+        to_date.val(new_last_date);
+    }
+
+    update_chart();
+}
+
+function get_events_url() {
+    if (window.events_url) {
+        return window.events_url;
+    }
+
+    // Сервер событий работает на отдельном порту того же хоста
+    return `${location.protocol}//${location.hostname}:${window.events_port}/events`;
+}
+
+function poll_new_items() {
+    return $.getJSON(URL_DATA).done(function(data) {
+        append_items(data.items);
+    });
+}
+
+let events_retry_ms = EVENTS_RETRY_MIN_MS;
+
+function subscribe_to_new_items() {
+    if (!window.EventSource) {
+        setInterval(poll_new_items, POLL_DATA_INTERVAL_MS);
+        return;
+    }
+
+    // При переподключении браузер сам передаст дату последнего события в Last-Event-ID
+    let last_item = get_last_item();
+    let url = get_events_url() + (last_item ? "?last_date=" + last_item.date_iso : "");
+
+    let source = new EventSource(url);
+    source.addEventListener("open", function() {
+        events_retry_ms = EVENTS_RETRY_MIN_MS;
+    });
+    source.addEventListener("rates", function(event) {
+        append_items(JSON.parse(event.data));
+    });
+    source.addEventListener("error", function() {
+        // После разрыва соединения браузер переподключается сам, но после ответа
+        // с ошибкой или недоступности сервера подключение закрывается навсегда
+        if (source.readyState !== EventSource.CLOSED) {
+            return;
+        }
+
+        // Разброс задержки, чтобы страницы не переподключались одновременно
+        let delay_ms = events_retry_ms * (0.5 + Math.random());
+        events_retry_ms = Math.min(events_retry_ms * 2, EVENTS_RETRY_MAX_MS);
+        console.log(`[subscribe_to_new_items] Поток событий недоступен, повтор через ${Math.round(delay_ms / 1000)} сек.`);
+
+        setTimeout(function() {
+            poll_new_items().always(subscribe_to_new_items);
+        }, delay_ms);
+    });
+}
+
 $(document).ready(function() {
     window.table = fill_table();
+    window.rates_index = new RatesIndex(window.items, Object.keys(window.metals));
 
     let chart_data = get_chart_data()
     window.chart = fill_chart(chart_data);
@@ -146,4 +364,6 @@ $(document).ready(function() {
     $(SELECTOR_USE_FOR_UPDATES_CHART).change(function() {
         update_chart();
     });
+
+    subscribe_to_new_items();
 });
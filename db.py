@@ -6,8 +6,11 @@ __author__ = "ipetrash"
 
 import datetime as DT
 import enum
+import threading
 import time
 
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
 from decimal import Decimal
 from typing import Type, Optional, Iterable
 
@@ -23,17 +26,27 @@ from peewee import (
     IntegerField,
     BooleanField,
     DateTimeField,
+    OperationalError,
+    fn,
+    chunked,
 )
+from playhouse.migrate import SqliteMigrator, migrate
 from playhouse.sqliteq import SqliteQueueDatabase
 
 from app_parser.config import START_DATE
 from app_parser import parser
 from root_config import DB_FILE_NAME
+from utils.rate_stats import RateStatsIndex, RateStats
+from utils.records import RecordTracker
 from root_common import (
     get_date_str,
     get_start_date,
     get_end_date,
     SubscriptionResultEnum,
+    MetalEnum,
+    RollupPeriodEnum,
+    PriceAlertKindEnum,
+    RecordKindEnum,
 )
 
 
@@ -51,9 +64,24 @@ def shorten(text: str, length=30) -> str:
     return text
 
 
+class StatsSqliteQueueDatabase(SqliteQueueDatabase):
+    """
+    Дополнительно считает количество выполненных запросов в текущем потоке
+    """
+
+    _local = threading.local()
+
+    def execute_sql(self, *args, **kwargs):
+        self._local.query_count = self.get_query_count() + 1
+        return super().execute_sql(*args, **kwargs)
+
+    def get_query_count(self) -> int:
+        return getattr(self._local, "query_count", 0)
+
+
 # This working with multithreading
 # SOURCE: http://docs.peewee-orm.com/en/latest/peewee/playhouse.html#sqliteq
-db = SqliteQueueDatabase(
+db = StatsSqliteQueueDatabase(
     DB_FILE_NAME,
     pragmas={
         "foreign_keys": 1,
@@ -109,6 +137,31 @@ class BaseModel(Model):
     def get_inherited_models(cls) -> list[Type["BaseModel"]]:
         return sorted(cls.__subclasses__(), key=lambda x: x.__name__)
 
+    @classmethod
+    def add_missing_columns(cls):
+        """
+        Добавление в уже существующую таблицу столбцов, которые появились в модели позже:
+        create_tables создает только отсутствующие таблицы
+        """
+
+        database = cls._meta.database
+        table_name = cls._meta.table_name
+
+        column_names = {column.name for column in database.get_columns(table_name)}
+        fields = [
+            field for field in cls._meta.sorted_fields if field.column_name not in column_names
+        ]
+        if not fields:
+            return
+
+        migrator = SqliteMigrator(database)
+        for field in fields:
+            try:
+                migrate(migrator.add_column(table_name, field.column_name, field))
+            except OperationalError:
+                # Столбец мог добавить другой процесс, который импортировал модуль одновременно
+                pass
+
     @classmethod
     def count(cls) -> int:
         return cls.select().count()
@@ -152,6 +205,11 @@ class MetalRate(BaseModel):
     platinum = DecimalField(null=True)
     palladium = DecimalField(null=True)
 
+    # Индекс для статистики за произвольный диапазон дат. Строится при первом
+    # обращении и дополняется новыми курсами через update_stats_index
+    _stats_index: Optional[RateStatsIndex] = None
+    _stats_index_lock = threading.RLock()
+
     def get_date_title(self) -> str:
         return get_date_str(self.date)
 
@@ -159,6 +217,10 @@ class MetalRate(BaseModel):
     def get_by(cls, date: DT.date) -> Optional["MetalRate"]:
         return cls.get_or_none(date=date)
 
+    @classmethod
+    def get_all_after(cls, date: DT.date) -> list["MetalRate"]:
+        return list(cls.select().where(cls.date > date).order_by(cls.date.asc()))
+
     def get_description(self, show_diff: bool = False) -> str:
         def get_diff_str(prev_amt: DecimalField, next_amt: DecimalField) -> str:
             diff = next_amt - prev_amt
@@ -254,31 +316,61 @@ class MetalRate(BaseModel):
 
     @classmethod
     def get_prev_next_years(cls, year: int) -> tuple[int, int]:
-        filters = [cls.date < get_start_date(year)]
-        prev_val = (
-            cls
-            .select(cls.date)
-            .distinct()
-            .where(*filters)
-            .limit(1)
-            .order_by(cls.date.desc())
-            .first()
-        )
-        prev_year = prev_val.date.year if prev_val else None
+        return MetalRateYear.get_prev_next_years(year)
 
-        filters = [cls.date > get_end_date(year)]
-        next_val = (
-            cls
-            .select(cls.date)
-            .distinct()
-            .where(*filters)
-            .limit(1)
-            .order_by(cls.date.asc())
-            .first()
-        )
-        next_year = next_val.date.year if next_val else None
+    @classmethod
+    def get_rollups(
+        cls,
+        metal: MetalEnum,
+        period: RollupPeriodEnum,
+        start_date: DT.date = None,
+        end_date: DT.date = None,
+    ) -> list["MetalRateRollup"]:
+        return MetalRateRollup.get_items(metal, period, start_date, end_date)
 
-        return prev_year, next_year
+    @classmethod
+    def update_stats_index(cls) -> RateStatsIndex:
+        """
+        Добавление в индекс статистики курсов, которые появились после его последней даты
+        """
+
+        with cls._stats_index_lock:
+            if cls._stats_index is None:
+                cls._stats_index = RateStatsIndex()
+
+            query = cls.select(
+                cls.date, cls.gold, cls.silver, cls.platinum, cls.palladium
+            ).order_by(cls.date.asc())
+
+            last_date = cls._stats_index.get_last_date()
+            if last_date:
+                query = query.where(cls.date > last_date)
+
+            cls._stats_index.extend(query.tuples())
+            return cls._stats_index
+
+    @classmethod
+    def reset_stats_index(cls):
+        with cls._stats_index_lock:
+            cls._stats_index = None
+
+    @classmethod
+    def get_range_stats(
+        cls,
+        metal: MetalEnum,
+        start_date: DT.date = None,
+        end_date: DT.date = None,
+    ) -> Optional[RateStats]:
+        """
+        Минимум, максимум и среднее значение металла за диапазон дат за O(1)
+        """
+
+        with cls._stats_index_lock:
+            stats_index = cls._stats_index
+            if stats_index is None:
+                stats_index = cls.update_stats_index()
+
+            return stats_index.get_stats(metal, start_date, end_date)
 
     @classmethod
     def get_last_date(cls) -> DT.date:
@@ -293,13 +385,25 @@ class MetalRate(BaseModel):
         return items
 
     @classmethod
-    def get_last_rates(
+    def _get_last_rates_query(
         cls,
         number: int = -1,
         ignore_null: bool = True,
-    ) -> list["MetalRate"]:
-        dates = cls.get_last_dates(number)
-        filters = [cls.date.in_(dates)]
+        fields: Iterable[Field] = None,
+    ):
+        filters = []
+        if number > 0:  # Иначе, все записи
+            # Дата N-ой с конца записи - все записи, начиная с нее, и будут последними N.
+            # Если записей меньше N, подзапрос вернет NULL и будут выбраны все записи
+            nth_last_date = (
+                cls
+                .select(cls.date)
+                .order_by(cls.date.desc())
+                .limit(1)
+                .offset(number - 1)
+            )
+            filters.append(cls.date >= fn.COALESCE(nth_last_date, DT.date.min))
+
         if ignore_null:
             # Все металлы должны быть заданы
             filters += [
@@ -309,9 +413,44 @@ class MetalRate(BaseModel):
                 cls.palladium.is_null(False),
             ]
 
-        query = cls.select().where(*filters).order_by(cls.date.asc())
+        query = cls.select(*(fields or []))
+        if filters:
+            query = query.where(*filters)
+
+        return query.order_by(cls.date.asc())
+
+    @classmethod
+    def get_last_rates(
+        cls,
+        number: int = -1,
+        ignore_null: bool = True,
+    ) -> list["MetalRate"]:
+        query = cls._get_last_rates_query(number, ignore_null)
         return list(query)
 
+    @classmethod
+    def get_last_rates_rows(
+        cls,
+        number: int = -1,
+        ignore_null: bool = True,
+        fields: Iterable[Field] = None,
+    ) -> list[tuple]:
+        # Аналог get_last_rates, но вместо моделей возвращаются namedtuple - для
+        # больших выборок это значительно быстрее
+        query = cls._get_last_rates_query(number, ignore_null, fields)
+        return list(query.namedtuples())
+
+    @classmethod
+    def get_rates_rows_after(
+        cls,
+        date: DT.date,
+        ignore_null: bool = True,
+        fields: Iterable[Field] = None,
+    ) -> list[tuple]:
+        # Записи после указанной даты, например, добавленные с последней проверки
+        query = cls._get_last_rates_query(ignore_null=ignore_null, fields=fields)
+        return list(query.where(cls.date > date).namedtuples())
+
     @classmethod
     def get_all_by_year(cls, year: int) -> list["MetalRate"]:
         query = (
@@ -326,6 +465,373 @@ class MetalRate(BaseModel):
         return list(query)
 
 
+class MetalRateYear(BaseModel):
+    """
+    Сводная информация по годам курсов: количество записей, диапазон дат
+    и минимальное/максимальное/среднее значение каждого металла.
+    Обновляется парсером при добавлении новых курсов
+    """
+
+    year = IntegerField(unique=True)
+    rates_count = IntegerField()
+    min_date = DateField()
+    max_date = DateField()
+    gold_min = DecimalField(null=True)
+    gold_max = DecimalField(null=True)
+    gold_avg = DecimalField(null=True)
+    silver_min = DecimalField(null=True)
+    silver_max = DecimalField(null=True)
+    silver_avg = DecimalField(null=True)
+    platinum_min = DecimalField(null=True)
+    platinum_max = DecimalField(null=True)
+    platinum_avg = DecimalField(null=True)
+    palladium_min = DecimalField(null=True)
+    palladium_max = DecimalField(null=True)
+    palladium_avg = DecimalField(null=True)
+
+    @classmethod
+    def get_by(cls, year: int) -> Optional["MetalRateYear"]:
+        return cls.get_or_none(year=year)
+
+    @classmethod
+    def get_years(cls) -> list[int]:
+        return [obj.year for obj in cls.select(cls.year).order_by(cls.year.asc())]
+
+    @classmethod
+    def get_last_year(cls) -> Optional[int]:
+        obj = cls.select(cls.year).order_by(cls.year.desc()).first()
+        return obj.year if obj else None
+
+    @classmethod
+    def get_prev_next_years(cls, year: int) -> tuple[int, int]:
+        prev_val = (
+            cls.select(cls.year).where(cls.year < year).order_by(cls.year.desc()).first()
+        )
+        prev_year = prev_val.year if prev_val else None
+
+        next_val = (
+            cls.select(cls.year).where(cls.year > year).order_by(cls.year.asc()).first()
+        )
+        next_year = next_val.year if next_val else None
+
+        return prev_year, next_year
+
+    @classmethod
+    def refresh(cls, year: int) -> Optional["MetalRateYear"]:
+        fields = [
+            fn.COUNT(MetalRate.id).alias("rates_count"),
+            fn.MIN(MetalRate.date).alias("min_date"),
+            fn.MAX(MetalRate.date).alias("max_date"),
+        ]
+        for metal in MetalEnum:
+            field = getattr(MetalRate, metal.name_lower)
+            fields += [
+                fn.MIN(field).alias(f"{metal.name_lower}_min"),
+                fn.MAX(field).alias(f"{metal.name_lower}_max"),
+                fn.ROUND(fn.AVG(field), 2).alias(f"{metal.name_lower}_avg"),
+            ]
+
+        data = (
+            MetalRate
+            .select(*fields)
+            .where(
+                MetalRate.date >= get_start_date(year),
+                MetalRate.date <= get_end_date(year),
+            )
+            .dicts()
+            .get()
+        )
+        if not data["rates_count"]:
+            cls.delete().where(cls.year == year).execute()
+            return None
+
+        cls.insert(year=year, **data).on_conflict_replace().execute()
+        return cls.get_by(year)
+
+    @classmethod
+    def get_rate_years(cls) -> set[int]:
+        """
+        Годы, за которые есть курсы
+        """
+
+        query = MetalRate.select(MetalRate.date.year.alias("year")).distinct()
+        return {row.year for row in query.namedtuples()}
+
+    @classmethod
+    def refresh_all(cls):
+        years = cls.get_rate_years()
+
+        # Удаление годов, для которых курсов больше нет
+        cls.delete().where(cls.year.not_in(years)).execute()
+
+        for year in sorted(years):
+            cls.refresh(year)
+
+    @classmethod
+    def refresh_missing(cls) -> list[int]:
+        """
+        Обновление только тех годов, которые отличаются в курсах и сводной таблице:
+        годы без записи в сводной таблице и записи для годов без курсов.
+        Возвращает список обновленных годов
+        """
+
+        years = sorted(cls.get_rate_years() ^ set(cls.get_years()))
+        for year in years:
+            cls.refresh(year)
+
+        return years
+
+
+class MetalRateRollup(BaseModel):
+    """
+    Агрегированные по неделям, месяцам и годам значения металла: цены открытия,
+    закрытия, максимальная, минимальная и средняя.
+    Обновляется парсером при добавлении новых курсов
+    """
+
+    period = CharField()
+    metal = CharField()
+    start_date = DateField()
+    first_date = DateField()
+    last_date = DateField()
+    rates_count = IntegerField()
+    open = DecimalField()
+    high = DecimalField()
+    low = DecimalField()
+    close = DecimalField()
+    avg = DecimalField()
+
+    class Meta:
+        indexes = (
+            (("period", "metal", "start_date"), True),
+        )
+
+    @classmethod
+    def get_items(
+        cls,
+        metal: MetalEnum,
+        period: RollupPeriodEnum,
+        start_date: DT.date = None,
+        end_date: DT.date = None,
+    ) -> list["MetalRateRollup"]:
+        filters = [cls.period == period.name, cls.metal == metal.name]
+        if start_date:
+            filters.append(cls.last_date >= start_date)
+        if end_date:
+            filters.append(cls.first_date <= end_date)
+
+        query = cls.select().where(*filters).order_by(cls.start_date.asc())
+        return list(query)
+
+    @classmethod
+    def _get_rows(cls, start_date: DT.date = None, end_date: DT.date = None) -> list[tuple]:
+        query = MetalRate.select(
+            MetalRate.date,
+            MetalRate.gold,
+            MetalRate.silver,
+            MetalRate.platinum,
+            MetalRate.palladium,
+        )
+        if start_date and end_date:
+            query = query.where(
+                MetalRate.date >= start_date,
+                MetalRate.date <= end_date,
+            )
+
+        return list(query.order_by(MetalRate.date.asc()).namedtuples())
+
+    @classmethod
+    def _get_items_from_rows(cls, period: RollupPeriodEnum, rows: list[tuple]) -> list[dict]:
+        # NOTE: Строки должны быть отсортированы по дате
+        start_date_by_rows: dict[DT.date, list[tuple]] = dict()
+        for row in rows:
+            start_date = period.get_period_start(row.date)
+            start_date_by_rows.setdefault(start_date, []).append(row)
+
+        items = []
+        for start_date, period_rows in start_date_by_rows.items():
+            for metal in MetalEnum:
+                date_by_value = [
+                    (row.date, getattr(row, metal.name_lower))
+                    for row in period_rows
+                    if getattr(row, metal.name_lower) is not None
+                ]
+                if not date_by_value:
+                    continue
+
+                dates = [date for date, _ in date_by_value]
+                values = [value for _, value in date_by_value]
+
+                items.append(
+                    dict(
+                        period=period.name,
+                        metal=metal.name,
+                        start_date=start_date,
+                        first_date=dates[0],
+                        last_date=dates[-1],
+                        rates_count=len(values),
+                        open=values[0],
+                        high=max(values),
+                        low=min(values),
+                        close=values[-1],
+                        # NOTE: Без арифметики Decimal, т.к. парсер задает глобальную точность в 2 знака
+                        avg=round(sum(map(float, values)) / len(values), 2),
+                    )
+                )
+
+        return items
+
+    @classmethod
+    def _save_items(cls, items: list[dict]):
+        for batch in chunked(items, 50):
+            cls.insert_many(batch).on_conflict_replace().execute()
+
+    @classmethod
+    def refresh(cls, period: RollupPeriodEnum, date: DT.date):
+        start_date = period.get_period_start(date)
+        end_date = period.get_period_end(date)
+
+        cls.delete().where(
+            cls.period == period.name, cls.start_date == start_date
+        ).execute()
+
+        rows = cls._get_rows(start_date, end_date)
+        cls._save_items(cls._get_items_from_rows(period, rows))
+
+    @classmethod
+    def refresh_for_dates(cls, dates: Iterable[DT.date]):
+        for period in RollupPeriodEnum:
+            # Достаточно обновить по одному разу каждый затронутый период
+            start_dates = {period.get_period_start(date) for date in dates}
+            for start_date in sorted(start_dates):
+                cls.refresh(period, start_date)
+
+    @classmethod
+    def refresh_all(cls):
+        rows = cls._get_rows()
+
+        cls.delete().execute()
+        for period in RollupPeriodEnum:
+            cls._save_items(cls._get_items_from_rows(period, rows))
+
+
+class MetalRateMonth(BaseModel):
+    """
+    Битовая карта дат с курсами по месяцам: бит (day - 1) в days_mask
+    установлен, если за этот день месяца есть курс.
+    Обновляется парсером при добавлении новых курсов
+    """
+
+    year = IntegerField()
+    month = IntegerField()
+    days_mask = IntegerField()
+
+    class Meta:
+        indexes = (
+            (("year", "month"), True),
+        )
+
+    @staticmethod
+    def get_days(days_mask: int) -> list[int]:
+        days = []
+        while days_mask:
+            lowest = days_mask & -days_mask
+            days.append(lowest.bit_length())
+            days_mask ^= lowest
+        return days
+
+    @staticmethod
+    def get_nearest_day(days_mask: int, day: int) -> Optional[int]:
+        """
+        Ближайший к day день из битовой карты, при равном удалении - следующий день
+        """
+
+        if days_mask >> (day - 1) & 1:
+            return day
+
+        # Старший установленный бит среди предыдущих дней
+        prev_mask = days_mask & ((1 << (day - 1)) - 1)
+        prev_day = prev_mask.bit_length() or None
+
+        # Младший установленный бит среди следующих дней
+        next_mask = days_mask >> day
+        next_day = day + (next_mask & -next_mask).bit_length() if next_mask else None
+
+        if prev_day and next_day:
+            return prev_day if day - prev_day < next_day - day else next_day
+
+        return next_day or prev_day
+
+    @classmethod
+    def get_days_mask(cls, year: int, month: int) -> int:
+        obj = cls.get_or_none(year=year, month=month)
+        return obj.days_mask if obj else 0
+
+    @classmethod
+    def get_available_days(cls, year: int, month: int) -> list[int]:
+        return cls.get_days(cls.get_days_mask(year, month))
+
+    @classmethod
+    def get_nearest_date(cls, date: DT.date) -> Optional[DT.date]:
+        """
+        Ближайшая к date дата с курсами. Обычно хватает битовой карты месяца,
+        а если в месяце курсов нет, то ищется ближайшая дата в соседних месяцах
+        """
+
+        day = cls.get_nearest_day(cls.get_days_mask(date.year, date.month), date.day)
+        if day:
+            return date.replace(day=day)
+
+        prev_date, next_date = MetalRate.get_prev_next_dates(date)
+        if prev_date and next_date:
+            return prev_date if date - prev_date < next_date - date else next_date
+
+        return next_date or prev_date
+
+    @classmethod
+    def _get_items(cls, dates: Iterable[DT.date]) -> list[dict]:
+        month_by_mask: dict[tuple[int, int], int] = defaultdict(int)
+        for date in dates:
+            month_by_mask[date.year, date.month] |= 1 << (date.day - 1)
+
+        return [
+            dict(year=year, month=month, days_mask=days_mask)
+            for (year, month), days_mask in sorted(month_by_mask.items())
+        ]
+
+    @classmethod
+    def refresh(cls, year: int, month: int):
+        start_date = DT.date(year, month, 1)
+        end_date = RollupPeriodEnum.MONTH.get_period_end(start_date)
+
+        query = MetalRate.select(MetalRate.date).where(
+            MetalRate.date >= start_date,
+            MetalRate.date <= end_date,
+        )
+        items = cls._get_items(date for date, in query.tuples())
+        if not items:
+            cls.delete().where(cls.year == year, cls.month == month).execute()
+            return
+
+        cls.insert_many(items).on_conflict_replace().execute()
+
+    @classmethod
+    def refresh_for_dates(cls, dates: Iterable[DT.date]):
+        for year, month in sorted({(date.year, date.month) for date in dates}):
+            cls.refresh(year, month)
+
+    @classmethod
+    def refresh_all(cls):
+        query = MetalRate.select(MetalRate.date)
+        items = cls._get_items(date for date, in query.tuples())
+
+        cls.delete().execute()
+
+        # Первичное заполнение может одновременно выполняться при импорте в нескольких процессах
+        for batch in chunked(items, 100):
+            cls.insert_many(batch).on_conflict_replace().execute()
+
+
 class Subscription(BaseModel):
     user_id = IntegerField(unique=True)
     is_active = BooleanField(default=True)
@@ -333,6 +839,63 @@ class Subscription(BaseModel):
     creation_datetime = DateTimeField(default=DT.datetime.now)
     modification_datetime = DateTimeField(default=DT.datetime.now)
 
+    # Кэш идентификаторов пользователей с активной подпиской. Загружается при
+    # запуске бота (или при первом обращении) и обновляется при изменении подписок
+    # через методы класса. Множество неизменяемое и при изменении заменяется целиком,
+    # поэтому его можно использовать вне блокировки
+    _active_user_ids: Optional[frozenset[int]] = None
+    _active_user_ids_lock = threading.RLock()
+
+    @classmethod
+    def _get_active_user_ids_from_db(cls) -> frozenset[int]:
+        query = cls.select(cls.user_id).where(cls.is_active == True)
+        return frozenset(user_id for user_id, in query.tuples())
+
+    @classmethod
+    def load_active_user_ids(cls) -> frozenset[int]:
+        with cls._active_user_ids_lock:
+            cls._active_user_ids = cls._get_active_user_ids_from_db()
+            return cls._active_user_ids
+
+    @classmethod
+    def get_active_user_ids(cls) -> frozenset[int]:
+        with cls._active_user_ids_lock:
+            if cls._active_user_ids is None:
+                return cls.load_active_user_ids()
+
+            return cls._active_user_ids
+
+    @classmethod
+    def _set_active_user_id(cls, user_id: int, active: bool):
+        with cls._active_user_ids_lock:
+            active_user_ids = cls.get_active_user_ids()
+            if active:
+                cls._active_user_ids = active_user_ids | {user_id}
+            else:
+                cls._active_user_ids = active_user_ids - {user_id}
+
+    @classmethod
+    def check_active_user_ids(cls) -> tuple[set[int], set[int]]:
+        """
+        Сверка кэша с таблицей и его перезагрузка.
+        Возвращает идентификаторы, которых не хватало в кэше, и лишние
+        """
+
+        with cls._active_user_ids_lock:
+            cached = cls.get_active_user_ids()
+            actual = cls.load_active_user_ids()
+
+        return set(actual - cached), set(cached - actual)
+
+    @classmethod
+    def reset_active_user_ids(cls):
+        with cls._active_user_ids_lock:
+            cls._active_user_ids = None
+
+    @classmethod
+    def get_active_count(cls) -> int:
+        return len(cls.get_active_user_ids())
+
     @classmethod
     def get_by_user_id(cls, user_id: int) -> Optional["Subscription"]:
         return cls.get_or_none(cls.user_id == user_id)
@@ -349,6 +912,7 @@ class Subscription(BaseModel):
         else:
             # По-умолчанию, подписки создаются активными
             cls.create(user_id=user_id)
+            cls._set_active_user_id(user_id, True)
 
         return SubscriptionResultEnum.SUBSCRIBE_OK
 
@@ -370,7 +934,7 @@ class Subscription(BaseModel):
 
     @classmethod
     def has_is_active(cls, user_id: int) -> bool:
-        return bool(cls.get_or_none(cls.user_id == user_id, cls.is_active == True))
+        return user_id in cls.get_active_user_ids()
 
     def set_active(self, active: bool):
         self.is_active = active
@@ -379,10 +943,446 @@ class Subscription(BaseModel):
         self.modification_datetime = DT.datetime.now()
         self.save()
 
+        self._set_active_user_id(self.user_id, active)
+
+
+class PriceAlertMatcher:
+    """
+    Индекс активных оповещений: для каждого металла и типа оповещения хранятся
+    отсортированные пороги, поэтому для нового курса бинарным поиском выбираются
+    только сработавшие оповещения, а не перебираются все.
+    Оповещения добавляются и удаляются по одному, без перестроения индекса
+    """
+
+    def __init__(self, items: Iterable[tuple[int, str, str, float]] = ()):
+        # Параллельные списки, отсортированные по (порог, идентификатор)
+        self._key_by_items: dict[tuple[str, str], list[tuple[float, int]]] = defaultdict(list)
+        self._key_by_values: dict[tuple[str, str], list[float]] = defaultdict(list)
+        self._key_by_ids: dict[tuple[str, str], list[int]] = defaultdict(list)
+
+        self._id_by_item: dict[int, tuple[tuple[str, str], tuple[float, int]]] = dict()
+
+        for alert_id, metal_name, kind_name, value in items:
+            self.add(alert_id, metal_name, kind_name, value)
+
+    def __len__(self) -> int:
+        return len(self._id_by_item)
+
+    def __contains__(self, alert_id: int) -> bool:
+        return alert_id in self._id_by_item
+
+    def add(self, alert_id: int, metal_name: str, kind_name: str, value: float):
+        self.remove(alert_id)
+
+        key = metal_name, kind_name
+        item = float(value), alert_id
+
+        items = self._key_by_items[key]
+        i = bisect_left(items, item)
+        items.insert(i, item)
+        self._key_by_values[key].insert(i, item[0])
+        self._key_by_ids[key].insert(i, alert_id)
+
+        self._id_by_item[alert_id] = key, item
+
+    def remove(self, alert_id: int):
+        if alert_id not in self._id_by_item:
+            return
+
+        key, item = self._id_by_item.pop(alert_id)
+
+        i = bisect_left(self._key_by_items[key], item)
+        del self._key_by_items[key][i]
+        del self._key_by_values[key][i]
+        del self._key_by_ids[key][i]
+
+    def _get(self, metal: MetalEnum, kind: PriceAlertKindEnum) -> tuple[list[float], list[int]]:
+        key = metal.name, kind.name
+        return self._key_by_values.get(key, []), self._key_by_ids.get(key, [])
+
+    def match(
+        self,
+        metal: MetalEnum,
+        prev_value: float,
+        value: float,
+    ) -> dict[PriceAlertKindEnum, list[int]]:
+        kind_by_alert_ids: dict[PriceAlertKindEnum, list[int]] = dict()
+        if prev_value is None or value is None:
+            return kind_by_alert_ids
+
+        prev_value = float(prev_value)
+        value = float(value)
+
+        # Курс поднялся до порога или выше: prev_value < порог <= value
+        values, ids = self._get(metal, PriceAlertKindEnum.UP)
+        kind_by_alert_ids[PriceAlertKindEnum.UP] = (
+            ids[bisect_right(values, prev_value):bisect_right(values, value)]
+        )
+
+        # Курс опустился до порога или ниже: value <= порог < prev_value
+        values, ids = self._get(metal, PriceAlertKindEnum.DOWN)
+        kind_by_alert_ids[PriceAlertKindEnum.DOWN] = (
+            ids[bisect_left(values, value):bisect_left(values, prev_value)]
+        )
+
+        # Изменение в процентах не меньше порога
+        if prev_value:
+            percent = abs(value - prev_value) / prev_value * 100
+            values, ids = self._get(metal, PriceAlertKindEnum.CHANGE)
+            kind_by_alert_ids[PriceAlertKindEnum.CHANGE] = ids[:bisect_right(values, percent)]
+
+        return kind_by_alert_ids
+
+
+class PriceAlert(BaseModel):
+    """
+    Оповещение пользователя о пересечении курсом металла порога
+    или об изменении курса за день более чем на заданный процент
+    """
+
+    user_id = IntegerField(index=True)
+    metal = CharField()
+    kind = CharField()
+    value = DecimalField()
+    is_active = BooleanField(default=True)
+    was_sending = BooleanField(default=True)
+    triggered_date = DateField(null=True)
+    triggered_prev_value = DecimalField(null=True)
+    triggered_value = DecimalField(null=True)
+    creation_datetime = DateTimeField(default=DT.datetime.now)
+    modification_datetime = DateTimeField(default=DT.datetime.now)
+
+    class Meta:
+        indexes = (
+            (("is_active", "metal", "kind", "value"), False),
+            (("modification_datetime",), False),
+        )
+
+    # Индекс активных оповещений для проверки новых курсов. Строится при первом
+    # обращении, а затем обновляется только измененными оповещениями (по
+    # modification_datetime), т.к. оповещения добавляет и отключает бот в другом процессе
+    _matcher: Optional[PriceAlertMatcher] = None
+    _matcher_modification_datetime: Optional[DT.datetime] = None
+    _matcher_lock = threading.RLock()
+
+    # Запас для изменений, записанных другим процессом с более ранним временем
+    # уже после синхронизации индекса. Повторное применение изменения безопасно
+    MATCHER_SYNC_OVERLAP = DT.timedelta(minutes=1)
+
+    def get_metal(self) -> MetalEnum:
+        return MetalEnum[self.metal]
+
+    def get_kind(self) -> PriceAlertKindEnum:
+        return PriceAlertKindEnum[self.kind]
+
+    def get_title(self) -> str:
+        value = f"{self.value:.2f}"
+        if self.get_kind() == PriceAlertKindEnum.CHANGE:
+            value += "%"
+
+        return f"{self.get_metal().singular.title()} {self.get_kind().value} {value}"
+
+    def get_description(self) -> str:
+        prev_value = float(self.triggered_prev_value)
+        value = float(self.triggered_value)
+        percent = (value - prev_value) / prev_value * 100 if prev_value else 0.0
+
+        return (
+            f"{self.get_title()}\n"
+            f"{get_date_str(self.triggered_date)}: {prev_value:.2f} -> {value:.2f} ({percent:+.2f}%)"
+        )
+
+    @classmethod
+    def add(
+        cls,
+        user_id: int,
+        metal: MetalEnum,
+        kind: PriceAlertKindEnum,
+        value: Decimal,
+    ) -> "PriceAlert":
+        return cls.create(
+            user_id=user_id,
+            metal=metal.name,
+            kind=kind.name,
+            value=value,
+        )
+
+    @classmethod
+    def get_active_by_user_id(cls, user_id: int) -> list["PriceAlert"]:
+        query = (
+            cls.select()
+            .where(cls.user_id == user_id, cls.is_active == True)
+            .order_by(cls.id.asc())
+        )
+        return list(query)
+
+    @classmethod
+    def deactivate(cls, user_id: int, alert_id: int = None) -> int:
+        """
+        Отключение оповещения пользователя или всех его оповещений, если alert_id не задан.
+        Возвращает количество отключенных оповещений
+        """
+
+        filters = [cls.user_id == user_id, cls.is_active == True]
+        if alert_id is not None:
+            filters.append(cls.id == alert_id)
+
+        return (
+            cls.update(is_active=False, modification_datetime=DT.datetime.now())
+            .where(*filters)
+            .execute()
+        )
+
+    @classmethod
+    def update_matcher(cls) -> PriceAlertMatcher:
+        """
+        Применение к индексу оповещений, которые были добавлены, изменены
+        или отключены после его последнего обновления
+        """
+
+        with cls._matcher_lock:
+            query = cls.select(
+                cls.id, cls.metal, cls.kind, cls.value, cls.is_active, cls.modification_datetime
+            )
+
+            if cls._matcher is None:
+                cls._matcher = PriceAlertMatcher()
+                cls._matcher_modification_datetime = (
+                    cls.select(fn.MAX(cls.modification_datetime)).scalar()
+                )
+                query = query.where(cls.is_active == True)
+            elif cls._matcher_modification_datetime:
+                query = query.where(
+                    cls.modification_datetime
+                    >= cls._matcher_modification_datetime - cls.MATCHER_SYNC_OVERLAP
+                )
+
+            for alert_id, metal_name, kind_name, value, is_active, modification_datetime in query.tuples():
+                if is_active:
+                    cls._matcher.add(alert_id, metal_name, kind_name, value)
+                else:
+                    cls._matcher.remove(alert_id)
+
+                if (
+                    not cls._matcher_modification_datetime
+                    or modification_datetime > cls._matcher_modification_datetime
+                ):
+                    cls._matcher_modification_datetime = modification_datetime
+
+            return cls._matcher
+
+    @classmethod
+    def reset_matcher(cls):
+        with cls._matcher_lock:
+            cls._matcher = None
+            cls._matcher_modification_datetime = None
+
+    @classmethod
+    def check_rates(cls, metal_rates: list[MetalRate]) -> list[int]:
+        """
+        Проверка оповещений для новых курсов. Сработавшие оповещения помечаются
+        для рассылки, оповещения о пересечении порога после этого отключаются.
+        Возвращает идентификаторы сработавших оповещений
+        """
+
+        if not metal_rates:
+            return []
+
+        metal_rates = sorted(metal_rates, key=lambda x: x.date)
+
+        prev_date, _ = MetalRate.get_prev_next_dates(metal_rates[0].date)
+        prev_metal_rate = MetalRate.get_by(prev_date) if prev_date else None
+
+        matcher = cls.update_matcher()
+
+        alert_id_by_data: dict[int, dict] = dict()
+
+        for metal_rate in metal_rates:
+            if prev_metal_rate:
+                for metal in MetalEnum:
+                    prev_value = getattr(prev_metal_rate, metal.name_lower)
+                    value = getattr(metal_rate, metal.name_lower)
+
+                    kind_by_alert_ids = matcher.match(metal, prev_value, value)
+                    for kind, alert_ids in kind_by_alert_ids.items():
+                        for alert_id in alert_ids:
+                            data = dict(
+                                triggered_date=metal_rate.date,
+                                triggered_prev_value=prev_value,
+                                triggered_value=value,
+                            )
+
+                            # Для изменения за день сохраняется последнее срабатывание,
+                            # для пересечения порога - первое
+                            if kind == PriceAlertKindEnum.CHANGE:
+                                alert_id_by_data[alert_id] = data
+                            else:
+                                alert_id_by_data.setdefault(alert_id, data)
+
+            prev_metal_rate = metal_rate
+
+        alert_ids = []
+        for alert in cls.select().where(cls.id.in_(list(alert_id_by_data))):
+            # Курсы могут проверяться повторно, если на прошлом проходе парсера
+            # была ошибка: уже сработавшее за эту дату оповещение не повторяется
+            triggered_date = alert_id_by_data[alert.id]["triggered_date"]
+            if alert.triggered_date and alert.triggered_date >= triggered_date:
+                continue
+
+            alert_ids.append(alert.id)
+
+            # Оповещение о пересечении порога срабатывает один раз
+            if alert.get_kind() != PriceAlertKindEnum.CHANGE:
+                alert.is_active = False
+                with cls._matcher_lock:
+                    matcher.remove(alert.id)
+
+            for name, value in alert_id_by_data[alert.id].items():
+                setattr(alert, name, value)
+
+            alert.was_sending = False
+            alert.modification_datetime = DT.datetime.now()
+            alert.save()
+
+        return sorted(alert_ids)
+
+    @classmethod
+    def get_unsent(cls) -> list["PriceAlert"]:
+        return list(
+            cls.select().where(cls.was_sending == False).order_by(cls.id.asc())
+        )
+
+
+class MetalRateRecord(BaseModel):
+    """
+    Рекордные дни металлов: исторический максимум/минимум, за 52 недели
+    или с начала года. Для дня и направления хранится только самый значимый рекорд.
+    Заполняется парсером при добавлении новых курсов
+    """
+
+    date = DateField()
+    metal = CharField()
+    kind = CharField()
+    is_high = BooleanField()
+    value = DecimalField()
+    prev_value = DecimalField()
+    was_sending = BooleanField(default=False)
+
+    class Meta:
+        indexes = (
+            (("date", "metal", "is_high"), True),
+        )
+
+    def get_metal(self) -> MetalEnum:
+        return MetalEnum[self.metal]
+
+    def get_kind(self) -> RecordKindEnum:
+        return RecordKindEnum[self.kind]
+
+    def get_description(self) -> str:
+        direction = "максимум" if self.is_high else "минимум"
+        return (
+            f"{self.get_metal().singular.title()}: {self.get_kind().value} {direction} "
+            f"{self.value:.2f} (предыдущий {self.prev_value:.2f})"
+        )
+
+    @classmethod
+    def get_tracker(cls, date: DT.date) -> RecordTracker:
+        """
+        Экстремумы по курсам до date: за прошлые годы - из сводной таблицы по годам,
+        за текущий год и окно в 52 недели - по курсам из диапазона дат
+        """
+
+        tracker = RecordTracker()
+
+        for year_info in MetalRateYear.select().where(MetalRateYear.year < date.year):
+            for metal in MetalEnum:
+                tracker.set_all_time(
+                    metal,
+                    getattr(year_info, f"{metal.name_lower}_min"),
+                    getattr(year_info, f"{metal.name_lower}_max"),
+                )
+
+        start_date = min(get_start_date(date.year), tracker.get_window_start(date))
+        query = (
+            MetalRate.select(
+                MetalRate.date,
+                MetalRate.gold,
+                MetalRate.silver,
+                MetalRate.platinum,
+                MetalRate.palladium,
+            )
+            .where(MetalRate.date >= start_date, MetalRate.date < date)
+            .order_by(MetalRate.date.asc())
+        )
+        for rate_date, *values in query.tuples():
+            tracker.add(rate_date, dict(zip(MetalEnum, values)), detect=False)
+
+        return tracker
+
+    @classmethod
+    def check_rates(cls, metal_rates: list[MetalRate]) -> list["MetalRateRecord"]:
+        """
+        Поиск рекордов среди новых курсов. Уже сохраненные рекорды пропускаются,
+        поэтому курсы можно проверить повторно, например, после ошибки в парсере
+        """
+
+        if not metal_rates:
+            return []
+
+        metal_rates = sorted(metal_rates, key=lambda x: x.date)
+        tracker = cls.get_tracker(metal_rates[0].date)
+
+        query = cls.select(cls.date, cls.metal, cls.is_high).where(
+            cls.date.between(metal_rates[0].date, metal_rates[-1].date)
+        )
+        existing_keys = set(query.tuples())
+
+        items = []
+        for metal_rate in metal_rates:
+            metal_by_value = {
+                metal: getattr(metal_rate, metal.name_lower) for metal in MetalEnum
+            }
+            for record in tracker.add(metal_rate.date, metal_by_value):
+                if (record.date, record.metal.name, record.is_high) in existing_keys:
+                    continue
+
+                items.append(
+                    cls.create(
+                        date=record.date,
+                        metal=record.metal.name,
+                        kind=record.kind.name,
+                        is_high=record.is_high,
+                        value=getattr(metal_rate, record.metal.name_lower),
+                        prev_value=record.prev_value,
+                    )
+                )
+
+        return items
+
+    @classmethod
+    def get_by_date(cls, date: DT.date) -> list["MetalRateRecord"]:
+        return list(cls.select().where(cls.date == date).order_by(cls.id.asc()))
+
+    @classmethod
+    def get_unsent(cls) -> list["MetalRateRecord"]:
+        return list(
+            cls.select().where(cls.was_sending == False).order_by(cls.date.asc(), cls.id.asc())
+        )
+
+    @classmethod
+    def set_sent(cls, items: list["MetalRateRecord"]):
+        cls.update(was_sending=True).where(cls.id.in_([obj.id for obj in items])).execute()
+
 
 class Settings(BaseModel):
     last_date_of_metals_rate = DateField(null=True)
 
+    # Последняя дата курсов, для которой парсер проверил оповещения и рекорды.
+    # Хранится отдельно от последней даты курсов, потому что проверка может
+    # не выполниться из-за ошибки после добавления курсов
+    last_date_of_checked_rates = DateField(null=True)
+
     @classmethod
     def instance(cls) -> "Settings":
         obj = cls.get_first()
@@ -401,14 +1401,39 @@ class Settings(BaseModel):
     def get_last_date_of_metals_rate(cls) -> Optional[DT.date]:
         return cls.instance().last_date_of_metals_rate
 
+    @classmethod
+    def set_last_date_of_checked_rates(cls, value: DT.date):
+        obj = cls.instance()
+        obj.last_date_of_checked_rates = value
+        obj.save()
+
+    @classmethod
+    def get_last_date_of_checked_rates(cls) -> Optional[DT.date]:
+        return cls.instance().last_date_of_checked_rates
+
 
 db.connect()
 db.create_tables(BaseModel.get_inherited_models())
+for model in BaseModel.get_inherited_models():
+    model.add_missing_columns()
 
 # Задержка в 50мс, чтобы дать время на запуск SqliteQueueDatabase и создание таблиц
 # Т.к. в SqliteQueueDatabase запросы на чтение выполняются сразу, а на запись попадают в очередь
 time.sleep(0.050)
 
+# Заполнение сводной таблицы по годам для уже существующих курсов. Проверяется
+# не пустота таблицы, а пропущенные годы, например, если курсы добавлялись без обновления
+if MetalRate.count():
+    MetalRateYear.refresh_missing()
+
+# Первичное заполнение агрегатов по периодам для уже существующих курсов
+if not MetalRateRollup.count() and MetalRate.count():
+    MetalRateRollup.refresh_all()
+
+# Первичное заполнение битовых карт месяцев для уже существующих курсов
+if not MetalRateMonth.count() and MetalRate.count():
+    MetalRateMonth.refresh_all()
+
 
 if __name__ == "__main__":
     BaseModel.print_count_of_tables()
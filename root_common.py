@@ -4,48 +4,216 @@
 __author__ = "ipetrash"
 
 
+import atexit
+import copy
 import datetime as DT
 import enum
 import logging
+import queue
+import random
 import sys
+import threading
 
-from logging.handlers import RotatingFileHandler
-from pathlib import Path
-from typing import Union
+from decimal import Decimal
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from pathlib import Path, PurePath
+from typing import Optional, Union
 
-from root_config import DATE_FORMAT
+from root_config import DATE_FORMAT, LOG_QUEUED, LOG_LEVELS, LOG_DEBUG_SAMPLING
 
 
-def get_logger(
-    name: str,
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает только часть DEBUG-записей, записи уровня INFO и выше пропускаются всегда
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+# Значения аргументов, которые не могут измениться до записи лога в другом потоке
+_IMMUTABLE_ARG_TYPES = (
+    str, bytes, int, float, complex, bool, type(None),
+    Decimal, DT.date, DT.time, DT.timedelta, enum.Enum, PurePath,
+)
+
+
+def _is_immutable_arg(value) -> bool:
+    if isinstance(value, tuple):
+        return all(_is_immutable_arg(x) for x in value)
+    return isinstance(value, _IMMUTABLE_ARG_TYPES)
+
+
+class _LazyQueueHandler(QueueHandler):
+    """
+    Обработчик очереди одного логгера. Запись кладется в очередь вместе с именем
+    логгера, обработчики которого должны ее записать: у записи, всплывшей от
+    дочернего логгера, в record.name будет имя дочернего логгера
+    """
+
+    def __init__(self, queue_: "queue.SimpleQueue", logger_name: str):
+        super().__init__(queue_)
+        self.logger_name = logger_name
+
+    # Стандартный QueueHandler форматирует сообщение в вызывающем потоке.
+    # Очередь используется только внутри процесса, поэтому запись передается
+    # как есть и форматируется уже в потоке QueueListener.
+    # NOTE: Изменяемые аргументы (списки, словари, модели и т.п.) к моменту записи
+    #       могут измениться, поэтому с ними сообщение форматируется сразу
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        args = record.args
+        if isinstance(args, dict):
+            args = tuple(args.values())
+
+        if args and not _is_immutable_arg(args):
+            # Та же запись может обрабатываться и другими обработчиками, поэтому копия
+            record = copy.copy(record)
+            record.msg = record.getMessage()
+            record.args = None
+
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        self.queue.put_nowait((self.logger_name, record))
+
+
+class _LoggerHandlersDispatcher:
+    """
+    Передает запись из очереди обработчикам логгера, чей обработчик очереди ее добавил.
+    QueueListener вызывает handle для каждого элемента очереди
+    """
+
+    def __init__(self):
+        self._name_by_handlers: dict[str, list[logging.Handler]] = dict()
+
+    def add_handlers(self, name: str, handlers: list[logging.Handler]):
+        self._name_by_handlers[name] = list(handlers)
+
+    def handle(self, item: tuple[str, logging.LogRecord]):
+        name, record = item
+        for handler in self._name_by_handlers.get(name, []):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+_LOG_QUEUE: "queue.SimpleQueue[tuple[str, logging.LogRecord]]" = queue.SimpleQueue()
+_LOG_DISPATCHER = _LoggerHandlersDispatcher()
+_LOG_LISTENER: Optional[QueueListener] = None
+_LOG_LISTENER_LOCK = threading.Lock()
+
+
+def start_log_listener():
+    global _LOG_LISTENER
+
+    with _LOG_LISTENER_LOCK:
+        if _LOG_LISTENER:
+            return
+
+        # Единственный поток, который пишет логи всех логгеров
+        _LOG_LISTENER = QueueListener(_LOG_QUEUE, _LOG_DISPATCHER)
+        _LOG_LISTENER.start()
+
+
+def stop_log_listener():
+    """
+    Остановка потока записи логов, перед остановкой записываются все записи из очереди
+    """
+
+    global _LOG_LISTENER
+
+    with _LOG_LISTENER_LOCK:
+        if not _LOG_LISTENER:
+            return
+
+        _LOG_LISTENER.stop()
+        _LOG_LISTENER = None
+
+
+# При завершении дописываем оставшиеся в очереди записи
+atexit.register(stop_log_listener)
+
+
+def _get_log_config_value(name: str, name_by_value: dict):
+    if name in name_by_value:
+        return name_by_value[name]
+    return name_by_value.get(Path(name).stem)
+
+
+def get_log_handlers(
     file: Union[str, Path] = "log.txt",
     encoding="utf-8",
     log_stdout=True,
     log_file=True,
-) -> "logging.Logger":
-    log = logging.getLogger(name)
-
-    # Возвращаем уже существующий логгер
-    if log.handlers:
-        return log
-
-    log.setLevel(logging.DEBUG)
-
+) -> list[logging.Handler]:
     formatter = logging.Formatter(
         "[%(asctime)s] %(filename)s:%(lineno)d %(levelname)-8s %(message)s"
     )
 
+    handlers = []
+
     if log_file:
         fh = RotatingFileHandler(
             file, maxBytes=10000000, backupCount=5, encoding=encoding
         )
         fh.setFormatter(formatter)
-        log.addHandler(fh)
+        handlers.append(fh)
 
     if log_stdout:
         sh = logging.StreamHandler(stream=sys.stdout)
         sh.setFormatter(formatter)
-        log.addHandler(sh)
+        handlers.append(sh)
+
+    return handlers
+
+
+def setup_logger(
+    log: logging.Logger,
+    handlers: list[logging.Handler],
+    queued: bool = LOG_QUEUED,
+):
+    """
+    Настройка уровня и выборки логгера по LOG_LEVELS и LOG_DEBUG_SAMPLING
+    и подключение обработчиков напрямую или через общую очередь
+    """
+
+    log.setLevel(_get_log_config_value(log.name, LOG_LEVELS) or logging.DEBUG)
+
+    rate = _get_log_config_value(log.name, LOG_DEBUG_SAMPLING)
+    if rate is not None:
+        log.addFilter(SamplingFilter(rate))
+
+    if queued:
+        _LOG_DISPATCHER.add_handlers(log.name, handlers)
+
+        # Повторная настройка логгера заменяет его обработчики, но не дублирует записи в очереди
+        if not any(isinstance(handler, _LazyQueueHandler) for handler in log.handlers):
+            log.addHandler(_LazyQueueHandler(_LOG_QUEUE, log.name))
+        start_log_listener()
+    else:
+        for handler in handlers:
+            log.addHandler(handler)
+
+
+def get_logger(
+    name: str,
+    file: Union[str, Path] = "log.txt",
+    encoding="utf-8",
+    log_stdout=True,
+    log_file=True,
+    queued: bool = LOG_QUEUED,
+) -> "logging.Logger":
+    log = logging.getLogger(name)
+
+    # Возвращаем уже существующий логгер
+    if log.handlers:
+        return log
+
+    handlers = get_log_handlers(file, encoding, log_stdout, log_file)
+    setup_logger(log, handlers, queued)
 
     return log
 
@@ -82,3 +250,41 @@ class MetalEnum(enum.Enum):
 
 
 DEFAULT_METAL = MetalEnum.GOLD
+
+
+class RollupPeriodEnum(enum.Enum):
+    WEEK = "неделя"
+    MONTH = "месяц"
+    YEAR = "год"
+
+    def get_period_start(self, date: DT.date) -> DT.date:
+        match self:
+            case RollupPeriodEnum.WEEK:
+                return date - DT.timedelta(days=date.weekday())
+            case RollupPeriodEnum.MONTH:
+                return date.replace(day=1)
+            case RollupPeriodEnum.YEAR:
+                return get_start_date(date.year)
+
+    def get_period_end(self, date: DT.date) -> DT.date:
+        match self:
+            case RollupPeriodEnum.WEEK:
+                return self.get_period_start(date) + DT.timedelta(days=6)
+            case RollupPeriodEnum.MONTH:
+                next_month = (date.replace(day=1) + DT.timedelta(days=31)).replace(day=1)
+                return next_month - DT.timedelta(days=1)
+            case RollupPeriodEnum.YEAR:
+                return get_end_date(date.year)
+
+
+class PriceAlertKindEnum(enum.Enum):
+    UP = "поднимется выше"
+    DOWN = "опустится ниже"
+    CHANGE = "изменится за день более чем на"
+
+
+class RecordKindEnum(enum.Enum):
+    # В порядке убывания значимости
+    ALL_TIME = "исторический"
+    WEEKS_52 = "за 52 недели"
+    YEAR = "с начала года"
@@ -4,6 +4,7 @@
 __author__ = "ipetrash"
 
 
+import os
 from pathlib import Path
 
 
@@ -18,3 +19,29 @@ DB_DIR_NAME.mkdir(parents=True, exist_ok=True)
 DB_FILE_NAME: str = str(DB_DIR_NAME / "database.sqlite")
 
 DATE_FORMAT: str = "%d/%m/%Y"
+
+# Запись логов в файлы и консоль выполняется в отдельном потоке через очередь,
+# чтобы потоки обработчиков не ждали ввода-вывода и ротации файлов
+LOG_QUEUED: bool = os.environ.get("LOG_QUEUED", "1") != "0"
+
+# Уровни логгеров, например: "common=INFO,werkzeug=WARNING".
+# Ключ - имя логгера или имя файла без расширения, для которого создан логгер
+LOG_LEVELS: dict[str, str] = {
+    name: value.upper()
+    for name, value in (
+        item.strip().split("=", maxsplit=1)
+        for item in os.environ.get("LOG_LEVELS", "").split(",")
+        if item.strip()
+    )
+}
+
+# Доля сохраняемых DEBUG-записей, например: "common=0.1".
+# Записи уровня INFO и выше сохраняются всегда
+LOG_DEBUG_SAMPLING: dict[str, float] = {
+    name: float(value)
+    for name, value in (
+        item.strip().split("=", maxsplit=1)
+        for item in os.environ.get("LOG_DEBUG_SAMPLING", "").split(",")
+        if item.strip()
+    )
+}
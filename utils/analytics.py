@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import datetime as DT
+import enum
+import math
+import threading
+
+from dataclasses import dataclass
+from typing import Optional
+
+# pip install numpy
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from db import MetalRate
+from root_common import MetalEnum, RollupPeriodEnum
+
+
+class AnalyticsMetricEnum(enum.Enum):
+    SMA = ("Скользящая средняя", True)
+    EMA = ("Экспоненциальная скользящая средняя", True)
+    VOLATILITY = ("Волатильность, %", False)
+    DRAWDOWN = ("Просадка, %", False)
+
+    def __init__(self, title: str, is_price_scale: bool):
+        self.title = title
+
+        # Значения метрики в тех же единицах, что и курс металла
+        self.is_price_scale = is_price_scale
+
+
+@dataclass
+class RatesHistory:
+    dates: np.ndarray  # datetime64[D]
+    metal_by_values: dict[MetalEnum, np.ndarray]  # float64, пропуски - NaN
+
+    def get_last_date(self) -> Optional[DT.date]:
+        return self.dates[-1].item() if len(self.dates) else None
+
+    def get_slice(self, number: int = -1, year: int = None) -> slice:
+        """
+        Срез по последним number значениям или по году, как у get_last_rates и get_all_by_year
+        """
+
+        if year:
+            start, end = np.searchsorted(
+                self.dates,
+                [np.datetime64(f"{year}-01-01"), np.datetime64(f"{year + 1}-01-01")],
+            )
+            return slice(start, end)
+
+        if number > 0:
+            return slice(max(len(self.dates) - number, 0), None)
+
+        return slice(None)
+
+
+def load_history() -> RatesHistory:
+    # Значения приводятся к REAL в запросе, чтобы не создавать Decimal для каждой ячейки
+    query = MetalRate.select(
+        MetalRate.date,
+        *[getattr(MetalRate, metal.name_lower).cast("REAL") for metal in MetalEnum],
+    ).order_by(MetalRate.date.asc())
+
+    rows = list(query.tuples())
+    if not rows:
+        return RatesHistory(
+            dates=np.array([], dtype="datetime64[D]"),
+            metal_by_values={metal: np.array([], dtype=float) for metal in MetalEnum},
+        )
+
+    dates, *columns = zip(*rows)
+    return RatesHistory(
+        dates=np.array(dates, dtype="datetime64[D]"),
+        metal_by_values={
+            # None превращается в NaN
+            metal: np.array(values, dtype=float)
+            for metal, values in zip(MetalEnum, columns)
+        },
+    )
+
+
+def fill_forward(values: np.ndarray) -> np.ndarray:
+    """
+    Замена пропусков предыдущим известным значением
+    """
+
+    mask = np.isnan(values)
+    if not mask.any():
+        return values
+
+    indexes = np.where(mask, 0, np.arange(len(values)))
+    np.maximum.accumulate(indexes, out=indexes)
+    return values[indexes]
+
+
+def get_sma(values: np.ndarray, window: int) -> np.ndarray:
+    values = fill_forward(values)
+
+    result = np.full(len(values), np.nan)
+    if window <= 0 or len(values) < window:
+        return result
+
+    cumsum = np.cumsum(np.insert(values, 0, 0.0))
+    result[window - 1:] = (cumsum[window:] - cumsum[:-window]) / window
+    return result
+
+
+def get_ema(values: np.ndarray, window: int) -> np.ndarray:
+    """
+    Экспоненциальная скользящая средняя с alpha = 2 / (window + 1).
+    Рекуррентная формула раскрывается в накопленную сумму со степенями (1 - alpha),
+    а чтобы степени не переполнялись, массив обрабатывается блоками
+    """
+
+    values = fill_forward(values)
+
+    result = np.full(len(values), np.nan)
+    if window <= 0 or not len(values):
+        return result
+
+    alpha = 2 / (window + 1)
+    decay = 1 - alpha
+    if not decay:
+        return values.copy()
+
+    # Длина блока, при которой decay ** -length не больше 1e100
+    length = max(1, int(100 / -math.log10(decay)))
+
+    prev = values[0]
+    for start in range(0, len(values), length):
+        chunk = values[start:start + length]
+        powers = decay ** np.arange(len(chunk))
+
+        # ema[i] = decay^(i+1) * prev + alpha * sum(decay^(i-k) * x[k]), k <= i
+        chunk_result = decay * powers * prev + alpha * powers * np.cumsum(chunk / powers)
+        result[start:start + len(chunk)] = chunk_result
+        prev = chunk_result[-1]
+
+    return result
+
+
+def get_returns(values: np.ndarray) -> np.ndarray:
+    """
+    Логарифмические доходности, первое значение - NaN
+    """
+
+    values = fill_forward(values)
+
+    result = np.full(len(values), np.nan)
+    if len(values) > 1:
+        result[1:] = np.diff(np.log(values))
+    return result
+
+
+def get_volatility(values: np.ndarray, window: int) -> np.ndarray:
+    """
+    Стандартное отклонение дневных логарифмических доходностей за окно, в процентах
+    """
+
+    returns = get_returns(values)
+
+    result = np.full(len(values), np.nan)
+    if window < 2 or len(returns) - 1 < window:
+        return result
+
+    result[window:] = sliding_window_view(returns[1:], window).std(axis=1, ddof=1) * 100
+    return result
+
+
+def get_drawdown(values: np.ndarray, window: int = None) -> np.ndarray:
+    """
+    Отклонение от максимума в процентах: за все время или за скользящее окно
+    """
+
+    values = fill_forward(values)
+    if not len(values):
+        return values
+
+    if window and window > 0:
+        peaks = np.full(len(values), np.nan)
+        if len(values) >= window:
+            peaks[window - 1:] = sliding_window_view(values, window).max(axis=1)
+
+        # Пока окно не заполнено, максимум считается с начала ряда
+        head = min(window - 1, len(values))
+        peaks[:head] = np.maximum.accumulate(values[:head])
+    else:
+        peaks = np.maximum.accumulate(values)
+
+    return (values / peaks - 1) * 100
+
+
+def get_period_last_indexes(dates: np.ndarray, period: RollupPeriodEnum) -> np.ndarray:
+    """
+    Индексы последних дат каждого периода, как даты закрытия в MetalRateRollup.
+    Даты должны быть отсортированы по возрастанию
+    """
+
+    if not len(dates):
+        return np.array([], dtype=int)
+
+    match period:
+        case RollupPeriodEnum.WEEK:
+            # 1970-01-01 - четверг, сдвиг на 3 дня делает началом недели понедельник
+            period_ids = (dates.astype("datetime64[D]").astype(np.int64) + 3) // 7
+        case RollupPeriodEnum.MONTH:
+            period_ids = dates.astype("datetime64[M]").astype(np.int64)
+        case RollupPeriodEnum.YEAR:
+            period_ids = dates.astype("datetime64[Y]").astype(np.int64)
+
+    return np.append(np.flatnonzero(np.diff(period_ids)), len(dates) - 1)
+
+
+_METRIC_BY_FUNC = {
+    AnalyticsMetricEnum.SMA: get_sma,
+    AnalyticsMetricEnum.EMA: get_ema,
+    AnalyticsMetricEnum.VOLATILITY: get_volatility,
+    AnalyticsMetricEnum.DRAWDOWN: get_drawdown,
+}
+
+
+class Analytics:
+    """
+    История курсов в виде массивов NumPy и кэш рассчитанных метрик.
+    История перезагружается при появлении новой последней даты, а результаты
+    кэшируются по (метрика, металл, окно, последняя дата)
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._history: Optional[RatesHistory] = None
+        self._key_by_result: dict[tuple, np.ndarray] = dict()
+
+    def get_history(self) -> RatesHistory:
+        last_date = MetalRate.get_last_dates(number=1)[0]
+
+        with self._lock:
+            if self._history is None or self._history.get_last_date() != last_date:
+                self._history = load_history()
+
+                # Результаты для прошлой последней даты больше не нужны
+                self._key_by_result.clear()
+
+            return self._history
+
+    def reset(self):
+        with self._lock:
+            self._history = None
+            self._key_by_result.clear()
+
+    def _get_cached(self, key: tuple, func) -> np.ndarray:
+        with self._lock:
+            result = self._key_by_result.get(key)
+            if result is None:
+                result = func()
+
+                # Закэшированный массив не должен изменяться снаружи
+                result.setflags(write=False)
+                self._key_by_result[key] = result
+
+            return result
+
+    def get_metric(
+        self,
+        metric: AnalyticsMetricEnum,
+        metal: MetalEnum,
+        window: int = None,
+    ) -> tuple[RatesHistory, np.ndarray]:
+        """
+        Значения метрики для всех дат истории
+        """
+
+        if window is None and metric != AnalyticsMetricEnum.DRAWDOWN:
+            raise ValueError(f"Для метрики {metric.name} нужно задать окно")
+
+        history = self.get_history()
+        key = metric, metal, window, history.get_last_date()
+
+        func = _METRIC_BY_FUNC[metric]
+        values = history.metal_by_values[metal]
+        result = self._get_cached(key, lambda: func(values, window))
+        return history, result
+
+    def get_correlations(self, window: int = None) -> tuple[list[MetalEnum], np.ndarray]:
+        """
+        Матрица корреляций дневных доходностей металлов за последние window дней
+        """
+
+        history = self.get_history()
+        metals = list(MetalEnum)
+        key = "CORRELATIONS", None, window, history.get_last_date()
+
+        def _calc() -> np.ndarray:
+            returns = np.vstack([get_returns(history.metal_by_values[metal]) for metal in metals])
+            returns = returns[:, 1:]
+            if window and window > 0:
+                returns = returns[:, -window:]
+
+            if returns.shape[1] < 2:
+                return np.full((len(metals), len(metals)), np.nan)
+
+            return np.corrcoef(returns)
+
+        return metals, self._get_cached(key, _calc)
+
+
+ANALYTICS = Analytics()
+
+
+if __name__ == "__main__":
+    history = ANALYTICS.get_history()
+    print(f"Dates: {len(history.dates)}, last date: {history.get_last_date()}")
+
+    for metric in AnalyticsMetricEnum:
+        _, values = ANALYTICS.get_metric(metric, MetalEnum.GOLD, window=20)
+        print(f"{metric.name}: {values[-3:]}")
+
+    metals, matrix = ANALYTICS.get_correlations(window=250)
+    print([metal.name for metal in metals])
+    print(matrix.round(2))
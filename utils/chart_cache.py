@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import hashlib
+import threading
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Hashable
+
+from utils.single_flight import SingleFlight
+
+
+class ChartRenderBusyError(Exception):
+    """
+    Все слоты для рисования заняты дольше допустимого времени ожидания
+    """
+
+
+@dataclass(frozen=True)
+class ChartImage:
+    data: bytes
+    etag: str
+
+
+class ChartCache:
+    """
+    Общий кэш нарисованных графиков. Ключи задаются вызывающим кодом, а при смене
+    версии данных (например, последней даты курсов) кэш очищается.
+    Одинаковые одновременные запросы ждут одно рисование, а количество одновременных
+    рисований ограничено, чтобы всплеск запросов не запускал десятки рисований сразу
+    """
+
+    def __init__(self, max_items: int = 128, max_renders: int = 2, render_timeout_secs: float = 10):
+        self.max_items = max_items
+        self.render_timeout_secs = render_timeout_secs
+
+        self._lock = threading.Lock()
+        self._version: Hashable = None
+        self._key_by_image: OrderedDict[Hashable, ChartImage] = OrderedDict()
+        self._single_flight = SingleFlight()
+        self._render_semaphore = threading.BoundedSemaphore(max_renders)
+
+        self.hits: int = 0
+        self.renders: int = 0
+
+    def _get_cached(self, key: Hashable, version: Hashable) -> ChartImage:
+        # NOTE: Вызывается под self._lock
+        if version != self._version:
+            self._version = version
+            self._key_by_image.clear()
+
+        image = self._key_by_image.get(key)
+        if image:
+            self._key_by_image.move_to_end(key)
+            self.hits += 1
+        return image
+
+    def get(self, key: Hashable, version: Hashable, render: Callable[[], bytes]) -> ChartImage:
+        with self._lock:
+            image = self._get_cached(key, version)
+            if image:
+                return image
+
+        # Ожидающие запросы получат тот же график или ту же ошибку
+        image, _ = self._single_flight.do(
+            (version, key), lambda: self._render(key, version, render)
+        )
+        return image
+
+    def _render(self, key: Hashable, version: Hashable, render: Callable[[], bytes]) -> ChartImage:
+        # График мог нарисовать запрос, который закончился после проверки кэша в get
+        with self._lock:
+            image = self._get_cached(key, version)
+            if image:
+                return image
+
+        if not self._render_semaphore.acquire(timeout=self.render_timeout_secs):
+            raise ChartRenderBusyError()
+
+        try:
+            data = render()
+        finally:
+            self._render_semaphore.release()
+
+        image = ChartImage(data=data, etag=hashlib.sha1(data).hexdigest())
+
+        with self._lock:
+            self.renders += 1
+
+            # Данные могли обновиться во время рисования
+            if version == self._version:
+                self._key_by_image[key] = image
+                while len(self._key_by_image) > self.max_items:
+                    self._key_by_image.popitem(last=False)
+
+        return image
+
+    def clear(self):
+        with self._lock:
+            self._version = None
+            self._key_by_image.clear()
@@ -5,23 +5,135 @@ __author__ = "ipetrash"
 
 
 import datetime as DT
+import enum
 from io import BytesIO
 
 from decimal import Decimal
 from pathlib import Path
-from typing import BinaryIO, Union
+from typing import BinaryIO, Iterable, Optional, Sequence, Union
 
 # pip install matplotlib
 import matplotlib.dates as mdates
+from matplotlib.axes import Axes
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.figure import Figure
 
-from db import MetalRate
+# pip install numpy
+import numpy as np
+
+# pip install pillow
+from PIL import Image
+
+from db import MetalRate, MetalRateYear
+from utils.analytics import (
+    ANALYTICS,
+    AnalyticsMetricEnum,
+    fill_forward,
+    get_period_last_indexes,
+)
 from root_config import DATE_FORMAT
-from root_common import get_date_str, MetalEnum
+from root_common import (
+    get_date_str,
+    get_start_date,
+    get_end_date,
+    MetalEnum,
+    RollupPeriodEnum,
+)
 
 
-def draw_plot(
+# Цвета дополнительных линий, не совпадающие с цветами металлов
+OVERLAY_COLORS: tuple[str, ...] = ("tab:blue", "tab:red", "tab:purple", "tab:brown")
+
+# Количество цветов палитры PNG: линии со сглаживанием без заметных искажений
+QUANTIZE_COLORS: int = 64
+
+
+class NoDataError(Exception):
+    """
+    Нет курсов для рисования графика
+    """
+
+
+class ChartEncodingEnum(enum.Enum):
+    PNG = "png"
+
+    # PNG с палитрой: на графике мало цветов, поэтому файл в несколько раз меньше
+    PNG_QUANTIZED = "png_quantized"
+
+    # WebP без потерь, сжатие с потерями размывает тонкие линии
+    WEBP = "webp"
+
+    @property
+    def mime_type(self) -> str:
+        return "image/webp" if self == ChartEncodingEnum.WEBP else "image/png"
+
+    @property
+    def extension(self) -> str:
+        return "webp" if self == ChartEncodingEnum.WEBP else "png"
+
+
+class ChartPresetEnum(enum.Enum):
+    """
+    Формат, DPI и размер графика в дюймах для разных получателей
+    """
+
+    # Как у matplotlib по умолчанию: 640x480
+    DEFAULT = (ChartEncodingEnum.PNG, 100, (6.4, 4.8))
+
+    # Telegram все равно пережимает фото, поэтому важнее размер загружаемого файла
+    TELEGRAM = (ChartEncodingEnum.PNG_QUANTIZED, 100, (6.4, 4.8))
+
+    # 960x720 для экранов с высокой плотностью пикселей
+    WEB = (ChartEncodingEnum.PNG_QUANTIZED, 150, (6.4, 4.8))
+    WEB_WEBP = (ChartEncodingEnum.WEBP, 150, (6.4, 4.8))
+
+    def __init__(self, encoding: ChartEncodingEnum, dpi: int, size: tuple[float, float]):
+        self.encoding = encoding
+        self.dpi = dpi
+        self.size = size
+
+
+def _get_figure(
+    preset: ChartPresetEnum = ChartPresetEnum.DEFAULT,
+    locator: mdates.DateLocator = None,
+    date_format: str = DATE_FORMAT,
+) -> tuple[Figure, Axes]:
+    if not locator:
+        locator = mdates.AutoDateLocator()
+
+    fig = Figure(figsize=preset.size, dpi=preset.dpi)
+    ax = fig.subplots()
+    ax.xaxis.set_major_formatter(mdates.DateFormatter(date_format))
+    ax.xaxis.set_major_locator(locator)
+
+    return fig, ax
+
+
+def save_figure(
+    fig: Figure,
     out: Union[str, Path, BinaryIO],
+    encoding: ChartEncodingEnum = ChartEncodingEnum.PNG,
+):
+    if encoding == ChartEncodingEnum.PNG:
+        fig.savefig(out, format="png")
+    else:
+        canvas = FigureCanvasAgg(fig)
+        canvas.draw()
+        img = Image.fromarray(np.asarray(canvas.buffer_rgba())).convert("RGB")
+
+        if encoding == ChartEncodingEnum.PNG_QUANTIZED:
+            # FASTOCTREE заметно быстрее MEDIANCUT, а файл получается даже меньше
+            img = img.quantize(colors=QUANTIZE_COLORS, method=Image.Quantize.FASTOCTREE)
+            img.save(out, format="PNG")
+        else:
+            img.save(out, format="WEBP", lossless=True)
+
+    # После записи в файловый объект нужно внутренний указатель переместить в начало, иначе read не будет работать
+    if hasattr(out, "seek"):  # Для BinaryIO и ему подобных
+        out.seek(0)
+
+
+def get_plot_figure(
     days: list[DT.date],
     values: list[Decimal],
     locator: mdates.DateLocator = None,
@@ -29,18 +141,39 @@ def draw_plot(
     color: str = "orange",
     date_format: str = DATE_FORMAT,
     axis_off: bool = False,
-):
-    if not locator:
-        locator = mdates.AutoDateLocator()
+    overlays: list[tuple[str, Sequence, bool]] = None,
+    preset: ChartPresetEnum = ChartPresetEnum.DEFAULT,
+) -> Figure:
+    """
+    overlays - дополнительные линии (название, значения, в единицах курса ли значения).
+    Значения не в единицах курса рисуются по второй оси
+    """
 
-    fig = Figure()
-    ax = fig.subplots()
-    ax.xaxis.set_major_formatter(mdates.DateFormatter(date_format))
-    ax.xaxis.set_major_locator(locator)
+    fig, ax = _get_figure(preset, locator, date_format)
 
     lines = ax.plot(days, values)[0]
     lines.set_color(color)
 
+    if overlays:
+        ax_secondary = None
+        for i, (overlay_title, overlay_values, is_price_scale) in enumerate(overlays):
+            overlay_color = OVERLAY_COLORS[i % len(OVERLAY_COLORS)]
+            if is_price_scale:
+                ax.plot(days, overlay_values, linewidth=1, color=overlay_color, label=overlay_title)
+            else:
+                if not ax_secondary:
+                    ax_secondary = ax.twinx()
+                ax_secondary.plot(
+                    days, overlay_values, linewidth=1, linestyle="--", color=overlay_color, label=overlay_title
+                )
+
+        handles, labels = ax.get_legend_handles_labels()
+        if ax_secondary:
+            secondary_handles, secondary_labels = ax_secondary.get_legend_handles_labels()
+            handles += secondary_handles
+            labels += secondary_labels
+        ax.legend(handles, labels, loc="upper left", fontsize="small")
+
     if title:
         ax.set_xlabel(title)
 
@@ -50,36 +183,201 @@ def draw_plot(
         ax.set_xticks([])
         ax.set_yticks([])
 
-    fig.savefig(out, format="png")
+    return fig
 
-    # После записи в файловый объект нужно внутренний указатель переместить в начало, иначе read не будет работать
-    if hasattr(out, "seek"):  # Для BinaryIO и ему подобных
-        out.seek(0)
+
+def draw_plot(
+    out: Union[str, Path, BinaryIO],
+    days: list[DT.date],
+    values: list[Decimal],
+    locator: mdates.DateLocator = None,
+    title: str = None,
+    color: str = "orange",
+    date_format: str = DATE_FORMAT,
+    axis_off: bool = False,
+    overlays: list[tuple[str, Sequence, bool]] = None,
+    preset: ChartPresetEnum = ChartPresetEnum.DEFAULT,
+):
+    fig = get_plot_figure(
+        days=days,
+        values=values,
+        locator=locator,
+        title=title,
+        color=color,
+        date_format=date_format,
+        axis_off=axis_off,
+        overlays=overlays,
+        preset=preset,
+    )
+    save_figure(fig, out, preset.encoding)
+
+
+def get_comparison_figure(
+    days: Sequence,
+    metal_by_values: dict[MetalEnum, np.ndarray],
+    locator: mdates.DateLocator = None,
+    title: str = None,
+    date_format: str = DATE_FORMAT,
+    normalized: bool = True,
+    preset: ChartPresetEnum = ChartPresetEnum.DEFAULT,
+) -> Figure:
+    """
+    Все металлы на одном графике: значения в процентах от первого значения (100 - начало
+    диапазона) или в рублях, тогда металлы с намного меньшими ценами рисуются по второй оси
+    """
+
+    fig, ax = _get_figure(preset, locator, date_format)
+
+    metal_by_values = {
+        metal: np.asarray(values, dtype=float)
+        for metal, values in metal_by_values.items()
+        if np.isfinite(np.asarray(values, dtype=float)).any()
+    }
+
+    ax_secondary = None
+    if normalized:
+        for metal, values in metal_by_values.items():
+            first_value = values[np.isfinite(values)][0]
+            ax.plot(days, values / first_value * 100, color=metal.color, label=metal.singular)
+
+        ax.axhline(100, color="gray", linewidth=0.5, linestyle=":")
+
+    elif metal_by_values:
+        max_value = max(np.nanmax(values) for values in metal_by_values.values())
+        for metal, values in metal_by_values.items():
+            # Например, серебро на фоне остальных металлов выглядело бы прямой линией
+            if np.nanmax(values) * 10 < max_value:
+                if not ax_secondary:
+                    ax_secondary = ax.twinx()
+                ax_secondary.plot(
+                    days, values, linestyle="--", color=metal.color, label=metal.singular
+                )
+            else:
+                ax.plot(days, values, color=metal.color, label=metal.singular)
+
+    handles, labels = ax.get_legend_handles_labels()
+    if ax_secondary:
+        secondary_handles, secondary_labels = ax_secondary.get_legend_handles_labels()
+        handles += secondary_handles
+        labels += secondary_labels
+    if handles:
+        ax.legend(handles, labels, loc="upper left", fontsize="small")
+
+    if title:
+        ax.set_xlabel(title)
+
+    fig.autofmt_xdate()
+
+    return fig
+
+
+def draw_plot_comparison(
+    out: Union[str, Path, BinaryIO],
+    days: Sequence,
+    metal_by_values: dict[MetalEnum, np.ndarray],
+    locator: mdates.DateLocator = None,
+    title: str = None,
+    date_format: str = DATE_FORMAT,
+    normalized: bool = True,
+    preset: ChartPresetEnum = ChartPresetEnum.DEFAULT,
+):
+    fig = get_comparison_figure(
+        days=days,
+        metal_by_values=metal_by_values,
+        locator=locator,
+        title=title,
+        date_format=date_format,
+        normalized=normalized,
+        preset=preset,
+    )
+    save_figure(fig, out, preset.encoding)
 
 
 def get_plot_for_metal(
     metal: MetalEnum,
     number: int = -1,
     year: int = None,
+    period: RollupPeriodEnum = None,
     title_format: str = "Стоимость грамма {metal_name} в рублях за {start_date} - {end_date}",
+    overlays: Iterable[tuple[AnalyticsMetricEnum, Optional[int]]] = None,
+    preset: ChartPresetEnum = ChartPresetEnum.DEFAULT,
 ) -> BytesIO:
-    if year:
-        rates = MetalRate.get_all_by_year(year=year)
+    """
+    overlays - метрики из utils.analytics с окном, которые будут нарисованы поверх курса.
+    Если курсов нет, будет выброшено NoDataError
+    """
+
+    history = ANALYTICS.get_history()
+
+    rollups = []
+    if period:
+        # Вместо значений за каждый день - цены закрытия периодов
+        if year:
+            rollups = MetalRate.get_rollups(
+                metal=metal,
+                period=period,
+                start_date=get_start_date(year),
+                end_date=get_end_date(year),
+            )
+        else:
+            rollups = MetalRate.get_rollups(metal=metal, period=period)
+            if number > 0:
+                rollups = rollups[-number:]
+
+    # Если сводные данные по периодам еще не посчитаны, график строится по дням
+    if rollups:
+        days = [rollup.last_date for rollup in rollups]
+        values = [rollup.close for rollup in rollups]
+
+        # Первая точка - закрытие периода, но сам период начинается раньше
+        start_date, end_date = rollups[0].first_date, days[-1]
+
+        # Индексы дат закрытия периодов в истории для значений метрик
+        indexes = np.searchsorted(history.dates, np.array(days, dtype="datetime64[D]"))
+
     else:
-        rates = MetalRate.get_last_rates(number=number)
+        # Срез массивов истории вместо обхода строк таблицы
+        indexes = np.arange(len(history.dates))[history.get_slice(number=number, year=year)]
 
-    days = []
-    values = []
-    for metal_rate in rates:
-        days.append(metal_rate.date)
-        values.append(getattr(metal_rate, metal.name_lower))
+        # Дни без курса металла пропускаются. Как у get_last_rates с ignore_null,
+        # для последних дней должны быть заданы все металлы
+        metals = [metal] if year else list(MetalEnum)
+        mask = np.ones(len(indexes), dtype=bool)
+        for filter_metal in metals:
+            mask &= ~np.isnan(history.metal_by_values[filter_metal][indexes])
+        indexes = indexes[mask]
+
+        if not len(indexes):
+            raise NoDataError(f"Нет курсов для {metal.name}")
+
+        days = history.dates[indexes]
+        values = history.metal_by_values[metal][indexes]
+
+        start_date, end_date = days[0].item(), days[-1].item()
+
+    if year:
+        year_info = MetalRateYear.get_by(year)
+        if year_info:
+            start_date, end_date = year_info.min_date, year_info.max_date
 
     title = title_format.format(
         metal_name=metal.plural,
-        start_date=get_date_str(days[0]),
-        end_date=get_date_str(days[-1]),
+        start_date=get_date_str(start_date),
+        end_date=get_date_str(end_date),
     )
 
+    plot_overlays = []
+    for metric, window in overlays or []:
+        _, metric_values = ANALYTICS.get_metric(metric, metal, window)
+
+        overlay_title = metric.title
+        if window:
+            overlay_title += f" ({window})"
+
+        plot_overlays.append(
+            (overlay_title, metric_values[indexes], metric.is_price_scale)
+        )
+
     bytes_io = BytesIO()
     draw_plot(
         out=bytes_io,
@@ -87,6 +385,67 @@ def get_plot_for_metal(
         values=values,
         title=title,
         color=metal.color,
+        overlays=plot_overlays,
+        preset=preset,
+    )
+    return bytes_io
+
+
+def get_plot_for_metals(
+    number: int = -1,
+    year: int = None,
+    period: RollupPeriodEnum = None,
+    normalized: bool = True,
+    preset: ChartPresetEnum = ChartPresetEnum.DEFAULT,
+) -> BytesIO:
+    """
+    Сравнение всех металлов на одном графике. Значения берутся из уже загруженной
+    истории курсов, поэтому для всех металлов нужен только один запрос
+    """
+
+    history = ANALYTICS.get_history()
+
+    indexes = np.arange(len(history.dates))[history.get_slice(number=number, year=year)]
+    if not len(indexes):
+        raise NoDataError("Нет курсов")
+
+    # Первая точка может быть закрытием периода, но сам период начинается раньше
+    start_date, end_date = history.dates[indexes[0]].item(), history.dates[indexes[-1]].item()
+
+    if period:
+        # Вместо значений за каждый день - цены закрытия периодов
+        indexes = indexes[get_period_last_indexes(history.dates[indexes], period)]
+
+    days = history.dates[indexes]
+    metal_by_values = {
+        # Пропуски заменяются предыдущими значениями, как у цен закрытия периодов
+        metal: fill_forward(history.metal_by_values[metal])[indexes]
+        for metal in MetalEnum
+    }
+
+    if year:
+        year_info = MetalRateYear.get_by(year)
+        if year_info:
+            start_date, end_date = year_info.min_date, year_info.max_date
+
+    if normalized:
+        title_format = "Стоимость металлов за {start_date} - {end_date}, % от начала"
+    else:
+        title_format = "Стоимость грамма металлов в рублях за {start_date} - {end_date}"
+
+    title = title_format.format(
+        start_date=get_date_str(start_date),
+        end_date=get_date_str(end_date),
+    )
+
+    bytes_io = BytesIO()
+    draw_plot_comparison(
+        out=bytes_io,
+        days=days,
+        metal_by_values=metal_by_values,
+        title=title,
+        normalized=normalized,
+        preset=preset,
     )
     return bytes_io
 
@@ -119,9 +478,9 @@ if __name__ == "__main__":
 
     days = []
     values = []
-    for metal_rate in MetalRate.select():
-        days.append(metal_rate.date)
-        values.append(metal_rate.gold)
+    for date, gold in MetalRate.select(MetalRate.date, MetalRate.gold).tuples():
+        days.append(date)
+        values.append(gold)
 
     title = f"Стоимость грамма золота в рублях за {get_date_str(days[0])} - {get_date_str(days[-1])}"
 
@@ -133,6 +492,11 @@ if __name__ == "__main__":
         title=title,
     )
 
+    for normalized in (True, False):
+        path = images_dir / f"get_plot_for_metals_normalized{int(normalized)}.png"
+        photo = get_plot_for_metals(number=-1, period=RollupPeriodEnum.WEEK, normalized=normalized)
+        path.write_bytes(photo.read())
+
     metal = MetalEnum.GOLD
     last_year = MetalRate.get_last_date().year
     for year in (last_year - 1, last_year):
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+"""
+Сравнение форматов графиков: размер файла и время кодирования для каждого
+ChartPresetEnum на типичных графиках бота.
+
+Запуск: python -m utils.draw_plot_benchmark --repeat 10
+"""
+
+
+import argparse
+import statistics
+import time
+
+from io import BytesIO
+from typing import Callable
+
+from matplotlib.figure import Figure
+
+from root_common import MetalEnum, RollupPeriodEnum
+from utils.analytics import ANALYTICS, fill_forward, get_period_last_indexes
+from utils.draw_plot import (
+    ChartPresetEnum,
+    get_comparison_figure,
+    get_plot_figure,
+    save_figure,
+)
+
+
+def get_figure_factories() -> list[tuple[str, Callable[[ChartPresetEnum], Figure]]]:
+    history = ANALYTICS.get_history()
+    metal = MetalEnum.GOLD
+
+    def get_slice_figure(indexes, preset: ChartPresetEnum) -> Figure:
+        return get_plot_figure(
+            days=history.dates[indexes],
+            values=history.metal_by_values[metal][indexes],
+            color=metal.color,
+            title="title",
+            preset=preset,
+        )
+
+    last_31 = history.get_slice(number=31)
+    last_year = history.get_slice(year=history.get_last_date().year)
+    all_weeks = get_period_last_indexes(history.dates, RollupPeriodEnum.WEEK)
+
+    return [
+        ("31 days", lambda preset: get_slice_figure(last_31, preset)),
+        ("year", lambda preset: get_slice_figure(last_year, preset)),
+        ("all (weeks)", lambda preset: get_slice_figure(all_weeks, preset)),
+        (
+            "comparison",
+            lambda preset: get_comparison_figure(
+                days=history.dates[all_weeks],
+                metal_by_values={
+                    metal: fill_forward(values)[all_weeks]
+                    for metal, values in history.metal_by_values.items()
+                },
+                title="title",
+                preset=preset,
+            ),
+        ),
+    ]
+
+
+def run(repeat: int):
+    print(f"{'Chart':<12} {'Preset':<10} {'Size':>8} {'Bytes':>8} {'Encode, ms':>11} {'Total, ms':>10}")
+
+    for title, get_figure in get_figure_factories():
+        for preset in ChartPresetEnum:
+            sizes = []
+            encode_times = []
+            total_times = []
+            for _ in range(repeat):
+                start_time = time.perf_counter()
+                fig = get_figure(preset)
+
+                encode_start_time = time.perf_counter()
+                out = BytesIO()
+                save_figure(fig, out, preset.encoding)
+                end_time = time.perf_counter()
+
+                sizes.append(len(out.getvalue()))
+                encode_times.append((end_time - encode_start_time) * 1000)
+                total_times.append((end_time - start_time) * 1000)
+
+            width, height = (int(x * preset.dpi) for x in preset.size)
+            print(
+                f"{title:<12} {preset.name:<10} {f'{width}x{height}':>8} "
+                f"{statistics.median(sizes):>8.0f} "
+                f"{statistics.median(encode_times):>11.1f} "
+                f"{statistics.median(total_times):>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5, help="Количество повторов для каждого графика")
+    args = parser.parse_args()
+
+    run(args.repeat)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import datetime as DT
+import math
+
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from root_common import MetalEnum
+
+
+@dataclass
+class RateStats:
+    metal: MetalEnum
+    start_date: DT.date
+    end_date: DT.date
+    count: int
+    min_value: float
+    min_date: DT.date
+    max_value: float
+    max_date: DT.date
+    avg_value: float
+
+
+class _SparseTable:
+    """
+    Разреженная таблица индексов минимумов (или максимумов): на уровне k для позиции i
+    хранится индекс лучшего значения на отрезке [i, i + 2^k). Запрос по любому
+    отрезку выполняется за O(1), добавление значения в конец - за O(log n)
+    """
+
+    def __init__(self, values: list[float], is_min: bool):
+        self.values = values
+        self.is_min = is_min
+        self.levels: list[list[int]] = [[]]
+
+    def _best(self, i: int, j: int) -> int:
+        if self.is_min:
+            return i if self.values[i] <= self.values[j] else j
+        return i if self.values[i] >= self.values[j] else j
+
+    def append(self):
+        """
+        Учет значения, уже добавленного в конец self.values
+        """
+
+        n = len(self.values)
+        self.levels[0].append(n - 1)
+
+        k = 1
+        while (1 << k) <= n:
+            if len(self.levels) == k:
+                self.levels.append([])
+
+            # Новый отрезок длины 2^k, заканчивающийся на последнем значении
+            level_prev = self.levels[k - 1]
+            i = n - (1 << k)
+            self.levels[k].append(
+                self._best(level_prev[i], level_prev[i + (1 << (k - 1))])
+            )
+            k += 1
+
+    def query(self, i: int, j: int) -> int:
+        k = (j - i + 1).bit_length() - 1
+        level = self.levels[k]
+        return self._best(level[i], level[j - (1 << k) + 1])
+
+
+class RateStatsIndex:
+    """
+    Индекс для получения минимума, максимума и среднего по металлу за произвольный
+    диапазон дат: префиксные суммы для среднего и разреженные таблицы для
+    минимума и максимума. Курсы добавляются только в конец, по возрастанию дат
+    """
+
+    def __init__(self):
+        self.dates: list[DT.date] = []
+
+        # Пропущенные значения не участвуют в минимуме и максимуме
+        # за счет бесконечностей и не учитываются в префиксных суммах
+        self._metal_by_min_values: dict[MetalEnum, list[float]] = dict()
+        self._metal_by_max_values: dict[MetalEnum, list[float]] = dict()
+        self._metal_by_prefix_sums: dict[MetalEnum, list[float]] = dict()
+        self._metal_by_prefix_counts: dict[MetalEnum, list[int]] = dict()
+        self._metal_by_min_table: dict[MetalEnum, _SparseTable] = dict()
+        self._metal_by_max_table: dict[MetalEnum, _SparseTable] = dict()
+
+        for metal in MetalEnum:
+            self._metal_by_min_values[metal] = []
+            self._metal_by_max_values[metal] = []
+            self._metal_by_prefix_sums[metal] = [0.0]
+            self._metal_by_prefix_counts[metal] = [0]
+            self._metal_by_min_table[metal] = _SparseTable(self._metal_by_min_values[metal], is_min=True)
+            self._metal_by_max_table[metal] = _SparseTable(self._metal_by_max_values[metal], is_min=False)
+
+    def get_last_date(self) -> Optional[DT.date]:
+        return self.dates[-1] if self.dates else None
+
+    def append(self, date: DT.date, metal_by_value: dict[MetalEnum, Optional[float]]):
+        last_date = self.get_last_date()
+        if last_date and date <= last_date:
+            raise ValueError(f"Дата {date} должна быть больше последней даты {last_date}")
+
+        self.dates.append(date)
+
+        for metal in MetalEnum:
+            value = metal_by_value.get(metal)
+            if value is not None:
+                value = float(value)
+
+            self._metal_by_min_values[metal].append(math.inf if value is None else value)
+            self._metal_by_max_values[metal].append(-math.inf if value is None else value)
+
+            prefix_sums = self._metal_by_prefix_sums[metal]
+            prefix_counts = self._metal_by_prefix_counts[metal]
+            prefix_sums.append(prefix_sums[-1] + (value or 0.0))
+            prefix_counts.append(prefix_counts[-1] + (value is not None))
+
+            self._metal_by_min_table[metal].append()
+            self._metal_by_max_table[metal].append()
+
+    def extend(self, rows: Iterable[tuple]):
+        """
+        Добавление строк вида (дата, золото, серебро, платина, палладий)
+        """
+
+        for date, *values in rows:
+            self.append(date, dict(zip(MetalEnum, values)))
+
+    def get_stats(
+        self,
+        metal: MetalEnum,
+        start_date: DT.date = None,
+        end_date: DT.date = None,
+    ) -> Optional[RateStats]:
+        i = bisect_left(self.dates, start_date) if start_date else 0
+        j = (bisect_right(self.dates, end_date) if end_date else len(self.dates)) - 1
+        if i > j:
+            return None
+
+        prefix_counts = self._metal_by_prefix_counts[metal]
+        count = prefix_counts[j + 1] - prefix_counts[i]
+        if not count:
+            return None
+
+        prefix_sums = self._metal_by_prefix_sums[metal]
+        min_index = self._metal_by_min_table[metal].query(i, j)
+        max_index = self._metal_by_max_table[metal].query(i, j)
+
+        return RateStats(
+            metal=metal,
+            start_date=self.dates[i],
+            end_date=self.dates[j],
+            count=count,
+            min_value=self._metal_by_min_values[metal][min_index],
+            min_date=self.dates[min_index],
+            max_value=self._metal_by_max_values[metal][max_index],
+            max_date=self.dates[max_index],
+            avg_value=(prefix_sums[j + 1] - prefix_sums[i]) / count,
+        )
+
+
+if __name__ == "__main__":
+    import random
+
+    index = RateStatsIndex()
+    start_date = DT.date(2022, 1, 1)
+    for i in range(100):
+        index.append(
+            start_date + DT.timedelta(days=i),
+            {metal: random.uniform(1000, 5000) for metal in MetalEnum},
+        )
+
+    print(index.get_stats(MetalEnum.GOLD, DT.date(2022, 1, 10), DT.date(2022, 2, 10)))
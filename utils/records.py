@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import datetime as DT
+
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+from root_common import MetalEnum, RecordKindEnum
+
+
+@dataclass
+class Record:
+    date: DT.date
+    metal: MetalEnum
+    kind: RecordKindEnum
+    is_high: bool
+    value: float
+    prev_value: float
+
+
+class MonotonicDeque:
+    """
+    Максимум (или минимум) значений в скользящем окне дат: значения в очереди
+    монотонны, поэтому текущий экстремум всегда в начале очереди, а каждое
+    значение добавляется и удаляется не больше одного раза
+    """
+
+    def __init__(self, is_max: bool):
+        self.is_max = is_max
+        self.items: deque[tuple[DT.date, float]] = deque()
+
+    def _is_dominated(self, value: float, new_value: float) -> bool:
+        return value <= new_value if self.is_max else value >= new_value
+
+    def push(self, date: DT.date, value: float):
+        while self.items and self._is_dominated(self.items[-1][1], value):
+            self.items.pop()
+        self.items.append((date, value))
+
+    def evict(self, min_date: DT.date):
+        """
+        Удаление значений с датами раньше min_date
+        """
+
+        while self.items and self.items[0][0] < min_date:
+            self.items.popleft()
+
+    def get(self) -> Optional[float]:
+        return self.items[0][1] if self.items else None
+
+
+class _MetalExtrema:
+    def __init__(self):
+        self.all_time_min: Optional[float] = None
+        self.all_time_max: Optional[float] = None
+
+        self.year: Optional[int] = None
+        self.year_min: Optional[float] = None
+        self.year_max: Optional[float] = None
+
+        self.window_min = MonotonicDeque(is_max=False)
+        self.window_max = MonotonicDeque(is_max=True)
+
+
+class RecordTracker:
+    """
+    Текущие экстремумы каждого металла: за все время, с начала года и за
+    скользящее окно в 52 недели. Курсы добавляются по возрастанию дат, для каждого
+    нового курса возвращаются побитые рекорды
+    """
+
+    def __init__(self, window: DT.timedelta = DT.timedelta(weeks=52)):
+        self.window = window
+        self._metal_by_extrema: dict[MetalEnum, _MetalExtrema] = {
+            metal: _MetalExtrema() for metal in MetalEnum
+        }
+
+    def get_window_start(self, date: DT.date) -> DT.date:
+        """
+        Первая дата окна, в котором проверяется рекорд для date
+        """
+
+        return date - self.window + DT.timedelta(days=1)
+
+    def set_all_time(self, metal: MetalEnum, min_value: float, max_value: float):
+        """
+        Начальные значения экстремумов за все время, например, из сводной таблицы по годам
+        """
+
+        extrema = self._metal_by_extrema[metal]
+        if min_value is not None:
+            extrema.all_time_min = _get_min(extrema.all_time_min, float(min_value))
+        if max_value is not None:
+            extrema.all_time_max = _get_max(extrema.all_time_max, float(max_value))
+
+    def add(
+        self,
+        date: DT.date,
+        metal_by_value: dict[MetalEnum, Optional[float]],
+        detect: bool = True,
+    ) -> list[Record]:
+        records = []
+
+        for metal, value in metal_by_value.items():
+            if value is None:
+                continue
+
+            value = float(value)
+            extrema = self._metal_by_extrema[metal]
+
+            if extrema.year != date.year:
+                extrema.year = date.year
+                extrema.year_min = extrema.year_max = None
+
+            extrema.window_min.evict(self.get_window_start(date))
+            extrema.window_max.evict(self.get_window_start(date))
+
+            if detect:
+                # Для каждого направления сохраняется только самый значимый рекорд.
+                # Рекорд возможен только если до него уже были значения
+                for is_high, prev_values in [
+                    (True, [
+                        (RecordKindEnum.ALL_TIME, extrema.all_time_max),
+                        (RecordKindEnum.WEEKS_52, extrema.window_max.get()),
+                        (RecordKindEnum.YEAR, extrema.year_max),
+                    ]),
+                    (False, [
+                        (RecordKindEnum.ALL_TIME, extrema.all_time_min),
+                        (RecordKindEnum.WEEKS_52, extrema.window_min.get()),
+                        (RecordKindEnum.YEAR, extrema.year_min),
+                    ]),
+                ]:
+                    for kind, prev_value in prev_values:
+                        if prev_value is None:
+                            continue
+
+                        if (value > prev_value) if is_high else (value < prev_value):
+                            records.append(
+                                Record(
+                                    date=date,
+                                    metal=metal,
+                                    kind=kind,
+                                    is_high=is_high,
+                                    value=value,
+                                    prev_value=prev_value,
+                                )
+                            )
+                            break
+
+            extrema.all_time_min = _get_min(extrema.all_time_min, value)
+            extrema.all_time_max = _get_max(extrema.all_time_max, value)
+            extrema.year_min = _get_min(extrema.year_min, value)
+            extrema.year_max = _get_max(extrema.year_max, value)
+            extrema.window_min.push(date, value)
+            extrema.window_max.push(date, value)
+
+        return records
+
+
+def _get_min(a: Optional[float], b: float) -> float:
+    return b if a is None else min(a, b)
+
+
+def _get_max(a: Optional[float], b: float) -> float:
+    return b if a is None else max(a, b)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import threading
+
+from typing import Any, Callable, Hashable, Optional
+
+
+class SingleFlight:
+    """
+    Одновременные вызовы с одинаковым ключом не выполняются повторно,
+    а дожидаются результата уже выполняющегося вызова
+    """
+
+    class _Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result: Any = None
+            self.error: Optional[BaseException] = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key_by_call: dict[Hashable, SingleFlight._Call] = dict()
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> tuple[Any, bool]:
+        """
+        Возвращает результат и признак того, что он был получен другим вызовом
+        """
+
+        with self._lock:
+            call = self._key_by_call.get(key)
+            is_shared = call is not None
+            if not is_shared:
+                call = self._key_by_call[key] = SingleFlight._Call()
+
+        if is_shared:
+            call.event.wait()
+
+        else:
+            try:
+                call.result = func()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    self._key_by_call.pop(key, None)
+                call.event.set()
+
+        if call.error:
+            raise call.error
+
+        return call.result, is_shared
@@ -5,24 +5,147 @@ __author__ = "ipetrash"
 
 
 import datetime as DT
+import inspect
+import json
+import logging
+import os
+import queue
 import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib.error
+import urllib.request
 
+from decimal import Decimal
 from io import BytesIO
 from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 from uuid import uuid4
 
 # pip install matplotlib
 import matplotlib.dates as mdates
 
+# pip install numpy
+import numpy as np
+
+# pip install pillow
+from PIL import Image
+
 from peewee import SqliteDatabase
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.ext import Filters, MessageHandler, Updater
+
+# Модули бота читают токен при импорте конфига, для тестов подойдет любой корректный
+os.environ.setdefault("TOKEN", "123456:" + "A" * 35)
+
+from app_tg_bot.bot.metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    METRICS,
+    get_labels_str,
+    get_metrics_as_json,
+    get_metrics_as_prometheus,
+)
+from app_tg_bot.bot import commands, common
+from app_tg_bot.bot.backgrounds_tasks import run_check_subscriptions
+from app_tg_bot.bot.backgrounds_tasks.run_check_subscriptions import send_price_alerts, send_records
+from app_tg_bot.bot.common import (
+    CALLBACK_CODE_BY_METAL,
+    LatestWins,
+    SeverityEnum,
+    SingleFlight,
+    get_inline_keyboard_for_metal_switch_in_chart,
+    get_metal_by_callback_code,
+)
+from app_tg_bot.bot import lanes, metrics
+from app_tg_bot.bot.lanes import Lane, LaneEnum, run_in_lane
+from app_tg_bot.bot.webhook import HEADER_SECRET_TOKEN, WebhookServer
+from app_tg_bot.config import BUSY_TEXT, DISPATCHER_WORKERS, USER_NAME_ADMINS
+from app_tg_bot.bot.third_party import auto_in_progress_message
+from app_tg_bot.bot.third_party.auto_in_progress_message import (
+    ProgressTicker,
+    ProgressValue,
+    _ProgressItem,
+    show_temp_message,
+)
+from app_tg_bot.bot.regexp_patterns import (
+    CALLBACK_ALL_METALS,
+    PATTERN_INLINE_GET_AS_CHART,
+    PATTERN_INLINE_GET_AS_CHART_LEGACY,
+    PATTERN_INLINE_GET_BY_DATE,
+    PATTERN_INLINE_GET_CHART_METAL_BY_YEAR,
+    PATTERN_REPLY_ADMIN_STATS,
+    PATTERN_REPLY_ALERTS,
+    PATTERN_REPLY_GET_ALL_AS_CHART,
+    PATTERN_REPLY_GET_AS_TEXT,
+    PATTERN_REPLY_GET_LAST_7_AS_CHART,
+    PATTERN_REPLY_GET_LAST_31_AS_CHART,
+    PATTERN_REPLY_SELECT_DATE,
+    PATTERN_REPLY_SUBSCRIBE,
+    PATTERN_REPLY_UNSUBSCRIBE,
+    fill_string_pattern,
+)
+from app_tg_bot.bot.router import CallbackQueryRouter, TextRouter, get_callback_code
+from app_tg_bot.fake_telegram.updates import get_callback_query_update, get_message_update
 
+from app_parser import main as parser_main
 from app_parser.config import START_DATE
-from db import MetalRate, Settings, Subscription, db
-from root_common import SubscriptionResultEnum, MetalEnum
+from app_web_server import main as web_main
+from app_web_server.rates_events import RETRY_BUSY_MS, RETRY_MS, RatesEventsServer, RatesSource
+from app_web_server.snapshot import FILE_NAME_DATA, FILE_NAME_INDEX, has_snapshot, publish_snapshot
+from db import (
+    MetalRate,
+    MetalRateMonth,
+    MetalRateRecord,
+    MetalRateRollup,
+    MetalRateYear,
+    PriceAlert,
+    PriceAlertMatcher,
+    Settings,
+    Subscription,
+    db,
+)
+import root_common
+from root_common import (
+    SubscriptionResultEnum,
+    MetalEnum,
+    RollupPeriodEnum,
+    PriceAlertKindEnum,
+    RecordKindEnum,
+    SamplingFilter,
+    get_date_str,
+    get_logger,
+    start_log_listener,
+    stop_log_listener,
+)
+from utils.analytics import (
+    ANALYTICS,
+    AnalyticsMetricEnum,
+    get_sma,
+    get_ema,
+    get_volatility,
+    get_drawdown,
+    fill_forward,
+    get_period_last_indexes,
+)
+from utils.chart_cache import ChartCache, ChartRenderBusyError
+from utils.rate_stats import RateStatsIndex
+from utils.records import RecordTracker
 from utils.draw_plot import (
+    ChartEncodingEnum,
+    ChartPresetEnum,
+    NoDataError,
     draw_plot,
+    draw_plot_comparison,
     get_plot_for_metal,
+    get_plot_for_metals,
     get_plot_for_gold,
     get_plot_for_silver,
     get_plot_for_platinum,
@@ -36,16 +159,27 @@ DIR = Path(__file__).resolve().parent
 # NOTE: https://docs.peewee-orm.com/en/latest/peewee/database.html#testing-peewee-applications
 class TestCaseDB(unittest.TestCase):
     def setUp(self):
-        self.models = [MetalRate, Subscription, Settings]
+        self.models = [
+            MetalRate, MetalRateYear, MetalRateMonth, MetalRateRollup, MetalRateRecord, PriceAlert,
+            Subscription, Settings
+        ]
         self.test_db = SqliteDatabase(":memory:")
         self.test_db.bind(self.models, bind_refs=False, bind_backrefs=False)
         self.test_db.connect()
         self.test_db.create_tables(self.models)
 
+        # Кэш активных подписок и индекс статистики были загружены из другой базы данных
+        Subscription.reset_active_user_ids()
+        MetalRate.reset_stats_index()
+        PriceAlert.reset_matcher()
+
     def tearDown(self):
         # Нужно вернуть маппинг к текущей базе данных, иначе следующие тесты, использующие базу данных, типа
         # рисования графиков будут проваливаться
         db.bind(self.models, bind_refs=False, bind_backrefs=False)
+        Subscription.reset_active_user_ids()
+        MetalRate.reset_stats_index()
+        PriceAlert.reset_matcher()
 
     def test_metalrate(self):
         self.assertEqual(
@@ -57,6 +191,261 @@ class TestCaseDB(unittest.TestCase):
         )
         self.assertEqual(MetalRate.get_last_date(), MetalRate.get_last_dates()[0])
 
+    def test_get_last_rates(self):
+        def get_last_rates_legacy(number: int, ignore_null: bool) -> list[MetalRate]:
+            # Прежняя реализация: отдельный запрос последних дат и выборка по ним
+            dates = MetalRate.get_last_dates(number)
+            filters = [MetalRate.date.in_(dates)]
+            if ignore_null:
+                filters += [
+                    MetalRate.gold.is_null(False),
+                    MetalRate.silver.is_null(False),
+                    MetalRate.platinum.is_null(False),
+                    MetalRate.palladium.is_null(False),
+                ]
+            query = MetalRate.select().where(*filters).order_by(MetalRate.date.asc())
+            return list(query)
+
+        numbers = [1, 2, 7, 31, 100, -1]
+
+        with self.subTest(msg="Empty table"):
+            self.assertEqual(MetalRate.get_last_dates(), [START_DATE])
+            for number in numbers:
+                for ignore_null in [True, False]:
+                    self.assertEqual(
+                        MetalRate.get_last_rates(number, ignore_null),
+                        get_last_rates_legacy(number, ignore_null),
+                    )
+                    self.assertEqual(MetalRate.get_last_rates(number, ignore_null), [])
+
+        date = START_DATE
+        for i in range(50):
+            date += DT.timedelta(days=random.randint(1, 3))
+            value = Decimal(random.randint(100, 10_000))
+            MetalRate.add(
+                date=date,
+                gold=value,
+                silver=value,
+                platinum=value,
+                # Иногда металлы бывают не заданы
+                palladium=None if i % 7 == 0 else value,
+            )
+
+        for number in numbers:
+            for ignore_null in [True, False]:
+                with self.subTest(number=number, ignore_null=ignore_null):
+                    self.assertEqual(
+                        MetalRate.get_last_rates(number, ignore_null),
+                        get_last_rates_legacy(number, ignore_null),
+                    )
+
+    def test_metalrateyear(self):
+        self.assertEqual(MetalRateYear.get_years(), [])
+        self.assertIsNone(MetalRateYear.get_last_year())
+        self.assertEqual(MetalRateYear.get_prev_next_years(2000), (None, None))
+
+        for date, value in [
+            (DT.date(2000, 1, 6), 10),
+            (DT.date(2000, 12, 29), 30),
+            (DT.date(2002, 5, 6), 5),
+        ]:
+            value = Decimal(value)
+            MetalRate.add(
+                date=date, gold=value, silver=value, platinum=value, palladium=value
+            )
+        MetalRateYear.refresh_all()
+
+        self.assertEqual(MetalRateYear.get_years(), [2000, 2002])
+        self.assertEqual(MetalRateYear.get_last_year(), 2002)
+        self.assertEqual(MetalRateYear.get_prev_next_years(2000), (None, 2002))
+        self.assertEqual(MetalRateYear.get_prev_next_years(2001), (2000, 2002))
+        self.assertEqual(MetalRateYear.get_prev_next_years(2002), (2000, None))
+
+        obj = MetalRateYear.get_by(2000)
+        self.assertEqual(obj.rates_count, 2)
+        self.assertEqual(obj.min_date, DT.date(2000, 1, 6))
+        self.assertEqual(obj.max_date, DT.date(2000, 12, 29))
+        self.assertEqual(obj.gold_min, 10)
+        self.assertEqual(obj.gold_max, 30)
+        self.assertEqual(obj.gold_avg, 20)
+
+        MetalRate.add(
+            date=DT.date(2001, 3, 1),
+            gold=Decimal(1),
+            silver=Decimal(1),
+            platinum=Decimal(1),
+            palladium=Decimal(1),
+        )
+        obj = MetalRateYear.refresh(2001)
+        self.assertEqual(obj.rates_count, 1)
+        self.assertEqual(MetalRateYear.get_prev_next_years(2002), (2001, None))
+
+        MetalRate.delete().where(MetalRate.date.year == 2001).execute()
+        self.assertIsNone(MetalRateYear.refresh(2001))
+        self.assertEqual(MetalRateYear.get_years(), [2000, 2002])
+
+    def test_metalratemonth(self):
+        self.assertEqual(MetalRateMonth.get_days_mask(2000, 1), 0)
+        self.assertEqual(MetalRateMonth.get_available_days(2000, 1), [])
+        self.assertIsNone(MetalRateMonth.get_nearest_date(DT.date(2000, 1, 1)))
+
+        dates = [
+            DT.date(2000, 1, 6),
+            DT.date(2000, 1, 10),
+            DT.date(2000, 1, 31),
+            DT.date(2000, 3, 1),
+        ]
+        for date in dates:
+            value = Decimal(1)
+            MetalRate.add(
+                date=date, gold=value, silver=value, platinum=value, palladium=value
+            )
+        MetalRateMonth.refresh_all()
+
+        # Другой процесс успел заполнить таблицу между удалением и вставкой
+        delete_query = MetalRateMonth.delete()
+
+        def delete_with_race():
+            delete_query.execute()
+            MetalRateMonth.refresh_for_dates(dates)
+
+        with mock.patch.object(MetalRateMonth, "delete") as delete:
+            delete.return_value.execute.side_effect = delete_with_race
+            MetalRateMonth.refresh_all()
+        self.assertEqual(MetalRateMonth.count(), 2)
+
+        self.assertEqual(MetalRateMonth.get_available_days(2000, 1), [6, 10, 31])
+        self.assertEqual(MetalRateMonth.get_days_mask(2000, 1), 1 << 5 | 1 << 9 | 1 << 30)
+        self.assertEqual(MetalRateMonth.get_available_days(2000, 2), [])
+        self.assertEqual(MetalRateMonth.get_available_days(2000, 3), [1])
+
+        for date, nearest_date in [
+            (DT.date(2000, 1, 1), DT.date(2000, 1, 6)),
+            (DT.date(2000, 1, 6), DT.date(2000, 1, 6)),
+            (DT.date(2000, 1, 7), DT.date(2000, 1, 6)),
+            # При равном удалении выбирается следующая дата
+            (DT.date(2000, 1, 8), DT.date(2000, 1, 10)),
+            (DT.date(2000, 1, 30), DT.date(2000, 1, 31)),
+            (DT.date(2000, 2, 10), DT.date(2000, 1, 31)),
+            (DT.date(2000, 2, 20), DT.date(2000, 3, 1)),
+            (DT.date(2000, 3, 20), DT.date(2000, 3, 1)),
+        ]:
+            with self.subTest(date=date):
+                self.assertEqual(MetalRateMonth.get_nearest_date(date), nearest_date)
+
+        # Сравнение с перебором
+        for days_mask in range(0, 1 << 8):
+            days = MetalRateMonth.get_days(days_mask)
+            self.assertEqual(days, [day for day in range(1, 9) if days_mask >> (day - 1) & 1])
+
+            for day in range(1, 9):
+                expected = min(days, key=lambda x: (abs(x - day), x < day), default=None)
+                self.assertEqual(MetalRateMonth.get_nearest_day(days_mask, day), expected)
+
+        MetalRate.add(
+            date=DT.date(2000, 2, 15),
+            gold=Decimal(1),
+            silver=Decimal(1),
+            platinum=Decimal(1),
+            palladium=Decimal(1),
+        )
+        MetalRateMonth.refresh_for_dates([DT.date(2000, 2, 15)])
+        self.assertEqual(MetalRateMonth.get_available_days(2000, 2), [15])
+        self.assertEqual(MetalRateMonth.get_nearest_date(DT.date(2000, 2, 1)), DT.date(2000, 2, 15))
+
+        MetalRate.delete().where(MetalRate.date == DT.date(2000, 3, 1)).execute()
+        MetalRateMonth.refresh(2000, 3)
+        self.assertEqual(MetalRateMonth.get_available_days(2000, 3), [])
+        self.assertEqual(MetalRateMonth.count(), 2)
+
+    def test_rates_source(self):
+        def add(date: DT.date, value: Decimal = Decimal(1)):
+            MetalRate.add(
+                date=date, gold=value, silver=value, platinum=value, palladium=value
+            )
+
+        add(DT.date(2000, 1, 3))
+        add(DT.date(2000, 1, 4), value=None)
+        self.assertEqual(
+            [row.date for row in MetalRate.get_rates_rows_after(DT.date(2000, 1, 1))],
+            [DT.date(2000, 1, 3)],
+        )
+        self.assertEqual(MetalRate.get_rates_rows_after(DT.date(2000, 1, 3)), [])
+
+        source = RatesSource()
+        self.assertEqual(source.get_last_date(), DT.date(2000, 1, 4))
+
+        items = source.get_items_after(DT.date(2000, 1, 1), DT.date(2000, 1, 4))
+        self.assertEqual([item["date_iso"] for item in items], ["2000-01-03"])
+
+        # Для того же диапазона дат записи берутся из кэша
+        add(DT.date(2000, 1, 5), value=Decimal(2))
+        self.assertIs(source.get_items_after(DT.date(2000, 1, 1), DT.date(2000, 1, 4)), items)
+
+        items = source.get_items_after(DT.date(2000, 1, 4), DT.date(2000, 1, 5))
+        self.assertEqual([item["date_iso"] for item in items], ["2000-01-05"])
+        self.assertEqual(items[0]["gold"], 2.0)
+
+    def test_metalraterollup(self):
+        for period in RollupPeriodEnum:
+            self.assertEqual(MetalRate.get_rollups(MetalEnum.GOLD, period), [])
+
+        # Понедельник - пятница одной недели и понедельник следующей
+        for date, gold in [
+            (DT.date(2022, 1, 31), 30),
+            (DT.date(2022, 2, 1), 50),
+            (DT.date(2022, 2, 2), 10),
+            (DT.date(2022, 2, 4), 20),
+            (DT.date(2022, 2, 7), 40),
+        ]:
+            MetalRate.add(date=date, gold=Decimal(gold))
+        MetalRateRollup.refresh_all()
+
+        self.assertEqual(MetalRate.get_rollups(MetalEnum.SILVER, RollupPeriodEnum.WEEK), [])
+
+        items = MetalRate.get_rollups(MetalEnum.GOLD, RollupPeriodEnum.WEEK)
+        self.assertEqual(
+            [(obj.start_date, obj.first_date, obj.last_date) for obj in items],
+            [
+                (DT.date(2022, 1, 31), DT.date(2022, 1, 31), DT.date(2022, 2, 4)),
+                (DT.date(2022, 2, 7), DT.date(2022, 2, 7), DT.date(2022, 2, 7)),
+            ],
+        )
+        obj = items[0]
+        self.assertEqual(
+            (obj.rates_count, obj.open, obj.high, obj.low, obj.close, obj.avg),
+            (4, 30, 50, 10, 20, Decimal("27.5")),
+        )
+
+        items = MetalRate.get_rollups(MetalEnum.GOLD, RollupPeriodEnum.MONTH)
+        self.assertEqual(
+            [(obj.start_date, obj.open, obj.close) for obj in items],
+            [(DT.date(2022, 1, 1), 30, 30), (DT.date(2022, 2, 1), 50, 40)],
+        )
+
+        items = MetalRate.get_rollups(MetalEnum.GOLD, RollupPeriodEnum.YEAR)
+        self.assertEqual(len(items), 1)
+        self.assertEqual((items[0].rates_count, items[0].high), (5, 50))
+
+        with self.subTest(msg="Incremental update"):
+            date = DT.date(2022, 2, 8)
+            MetalRate.add(date=date, gold=Decimal(100))
+            MetalRateRollup.refresh_for_dates([date])
+
+            obj = MetalRate.get_rollups(MetalEnum.GOLD, RollupPeriodEnum.WEEK)[-1]
+            self.assertEqual(
+                (obj.rates_count, obj.open, obj.high, obj.close, obj.last_date),
+                (2, 40, 100, 100, date),
+            )
+
+            obj = MetalRate.get_rollups(MetalEnum.GOLD, RollupPeriodEnum.YEAR)[-1]
+            self.assertEqual((obj.rates_count, obj.high, obj.close), (6, 100, 100))
+
+            items = MetalRate.get_rollups(
+                MetalEnum.GOLD, RollupPeriodEnum.WEEK, start_date=DT.date(2022, 2, 5)
+            )
+            self.assertEqual([obj.start_date for obj in items], [DT.date(2022, 2, 7)])
+
     def test_settings(self):
         self.assertEqual(Settings.instance(), Settings.instance())
         self.assertEqual(Settings.instance(), Settings.get_first())
@@ -133,6 +522,519 @@ class TestCaseDB(unittest.TestCase):
             self.assertIsNotNone(Subscription.get_by_user_id(user_id))
             self.assertFalse(Subscription.has_is_active(user_id))
 
+    def test_subscription_active_user_ids(self):
+        user_id_1, user_id_2 = 1, 2
+
+        self.assertEqual(Subscription.get_active_count(), 0)
+        self.assertEqual(Subscription.check_active_user_ids(), (set(), set()))
+
+        Subscription.subscribe(user_id_1)
+        Subscription.subscribe(user_id_2)
+        self.assertEqual(Subscription.get_active_user_ids(), {user_id_1, user_id_2})
+        self.assertEqual(Subscription.get_active_count(), 2)
+
+        Subscription.unsubscribe(user_id_1)
+        self.assertEqual(Subscription.get_active_user_ids(), {user_id_2})
+        self.assertEqual(Subscription.check_active_user_ids(), (set(), set()))
+
+        # Изменение таблицы в обход методов класса
+        Subscription.update(is_active=True).where(Subscription.user_id == user_id_1).execute()
+        Subscription.update(is_active=False).where(Subscription.user_id == user_id_2).execute()
+        self.assertEqual(
+            Subscription.check_active_user_ids(), ({user_id_1}, {user_id_2})
+        )
+        self.assertEqual(Subscription.get_active_user_ids(), {user_id_1})
+        self.assertTrue(Subscription.has_is_active(user_id_1))
+        self.assertFalse(Subscription.has_is_active(user_id_2))
+
+        # Возвращается неизменяемый снимок, на который не влияют следующие изменения
+        active_user_ids = Subscription.get_active_user_ids()
+        self.assertIsInstance(active_user_ids, frozenset)
+        Subscription.subscribe(user_id_2)
+        self.assertEqual(active_user_ids, {user_id_1})
+        self.assertEqual(Subscription.get_active_user_ids(), {user_id_1, user_id_2})
+
+    def test_subscription_load_active_user_ids(self):
+        Subscription.create(user_id=1)
+        Subscription.create(user_id=2, is_active=False)
+
+        # Как при запуске бота: кэш заполняется из таблицы до первого обращения
+        self.assertEqual(Subscription.load_active_user_ids(), {1})
+        with mock.patch.object(Subscription, "_get_active_user_ids_from_db") as get_from_db:
+            self.assertTrue(Subscription.has_is_active(1))
+            self.assertFalse(Subscription.has_is_active(2))
+            get_from_db.assert_not_called()
+
+    def test_get_range_stats(self):
+        metal = MetalEnum.GOLD
+
+        self.assertIsNone(MetalRate.get_range_stats(metal))
+
+        MetalRate.add(DT.date(2022, 1, 1), gold=10, silver=1, platinum=1, palladium=1)
+        MetalRate.add(DT.date(2022, 1, 2), gold=30, silver=1, platinum=1, palladium=1)
+
+        # Новые курсы попадают в индекс только после его обновления
+        self.assertIsNone(MetalRate.get_range_stats(metal))
+        MetalRate.update_stats_index()
+
+        stats = MetalRate.get_range_stats(metal)
+        self.assertEqual(stats.count, 2)
+        self.assertEqual((stats.min_value, stats.min_date), (10, DT.date(2022, 1, 1)))
+        self.assertEqual((stats.max_value, stats.max_date), (30, DT.date(2022, 1, 2)))
+        self.assertEqual(stats.avg_value, 20)
+
+        MetalRate.add(DT.date(2022, 1, 3), gold=5, silver=1, platinum=1, palladium=1)
+        MetalRate.update_stats_index()
+
+        stats = MetalRate.get_range_stats(metal, DT.date(2022, 1, 2), DT.date(2022, 2, 1))
+        self.assertEqual((stats.start_date, stats.end_date), (DT.date(2022, 1, 2), DT.date(2022, 1, 3)))
+        self.assertEqual((stats.min_value, stats.min_date), (5, DT.date(2022, 1, 3)))
+        self.assertEqual(stats.avg_value, 17.5)
+
+        self.assertIsNone(MetalRate.get_range_stats(metal, DT.date(2023, 1, 1)))
+
+    def test_metalrateyear_refresh_missing(self):
+        for year in [2020, 2021, 2022]:
+            MetalRate.add(DT.date(year, 6, 1), gold=year, silver=1, platinum=1, palladium=1)
+
+        self.assertEqual(MetalRateYear.refresh_missing(), [2020, 2021, 2022])
+        self.assertEqual(MetalRateYear.refresh_missing(), [])
+
+        # Курсы за год добавлены без обновления сводной таблицы, а курсы за другой год удалены
+        MetalRate.add(DT.date(2023, 6, 1), gold=2023, silver=1, platinum=1, palladium=1)
+        MetalRate.delete().where(MetalRate.date == DT.date(2021, 6, 1)).execute()
+        self.assertEqual(MetalRateYear.get_prev_next_years(2022), (2021, None))
+
+        self.assertEqual(MetalRateYear.refresh_missing(), [2021, 2023])
+        self.assertEqual(MetalRateYear.get_years(), [2020, 2022, 2023])
+        self.assertEqual(MetalRateYear.get_prev_next_years(2022), (2020, 2023))
+        self.assertEqual(MetalRateYear.get_by(2023).gold_max, 2023)
+
+    def test_metalraterecord(self):
+        metal = MetalEnum.GOLD
+
+        def add_rate(date: DT.date, value: int) -> MetalRate:
+            return MetalRate.add(date, gold=value, silver=1, platinum=1, palladium=1)
+
+        add_rate(DT.date(2020, 6, 1), 100)
+        add_rate(DT.date(2021, 6, 1), 50)
+        add_rate(DT.date(2022, 1, 10), 70)
+        for year in [2020, 2021, 2022]:
+            MetalRateYear.refresh(year)
+
+        rates = [
+            add_rate(DT.date(2022, 1, 11), 80),  # За 52 недели, прошлый максимум 2020 года вне окна
+            add_rate(DT.date(2022, 1, 12), 75),
+            add_rate(DT.date(2022, 1, 13), 101),  # Исторический максимум
+            add_rate(DT.date(2022, 1, 14), 60),  # С начала года, минимум 2021 года в окне
+            add_rate(DT.date(2022, 1, 15), 40),  # Исторический минимум
+        ]
+        records = MetalRateRecord.check_rates(rates)
+        self.assertEqual(
+            [
+                (obj.date.day, obj.kind, obj.is_high, obj.value, obj.prev_value)
+                for obj in records
+                if obj.metal == metal.name
+            ],
+            [
+                (11, RecordKindEnum.WEEKS_52.name, True, 80, 70),
+                (13, RecordKindEnum.ALL_TIME.name, True, 101, 100),
+                (14, RecordKindEnum.YEAR.name, False, 60, 70),
+                (15, RecordKindEnum.ALL_TIME.name, False, 40, 50),
+            ]
+        )
+
+        # Значения остальных металлов не менялись
+        self.assertEqual({obj.metal for obj in records}, {metal.name})
+
+        self.assertEqual(MetalRateRecord.get_unsent(), records)
+        MetalRateRecord.set_sent(records[:2])
+        self.assertEqual(MetalRateRecord.get_unsent(), records[2:])
+        self.assertEqual(MetalRateRecord.get_by_date(DT.date(2022, 1, 13)), [records[1]])
+        self.assertEqual(MetalRateRecord.check_rates([]), [])
+
+        # Повторная проверка тех же курсов не создает дубликатов
+        self.assertEqual(MetalRateRecord.check_rates(rates), [])
+        self.assertEqual(MetalRateRecord.select().count(), len(records))
+
+        records_new = MetalRateRecord.check_rates(rates + [add_rate(DT.date(2022, 1, 16), 30)])
+        self.assertEqual(
+            [(obj.date.day, obj.kind, obj.value) for obj in records_new],
+            [(16, RecordKindEnum.ALL_TIME.name, 30)],
+        )
+
+    def test_price_alert_matcher(self):
+        gold, silver = MetalEnum.GOLD, MetalEnum.SILVER
+        up, down, change = PriceAlertKindEnum.UP, PriceAlertKindEnum.DOWN, PriceAlertKindEnum.CHANGE
+
+        matcher = PriceAlertMatcher([
+            (1, gold.name, up.name, 100),
+            (2, gold.name, up.name, 110),
+            (3, gold.name, down.name, 90),
+            (4, gold.name, change.name, 5),
+            (5, gold.name, change.name, 15),
+            (6, silver.name, up.name, 100),
+        ])
+
+        def match(metal: MetalEnum, prev_value: float, value: float) -> dict:
+            return {
+                kind: alert_ids
+                for kind, alert_ids in matcher.match(metal, prev_value, value).items()
+                if alert_ids
+            }
+
+        self.assertEqual(match(gold, 99, 100), {up: [1]})
+        self.assertEqual(match(gold, 100, 105), {change: [4]})
+        self.assertEqual(match(gold, 95, 120), {up: [1, 2], change: [4, 5]})
+        self.assertEqual(match(gold, 91, 90), {down: [3]})
+        self.assertEqual(match(gold, 90, 85), {change: [4]})
+        self.assertEqual(match(gold, 99, 99), {})
+        self.assertEqual(match(gold, None, 120), {})
+        self.assertEqual(match(silver, 50, 150), {up: [6]})
+        self.assertEqual(match(MetalEnum.PLATINUM, 50, 150), {})
+
+        # Изменение и удаление оповещения без перестроения индекса
+        self.assertEqual(len(matcher), 6)
+        matcher.add(1, gold.name, up.name, 115)
+        self.assertEqual(match(gold, 99, 112), {up: [2], change: [4]})
+        matcher.add(1, gold.name, down.name, 95)
+        self.assertEqual(match(gold, 100, 94), {down: [1], change: [4]})
+
+        matcher.remove(1)
+        matcher.remove(1)
+        self.assertNotIn(1, matcher)
+        self.assertEqual(len(matcher), 5)
+        self.assertEqual(match(gold, 100, 94), {change: [4]})
+        self.assertEqual(match(gold, 95, 120), {up: [2], change: [4, 5]})
+
+    def test_price_alert(self):
+        user_id = 1
+
+        def add_rate(date: DT.date, value: int) -> MetalRate:
+            return MetalRate.add(date, gold=value, silver=1, platinum=1, palladium=1)
+
+        add_rate(DT.date(2022, 1, 1), 100)
+
+        alert_up = PriceAlert.add(user_id, MetalEnum.GOLD, PriceAlertKindEnum.UP, Decimal(110))
+        alert_down = PriceAlert.add(user_id, MetalEnum.GOLD, PriceAlertKindEnum.DOWN, Decimal(80))
+        alert_change = PriceAlert.add(user_id, MetalEnum.GOLD, PriceAlertKindEnum.CHANGE, Decimal(10))
+        self.assertEqual(len(PriceAlert.get_active_by_user_id(user_id)), 3)
+        self.assertEqual(PriceAlert.get_unsent(), [])
+
+        rates = [add_rate(DT.date(2022, 1, 2), 105), add_rate(DT.date(2022, 1, 3), 120)]
+        self.assertEqual(PriceAlert.check_rates(rates), [alert_up.id, alert_change.id])
+
+        alert_up = alert_up.get_new()
+        self.assertFalse(alert_up.is_active)
+        self.assertEqual(alert_up.triggered_date, DT.date(2022, 1, 3))
+        self.assertEqual(alert_up.triggered_prev_value, 105)
+        self.assertEqual(alert_up.triggered_value, 120)
+        self.assertTrue(alert_change.get_new().is_active)
+        self.assertEqual(PriceAlert.get_unsent(), [alert_up, alert_change])
+
+        # Сработавшее оповещение о пересечении порога больше не проверяется
+        rates = [add_rate(DT.date(2022, 1, 4), 100), add_rate(DT.date(2022, 1, 5), 115)]
+        self.assertEqual(PriceAlert.check_rates(rates), [alert_change.id])
+
+        self.assertEqual(PriceAlert.deactivate(user_id, alert_down.id), 1)
+        self.assertEqual(PriceAlert.check_rates([add_rate(DT.date(2022, 1, 6), 70)]), [alert_change.id])
+
+        self.assertEqual(PriceAlert.deactivate(user_id), 1)
+        self.assertEqual(PriceAlert.get_active_by_user_id(user_id), [])
+        self.assertEqual(PriceAlert.check_rates([]), [])
+
+    def test_price_alert_recheck(self):
+        user_id = 1
+
+        def add_rate(date: DT.date, value: int) -> MetalRate:
+            return MetalRate.add(date, gold=value, silver=1, platinum=1, palladium=1)
+
+        add_rate(DT.date(2022, 1, 1), 100)
+        alert_change = PriceAlert.add(user_id, MetalEnum.GOLD, PriceAlertKindEnum.CHANGE, Decimal(10))
+
+        rates = [add_rate(DT.date(2022, 1, 2), 120)]
+        self.assertEqual(PriceAlert.check_rates(rates), [alert_change.id])
+
+        # Повторная проверка тех же курсов после ошибки не отправляет оповещение еще раз
+        PriceAlert.update(was_sending=True).execute()
+        self.assertEqual(PriceAlert.check_rates(rates), [])
+        self.assertEqual(PriceAlert.get_unsent(), [])
+
+        self.assertEqual(PriceAlert.check_rates([add_rate(DT.date(2022, 1, 3), 140)]), [alert_change.id])
+
+    def test_settings_last_date_of_checked_rates(self):
+        self.assertIsNone(Settings.get_last_date_of_checked_rates())
+
+        Settings.set_last_date_of_checked_rates(DT.date(2022, 1, 1))
+        self.assertEqual(Settings.get_last_date_of_checked_rates(), DT.date(2022, 1, 1))
+
+    def test_add_missing_columns(self):
+        self.test_db.execute_sql("ALTER TABLE settings DROP COLUMN last_date_of_checked_rates")
+        self.assertNotIn("last_date_of_checked_rates", [c.name for c in self.test_db.get_columns("settings")])
+
+        Settings.add_missing_columns()
+        self.assertIn("last_date_of_checked_rates", [c.name for c in self.test_db.get_columns("settings")])
+
+        # Повторный вызов ничего не меняет
+        Settings.add_missing_columns()
+        Settings.set_last_date_of_checked_rates(DT.date(2022, 1, 1))
+        self.assertEqual(Settings.get_last_date_of_checked_rates(), DT.date(2022, 1, 1))
+
+    def test_parser_process_new_rates(self):
+        user_id = 1
+
+        def add_rate(date: DT.date, value: int) -> MetalRate:
+            return MetalRate.add(date, gold=value, silver=1, platinum=1, palladium=1)
+
+        add_rate(DT.date(2022, 1, 1), 100)
+        Settings.set_last_date_of_checked_rates(DT.date(2022, 1, 1))
+        alert_change = PriceAlert.add(user_id, MetalEnum.GOLD, PriceAlertKindEnum.CHANGE, Decimal(10))
+
+        dates = {add_rate(DT.date(2022, 1, 2), 120).date}
+
+        # Ошибка после добавления курсов: оповещение уже проверено, отметка не сдвинулась
+        with mock.patch.object(MetalRateRollup, "refresh_for_dates", side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                parser_main.process_new_rates(dates)
+
+        self.assertEqual(PriceAlert.get_unsent(), [alert_change.get_new()])
+        self.assertEqual(Settings.get_last_date_of_checked_rates(), DT.date(2022, 1, 1))
+        PriceAlert.update(was_sending=True).execute()
+
+        # На следующем проходе новых курсов из API нет, но пропущенные даты обрабатываются
+        with mock.patch.object(MetalRateRollup, "refresh_for_dates") as refresh_for_dates:
+            parser_main.process_new_rates(set())
+            refresh_for_dates.assert_called_once_with({DT.date(2022, 1, 2)})
+
+        self.assertEqual(PriceAlert.get_unsent(), [])
+        self.assertEqual(Settings.get_last_date_of_checked_rates(), DT.date(2022, 1, 2))
+        self.assertIsNotNone(MetalRateYear.get_by(2022))
+
+    def test_parser_process_new_rates_empty_db(self):
+        def add_rate(date: DT.date, value: int) -> MetalRate:
+            return MetalRate.add(date, gold=value, silver=1, platinum=1, palladium=1)
+
+        PriceAlert.add(1, MetalEnum.GOLD, PriceAlertKindEnum.CHANGE, Decimal(1))
+
+        # Загрузка истории в пустую базу не создает рекордов и не вызывает оповещений
+        dates = {add_rate(START_DATE + DT.timedelta(days=i), 100 + i).date for i in range(30)}
+        parser_main.process_new_rates(dates)
+
+        self.assertEqual(MetalRateRecord.select().count(), 0)
+        self.assertEqual(PriceAlert.get_unsent(), [])
+        self.assertEqual(Settings.get_last_date_of_checked_rates(), max(dates))
+        self.assertIsNotNone(MetalRateYear.get_by(START_DATE.year))
+
+        # Проверяются только курсы после загрузки истории
+        parser_main.process_new_rates({add_rate(max(dates) + DT.timedelta(days=1), 200).date})
+        self.assertEqual(MetalRateRecord.select().count(), 1)
+        self.assertEqual(len(PriceAlert.get_unsent()), 1)
+
+    def test_price_alert_update_matcher(self):
+        user_id = 1
+
+        matcher = PriceAlert.update_matcher()
+        self.assertEqual(len(matcher), 0)
+
+        alert_up = PriceAlert.add(user_id, MetalEnum.GOLD, PriceAlertKindEnum.UP, Decimal(110))
+        alert_down = PriceAlert.add(user_id, MetalEnum.GOLD, PriceAlertKindEnum.DOWN, Decimal(80))
+
+        # Индекс не перестраивается, а дополняется изменениями из базы данных
+        self.assertIs(PriceAlert.update_matcher(), matcher)
+        self.assertIn(alert_up.id, matcher)
+        self.assertIn(alert_down.id, matcher)
+
+        self.assertEqual(PriceAlert.deactivate(user_id, alert_up.id), 1)
+        PriceAlert.update_matcher()
+        self.assertNotIn(alert_up.id, matcher)
+        self.assertIn(alert_down.id, matcher)
+
+        # Изменения старше последней синхронизации (с учетом запаса) повторно не читаются
+        old_datetime = DT.datetime.now() - PriceAlert.MATCHER_SYNC_OVERLAP * 2
+        PriceAlert.update(is_active=False, modification_datetime=old_datetime).where(
+            PriceAlert.id == alert_down.id
+        ).execute()
+        PriceAlert.update_matcher()
+        self.assertIn(alert_down.id, matcher)
+
+        # Новый индекс загружает только активные оповещения
+        PriceAlert.reset_matcher()
+        matcher = PriceAlert.update_matcher()
+        self.assertEqual(len(matcher), 0)
+
+    def test_on_stats(self):
+        MetalRate.add(DT.date(2022, 1, 10), gold=None, silver=5, platinum=1, palladium=1)
+        MetalRate.add(DT.date(2022, 1, 11), gold=100, silver=10, platinum=2, palladium=2)
+        MetalRate.add(DT.date(2022, 1, 12), gold=200, silver=None, platinum=3, palladium=3)
+
+        update = mock.Mock()
+        context = SimpleNamespace(args=["2022"])
+
+        with mock.patch.object(commands, "reply_message") as reply_message, \
+                mock.patch.object(commands, "get_reply_keyboard"):
+            inspect.unwrap(commands.on_stats)(update, context)
+
+        lines = reply_message.call_args.kwargs["text"].splitlines()
+
+        # В заголовке фактический диапазон дат с курсами, а не весь запрошенный год
+        date_10, date_11, date_12 = (
+            get_date_str(DT.date(2022, 1, day)) for day in (10, 11, 12)
+        )
+        self.assertEqual(lines[0], f"<b>Статистика за {date_10} - {date_12}</b>")
+        self.assertTrue(lines[1].startswith(f"Золото: мин. 100.00 ({date_11}), макс. 200.00 ({date_12})"))
+        self.assertTrue(lines[2].startswith(f"Серебро: мин. 5.00 ({date_10}), макс. 10.00 ({date_11})"))
+        self.assertTrue(lines[3].startswith(f"Платина: мин. 1.00 ({date_10}), макс. 3.00 ({date_12})"))
+
+    def test_get_plot_for_metal_without_values(self):
+        # История курсов должна загрузиться из тестовой базы данных
+        ANALYTICS.reset()
+        self.addCleanup(ANALYTICS.reset)
+
+        def get_days(**kwargs) -> list[DT.date]:
+            with mock.patch("utils.draw_plot.draw_plot") as draw_plot_mock:
+                get_plot_for_metal(metal=MetalEnum.GOLD, **kwargs)
+            return [day.item() for day in draw_plot_mock.call_args.kwargs["days"]]
+
+        with self.subTest(msg="Нет курсов"):
+            for kwargs in [dict(), dict(number=7), dict(period=RollupPeriodEnum.WEEK)]:
+                self.assertRaises(NoDataError, get_plot_for_metal, metal=MetalEnum.GOLD, **kwargs)
+
+        MetalRate.add(DT.date(2022, 1, 10), gold=100, silver=1, platinum=1, palladium=1)
+        MetalRate.add(DT.date(2022, 1, 11), gold=None, silver=1, platinum=1, palladium=1)
+        MetalRate.add(DT.date(2022, 1, 12), gold=110, silver=None, platinum=1, palladium=1)
+        MetalRate.add(DT.date(2022, 1, 13), gold=120, silver=1, platinum=1, palladium=1)
+        ANALYTICS.reset()
+
+        with self.subTest(msg="Последние дни"):
+            # Как у ignore_null: должны быть заданы все металлы
+            self.assertEqual(get_days(), [DT.date(2022, 1, 10), DT.date(2022, 1, 13)])
+            self.assertEqual(get_days(number=2), [DT.date(2022, 1, 13)])
+
+        with self.subTest(msg="Год"):
+            self.assertEqual(
+                get_days(year=2022),
+                [DT.date(2022, 1, 10), DT.date(2022, 1, 12), DT.date(2022, 1, 13)],
+            )
+
+        with self.subTest(msg="Нет сводных данных по периодам"):
+            self.assertEqual(MetalRate.get_rollups(MetalEnum.GOLD, RollupPeriodEnum.WEEK), [])
+            self.assertEqual(
+                get_days(period=RollupPeriodEnum.WEEK), [DT.date(2022, 1, 10), DT.date(2022, 1, 13)]
+            )
+
+        with self.subTest(msg="Нет курсов за год"):
+            self.assertRaises(NoDataError, get_plot_for_metal, metal=MetalEnum.GOLD, year=2021)
+
+    def test_send_price_alerts(self):
+        alert_1 = PriceAlert.add(1, MetalEnum.GOLD, PriceAlertKindEnum.UP, Decimal(110))
+        alert_2 = PriceAlert.add(2, MetalEnum.GOLD, PriceAlertKindEnum.UP, Decimal(110))
+        alert_3 = PriceAlert.add(3, MetalEnum.GOLD, PriceAlertKindEnum.UP, Decimal(110))
+        PriceAlert.update(
+            was_sending=False,
+            triggered_date=DT.date(2022, 1, 1),
+            triggered_prev_value=100,
+            triggered_value=120,
+        ).execute()
+
+        def send_message(chat_id: int, **_):
+            if chat_id == 2:
+                raise Exception("Timed out")
+            if chat_id == 3:
+                raise Exception("Forbidden: bot was blocked by the user")
+
+        bot = mock.Mock()
+        bot.send_message.side_effect = send_message
+
+        with mock.patch("time.sleep") as sleep:
+            self.assertEqual(send_price_alerts(bot, delay_secs=0.1), 1)
+
+        # Пауза выдерживается и после ошибки
+        self.assertEqual(sleep.call_count, 3)
+
+        self.assertTrue(alert_1.get_new().was_sending)
+
+        # Временная ошибка: оповещение будет отправлено при следующем проходе
+        self.assertFalse(alert_2.get_new().was_sending)
+        self.assertTrue(alert_2.get_new().is_active)
+
+        # Пользователь недоступен: оповещения отключаются и больше не отправляются
+        alert_3 = alert_3.get_new()
+        self.assertTrue(alert_3.was_sending)
+        self.assertFalse(alert_3.is_active)
+
+        self.assertEqual(PriceAlert.get_unsent(), [alert_2])
+
+    def test_send_records(self):
+        def add_record(day: int, kind: RecordKindEnum) -> MetalRateRecord:
+            return MetalRateRecord.create(
+                date=DT.date(2022, 1, day),
+                metal=MetalEnum.GOLD.name,
+                kind=kind.name,
+                is_high=True,
+                value=Decimal(120),
+                prev_value=Decimal(110),
+            )
+
+        subscription = Subscription.create(user_id=1)
+        self.assertTrue(subscription.is_active)
+        bot = mock.Mock()
+
+        with self.subTest(msg="Рассылка выключена"):
+            add_record(10, RecordKindEnum.ALL_TIME)
+            with mock.patch.object(run_check_subscriptions, "RECORDS_BROADCAST", False):
+                self.assertEqual(send_records(bot, delay_secs=0), 0)
+            bot.send_message.assert_not_called()
+            self.assertEqual(MetalRateRecord.get_unsent(), [])
+
+        with mock.patch.object(run_check_subscriptions, "RECORDS_BROADCAST", True):
+            with self.subTest(msg="Только рекорды с начала года"):
+                add_record(11, RecordKindEnum.YEAR)
+                self.assertEqual(send_records(bot, delay_secs=0), 0)
+                bot.send_message.assert_not_called()
+                self.assertEqual(MetalRateRecord.get_unsent(), [])
+
+            with self.subTest(msg="Рассылаются только заданные виды"):
+                add_record(12, RecordKindEnum.YEAR)
+                record_52 = add_record(13, RecordKindEnum.WEEKS_52)
+                self.assertEqual(send_records(bot, delay_secs=0), 1)
+
+                text = bot.send_message.call_args.kwargs["text"]
+                self.assertEqual(text.splitlines()[1:], [
+                    f"{get_date_str(record_52.date)}. {record_52.get_description()}"
+                ])
+                self.assertEqual(MetalRateRecord.get_unsent(), [])
+
+            with self.subTest(msg="Виды рекордов из аргумента"):
+                bot.reset_mock()
+                add_record(14, RecordKindEnum.YEAR)
+                self.assertEqual(send_records(bot, delay_secs=0, kinds={RecordKindEnum.YEAR}), 1)
+                bot.send_message.assert_called_once()
+
+    def test_on_alert_add_without_current_rate(self):
+        MetalRate.add(DT.date(2022, 1, 1), gold=None, silver=1, platinum=1, palladium=1)
+
+        # Обработчик без декораторов, чтобы он выполнился в этом потоке, а не в очереди
+        on_alert_add = inspect.unwrap(commands.on_alert_add)
+
+        update = mock.Mock()
+        update.effective_user.id = 1
+        context = SimpleNamespace(args=["gold", "100"])
+
+        with mock.patch.object(commands, "reply_message") as reply_message:
+            on_alert_add(update, context)
+
+        reply_message.assert_called_once()
+        self.assertEqual(reply_message.call_args.kwargs["severity"], SeverityEnum.ERROR)
+        self.assertEqual(PriceAlert.get_active_by_user_id(1), [])
+
+        # Направление указано явно, текущий курс не нужен
+        with mock.patch.object(commands, "reply_message"), \
+                mock.patch.object(commands, "get_reply_keyboard"):
+            on_alert_add(update, SimpleNamespace(args=["gold", ">", "100"]))
+
+        alerts = PriceAlert.get_active_by_user_id(1)
+        self.assertEqual([alert.get_kind() for alert in alerts], [PriceAlertKindEnum.UP])
+
 
 class TestCaseMetalRate(unittest.TestCase):
     def test_get_last_dates(self):
@@ -145,6 +1047,22 @@ class TestCaseMetalRate(unittest.TestCase):
         )
         self.assertEqual(MetalRate.get_last_date(), MetalRate.get_last_dates()[0])
 
+    def test_get_rates_rows(self):
+        fields = ["date", "gold", "silver", "platinum", "palladium"]
+
+        for number in [7, 31, -1]:
+            with self.subTest(number=number):
+                self.assertEqual(
+                    [
+                        tuple(getattr(row, name) for name in fields)
+                        for row in MetalRate.get_last_rates_rows(number=number)
+                    ],
+                    [
+                        tuple(getattr(obj, name) for name in fields)
+                        for obj in MetalRate.get_last_rates(number=number)
+                    ],
+                )
+
     def test_get_prev_next_years(self):
         self.assertEqual(
             MetalRate.get_prev_next_years(year=1000), (None, START_DATE.year)
@@ -162,6 +1080,152 @@ class TestCaseMetalRate(unittest.TestCase):
             )
 
 
+class TestCaseRateStats(unittest.TestCase):
+    def test_rate_stats_index(self):
+        rnd = random.Random(1)
+        metal = MetalEnum.GOLD
+
+        index = RateStatsIndex()
+        dates = []
+        values = []
+        start_date = DT.date(2022, 1, 1)
+        for i in range(300):
+            date = start_date + DT.timedelta(days=i * 2)
+            value = None if i % 17 == 5 else rnd.randint(1, 1000)
+            index.append(date, {metal: value})
+
+            dates.append(date)
+            values.append(value)
+
+        with self.assertRaises(ValueError):
+            index.append(start_date, {metal: 1})
+
+        for _ in range(300):
+            date_1 = start_date + DT.timedelta(days=rnd.randint(-5, 605))
+            date_2 = start_date + DT.timedelta(days=rnd.randint(-5, 605))
+            date_1, date_2 = min(date_1, date_2), max(date_1, date_2)
+
+            items = [
+                (date, value)
+                for date, value in zip(dates, values)
+                if date_1 <= date <= date_2 and value is not None
+            ]
+
+            with self.subTest(start_date=date_1, end_date=date_2):
+                stats = index.get_stats(metal, date_1, date_2)
+                if not items:
+                    self.assertIsNone(stats)
+                    continue
+
+                range_values = [value for _, value in items]
+                self.assertEqual(stats.count, len(items))
+                self.assertEqual(stats.min_value, min(range_values))
+                self.assertEqual(stats.max_value, max(range_values))
+                self.assertAlmostEqual(stats.avg_value, sum(range_values) / len(items))
+                self.assertIn((stats.min_date, stats.min_value), items)
+                self.assertIn((stats.max_date, stats.max_value), items)
+
+        # Для металла без значений статистики нет
+        self.assertIsNone(index.get_stats(MetalEnum.SILVER))
+
+
+class TestCaseRecords(unittest.TestCase):
+    def test_record_tracker(self):
+        rnd = random.Random(1)
+        metal = MetalEnum.GOLD
+
+        tracker = RecordTracker()
+        items: list[tuple[DT.date, int]] = []
+
+        date = DT.date(2019, 1, 1)
+        for _ in range(800):
+            date += DT.timedelta(days=rnd.randint(1, 3))
+            value = rnd.randint(1, 10_000)
+
+            records = tracker.add(date, {metal: value})
+
+            prev_all = [v for _, v in items]
+            prev_window = [v for d, v in items if d >= tracker.get_window_start(date)]
+            prev_year = [v for d, v in items if d.year == date.year]
+
+            expected = []
+            for is_high, func in [(True, max), (False, min)]:
+                for kind, prev_values in [
+                    (RecordKindEnum.ALL_TIME, prev_all),
+                    (RecordKindEnum.WEEKS_52, prev_window),
+                    (RecordKindEnum.YEAR, prev_year),
+                ]:
+                    if not prev_values:
+                        continue
+
+                    prev_value = func(prev_values)
+                    if (value > prev_value) if is_high else (value < prev_value):
+                        expected.append((kind, is_high, prev_value))
+                        break
+
+            with self.subTest(date=date, value=value):
+                self.assertEqual(
+                    [(record.kind, record.is_high, record.prev_value) for record in records],
+                    expected,
+                )
+
+            items.append((date, value))
+
+
+class TestCaseAnalytics(unittest.TestCase):
+    def test_metrics(self):
+        values = np.array([10.0, 12.0, np.nan, 9.0, 15.0, 14.0, 20.0])
+        self.assertEqual(fill_forward(values).tolist(), [10, 12, 12, 9, 15, 14, 20])
+
+        values = fill_forward(values)
+        window = 3
+
+        sma = get_sma(values, window)
+        self.assertTrue(np.isnan(sma[:window - 1]).all())
+        for i in range(window - 1, len(values)):
+            self.assertAlmostEqual(sma[i], values[i - window + 1:i + 1].mean())
+
+        alpha = 2 / (window + 1)
+        ema = get_ema(values, window)
+        expected = values[0]
+        for i, value in enumerate(values):
+            expected = alpha * value + (1 - alpha) * expected
+            self.assertAlmostEqual(ema[i], expected)
+
+        returns = np.diff(np.log(values))
+        volatility = get_volatility(values, window)
+        self.assertTrue(np.isnan(volatility[:window]).all())
+        for i in range(window, len(values)):
+            self.assertAlmostEqual(volatility[i], returns[i - window:i].std(ddof=1) * 100)
+
+        self.assertEqual(
+            get_drawdown(np.array([10.0, 20.0, 15.0, 25.0])).tolist(), [0, 0, -25, 0]
+        )
+        self.assertEqual(
+            get_drawdown(np.array([20.0, 10.0, 15.0, 5.0]), window=2).tolist(), [0, -50, 0, -66.66666666666667]
+        )
+
+    def test_get_metric(self):
+        metal = MetalEnum.GOLD
+
+        history, sma = ANALYTICS.get_metric(AnalyticsMetricEnum.SMA, metal, window=5)
+        self.assertEqual(history.get_last_date(), MetalRate.get_last_date())
+        self.assertEqual(len(sma), len(history.dates))
+
+        # Повторный запрос возвращает закэшированный результат
+        _, sma_2 = ANALYTICS.get_metric(AnalyticsMetricEnum.SMA, metal, window=5)
+        self.assertIs(sma, sma_2)
+        self.assertFalse(sma.flags.writeable)
+
+        with self.assertRaises(ValueError):
+            ANALYTICS.get_metric(AnalyticsMetricEnum.EMA, metal)
+
+        metals, matrix = ANALYTICS.get_correlations(window=250)
+        self.assertEqual(metals, list(MetalEnum))
+        self.assertEqual(matrix.shape, (len(metals), len(metals)))
+        self.assertTrue(np.allclose(np.diag(matrix), 1))
+
+
 class TestCasePlot(unittest.TestCase):
     def test_draw_plot(self):
         locator = mdates.YearLocator(3)
@@ -211,6 +1275,92 @@ class TestCasePlot(unittest.TestCase):
                     photo = get_plot_for_metal(metal=metal, number=number)
                     assert photo.read()
 
+    def test_get_plot_for_metal_by_period(self):
+        last_year = MetalRate.get_last_date().year
+
+        for period in RollupPeriodEnum:
+            for number, year in [(-1, None), (10, None), (-1, last_year)]:
+                with self.subTest(msg=period.name, number=number, year=year):
+                    photo = get_plot_for_metal(
+                        metal=MetalEnum.GOLD, number=number, year=year, period=period
+                    )
+                    assert photo.read()
+
+    def test_get_plot_for_metal_with_overlays(self):
+        overlays = [
+            (AnalyticsMetricEnum.SMA, 20),
+            (AnalyticsMetricEnum.VOLATILITY, 20),
+            (AnalyticsMetricEnum.DRAWDOWN, None),
+        ]
+        last_year = MetalRate.get_last_date().year
+
+        for kwargs in [dict(number=31), dict(year=last_year), dict(period=RollupPeriodEnum.WEEK)]:
+            with self.subTest(**kwargs):
+                photo = get_plot_for_metal(metal=MetalEnum.GOLD, overlays=overlays, **kwargs)
+                assert photo.read()
+
+    def test_chart_presets(self):
+        signature_by_encoding = {
+            ChartEncodingEnum.PNG: b"\x89PNG",
+            ChartEncodingEnum.PNG_QUANTIZED: b"\x89PNG",
+            ChartEncodingEnum.WEBP: b"RIFF",
+        }
+
+        for preset in ChartPresetEnum:
+            with self.subTest(preset=preset):
+                photo = get_plot_for_metal(metal=MetalEnum.GOLD, number=31, preset=preset)
+                data = photo.read()
+                self.assertTrue(data.startswith(signature_by_encoding[preset.encoding]))
+
+                img = Image.open(BytesIO(data))
+                self.assertEqual(img.format.lower(), preset.encoding.extension)
+                self.assertEqual(img.size, tuple(round(x * preset.dpi) for x in preset.size))
+                if preset.encoding == ChartEncodingEnum.PNG_QUANTIZED:
+                    self.assertEqual(img.mode, "P")
+
+                photo = get_plot_for_metals(number=31, preset=preset)
+                self.assertTrue(photo.read().startswith(signature_by_encoding[preset.encoding]))
+
+    def test_get_plot_for_metals(self):
+        last_year = MetalRate.get_last_date().year
+
+        for normalized in [True, False]:
+            for kwargs in [dict(number=31), dict(year=last_year), dict(period=RollupPeriodEnum.WEEK)]:
+                with self.subTest(normalized=normalized, **kwargs):
+                    photo = get_plot_for_metals(normalized=normalized, **kwargs)
+                    assert photo.read()
+
+        # Металл без значений не рисуется
+        days = [DT.date(2022, 1, 1), DT.date(2022, 1, 2)]
+        photo = BytesIO()
+        draw_plot_comparison(
+            out=photo,
+            days=days,
+            metal_by_values={
+                MetalEnum.GOLD: np.array([1.0, 2.0]),
+                MetalEnum.SILVER: np.array([np.nan, np.nan]),
+            },
+        )
+        assert photo.read()
+
+    def test_get_period_last_indexes(self):
+        dates = np.arange(
+            np.datetime64("2021-12-01"), np.datetime64("2022-03-01"), dtype="datetime64[D]"
+        )
+        for period in RollupPeriodEnum:
+            with self.subTest(period=period):
+                expected = [
+                    i for i, date in enumerate(dates.tolist())
+                    if i == len(dates) - 1
+                    or period.get_period_start(date) != period.get_period_start(dates[i + 1].item())
+                ]
+                self.assertEqual(get_period_last_indexes(dates, period).tolist(), expected)
+
+        self.assertEqual(
+            get_period_last_indexes(np.array([], dtype="datetime64[D]"), RollupPeriodEnum.WEEK).tolist(),
+            [],
+        )
+
     def test_get_plot_for_xxx_by_number(self):
         for draw_func in [
             get_plot_for_gold,
@@ -233,5 +1383,1269 @@ class TestCasePlot(unittest.TestCase):
                     assert photo.read()
 
 
+class TestCaseLogger(unittest.TestCase):
+    def test_get_logger_queued(self):
+        # Файл лога остается открытым обработчиком логгера
+        with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as temp_dir:
+            file_name = Path(temp_dir) / "log.txt"
+            log = get_logger(f"test_{uuid4()}", file_name, log_stdout=False, queued=True)
+
+            log.debug("%s = %r", "debug", 1)
+            log.info("info")
+
+            # Перед остановкой поток записи обрабатывает все записи из очереди
+            stop_log_listener()
+            start_log_listener()
+
+            text = file_name.read_text("utf-8")
+            self.assertIn("debug = 1", text)
+            self.assertIn("info", text)
+
+    def test_get_logger_queued_child(self):
+        # Записи дочерних логгеров, как и без очереди, записываются обработчиками родителей
+        for queued in [False, True]:
+            with self.subTest(queued=queued), tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as temp_dir:
+                parent_file_name = Path(temp_dir) / "parent.txt"
+                child_file_name = Path(temp_dir) / "child.txt"
+
+                name = f"test_{uuid4()}"
+                parent_log = get_logger(name, parent_file_name, log_stdout=False, queued=queued)
+                child_log = get_logger(f"{name}.child", child_file_name, log_stdout=False, queued=queued)
+                logging.getLogger(f"{name}.other").info("from other")
+
+                parent_log.info("from parent")
+                child_log.info("from child")
+
+                stop_log_listener()
+                start_log_listener()
+
+                parent_text = parent_file_name.read_text("utf-8")
+                child_text = child_file_name.read_text("utf-8")
+                self.assertEqual(parent_text.count("from other"), 1)
+                self.assertEqual(parent_text.count("from parent"), 1)
+                self.assertEqual(parent_text.count("from child"), 1)
+                self.assertNotIn("from other", child_text)
+                self.assertNotIn("from parent", child_text)
+                self.assertEqual(child_text.count("from child"), 1)
+
+                for handler in parent_log.handlers + child_log.handlers:
+                    handler.close()
+
+    def test_get_logger_queued_mutable_args(self):
+        with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as temp_dir:
+            file_name = Path(temp_dir) / "log.txt"
+            log = get_logger(f"test_{uuid4()}", file_name, log_stdout=False, queued=True)
+
+            # Сообщение должно соответствовать состоянию аргументов на момент вызова
+            items = [1]
+            log.info("items=%s", items)
+            items.append(2)
+            log.info("value=%(value)s", {"value": items})
+            items.append(3)
+
+            stop_log_listener()
+            start_log_listener()
+
+            text = file_name.read_text("utf-8")
+            self.assertIn("items=[1]\n", text)
+            self.assertIn("value=[1, 2]\n", text)
+
+    def test_lazy_queue_handler_prepare(self):
+        handler = root_common._LazyQueueHandler(queue.SimpleQueue(), "test")
+
+        def get_record(args) -> logging.LogRecord:
+            return logging.LogRecord("test", logging.INFO, __file__, 0, "msg %s %s", args, None)
+
+        # Неизменяемые аргументы форматируются позже, в потоке записи логов
+        record = get_record((1, ("a", DT.date(2000, 1, 1))))
+        self.assertIs(handler.prepare(record), record)
+        self.assertEqual(record.msg, "msg %s %s")
+
+        # Изменяемые - сразу, в копии записи
+        record = get_record((1, [2]))
+        prepared = handler.prepare(record)
+        self.assertIsNot(prepared, record)
+        self.assertEqual(prepared.msg, "msg 1 [2]")
+        self.assertIsNone(prepared.args)
+        self.assertEqual(record.args, (1, [2]))
+
+        handler.enqueue(record)
+        self.assertEqual(handler.queue.get_nowait(), ("test", record))
+
+    def test_sampling_filter(self):
+        def get_record(level: int) -> logging.LogRecord:
+            return logging.LogRecord("test", level, __file__, 0, "msg", None, None)
+
+        log_filter = SamplingFilter(rate=0)
+        self.assertFalse(log_filter.filter(get_record(logging.DEBUG)))
+        self.assertTrue(log_filter.filter(get_record(logging.INFO)))
+        self.assertTrue(log_filter.filter(get_record(logging.ERROR)))
+
+        log_filter = SamplingFilter(rate=1)
+        self.assertTrue(log_filter.filter(get_record(logging.DEBUG)))
+
+
+
+class TestCaseChartCache(unittest.TestCase):
+    def test_get(self):
+        cache = ChartCache(max_items=2)
+
+        image = cache.get("a", version=1, render=lambda: b"a1")
+        self.assertEqual(image.data, b"a1")
+        self.assertTrue(image.etag)
+
+        # Повторный запрос берется из кэша
+        self.assertEqual(cache.get("a", version=1, render=lambda: b"a2"), image)
+        self.assertEqual((cache.hits, cache.renders), (1, 1))
+
+        # Вытеснение самого старого графика
+        cache.get("b", version=1, render=lambda: b"b1")
+        cache.get("a", version=1, render=lambda: b"a2")
+        cache.get("c", version=1, render=lambda: b"c1")
+        self.assertEqual(cache.get("a", version=1, render=lambda: b"a3").data, b"a1")
+        self.assertEqual(cache.get("b", version=1, render=lambda: b"b2").data, b"b2")
+
+        # Новая версия данных сбрасывает кэш
+        image = cache.get("a", version=2, render=lambda: b"a4")
+        self.assertEqual(image.data, b"a4")
+        self.assertNotEqual(image.etag, cache.get("b", version=2, render=lambda: b"b3").etag)
+
+    def test_render_errors(self):
+        cache = ChartCache()
+
+        def _render() -> bytes:
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            cache.get("a", version=1, render=_render)
+        self.assertEqual(cache.get("a", version=1, render=lambda: b"a").data, b"a")
+
+    def test_concurrency(self):
+        cache = ChartCache(max_renders=1, render_timeout_secs=0.05)
+        render_started = threading.Event()
+        render_finished = threading.Event()
+
+        def _render_slow() -> bytes:
+            render_started.set()
+            render_finished.wait(5)
+            return b"slow"
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(cache.get("a", version=1, render=_render_slow).data)
+            )
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        render_started.wait(5)
+
+        # Слот рисования занят, другой график не дождется своей очереди
+        with self.assertRaises(ChartRenderBusyError):
+            cache.get("b", version=1, render=lambda: b"b")
+
+        render_finished.set()
+        for thread in threads:
+            thread.join()
+
+        # Одинаковые запросы дождались одного рисования
+        self.assertEqual(results, [b"slow"] * 3)
+        self.assertEqual(cache.renders, 1)
+
+        self.assertEqual(cache.get("b", version=1, render=lambda: b"b").data, b"b")
+
+    def test_no_double_render(self):
+        cache = ChartCache()
+        single_flight_do = cache._single_flight.do
+        renders = []
+
+        def _render() -> bytes:
+            renders.append(len(renders))
+            return b"a"
+
+        other_requests = [lambda: cache.get("a", version=1, render=_render)]
+
+        def _do(key, func):
+            # Другой запрос нарисовал график после проверки кэша, но до начала рисования
+            if other_requests:
+                other_requests.pop()()
+            return single_flight_do(key, func)
+
+        with mock.patch.object(cache._single_flight, "do", _do):
+            self.assertEqual(cache.get("a", version=1, render=_render).data, b"a")
+
+        self.assertEqual(renders, [0])
+        self.assertEqual(cache.renders, 1)
+
+
+class TestCaseWebChart(unittest.TestCase):
+    def setUp(self):
+        self.client = web_main.app.test_client()
+
+        cache_patcher = mock.patch.object(web_main, "CHART_CACHE", ChartCache())
+        self.cache = cache_patcher.start()
+        self.addCleanup(cache_patcher.stop)
+
+    def test_bad_params(self):
+        for query in [
+            "days=abc", "year=abc", "days=", "days=0", "days=-2", "days=7&year=2021"
+        ]:
+            with self.subTest(query=query):
+                rs = self.client.get(f"/chart/gold.png?{query}")
+                self.assertEqual(rs.status_code, 400)
+
+        self.assertEqual(self.cache.renders, 0)
+
+    def test_not_found(self):
+        for url in ["/chart/unknown.png", "/chart/gold.png?year=1900"]:
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 404)
+
+        with self.subTest(msg="Нет курсов"):
+            with mock.patch.object(web_main, "get_plot_for_metal", side_effect=NoDataError()):
+                self.assertEqual(self.client.get("/chart/gold.png?days=7").status_code, 404)
+
+    def test_cache(self):
+        rs = self.client.get("/chart/gold.png?days=7")
+        self.assertEqual(rs.status_code, 200)
+        self.assertEqual(rs.mimetype, web_main.CHART_PRESET.encoding.mime_type)
+        self.assertTrue(rs.data.startswith(b"\x89PNG"))
+        etag, _ = rs.get_etag()
+        self.assertTrue(etag)
+        self.assertEqual((self.cache.hits, self.cache.renders), (0, 1))
+
+        # Данные не изменились: график берется из кэша
+        rs = self.client.get("/chart/gold.png?days=7")
+        self.assertEqual(rs.status_code, 200)
+        self.assertEqual(rs.get_etag(), (etag, False))
+        self.assertEqual((self.cache.hits, self.cache.renders), (1, 1))
+
+        # Совпадающий If-None-Match: 304 без тела
+        rs = self.client.get("/chart/gold.png?days=7", headers={"If-None-Match": f'"{etag}"'})
+        self.assertEqual(rs.status_code, 304)
+        self.assertEqual(rs.data, b"")
+        self.assertEqual((self.cache.hits, self.cache.renders), (2, 1))
+
+        # Другие параметры - другой график
+        rs = self.client.get("/chart/gold.png?days=8", headers={"If-None-Match": f'"{etag}"'})
+        self.assertEqual(rs.status_code, 200)
+        self.assertNotEqual(rs.get_etag(), (etag, False))
+        self.assertEqual(self.cache.renders, 2)
+
+
+class TestCaseRatesEventsServer(unittest.TestCase):
+    class FakeSource:
+        def __init__(self):
+            self.item_by_date: dict[DT.date, dict] = dict()
+            self.add(DT.date(2000, 1, 3))
+
+        def add(self, date: DT.date):
+            # Новый словарь, чтобы поток сервера не читал изменяемый
+            self.item_by_date = {**self.item_by_date, date: dict(date_iso=date.isoformat())}
+
+        def get_last_date(self) -> DT.date:
+            return max(self.item_by_date)
+
+        def get_items_after(self, date: DT.date, end_date: DT.date) -> list[dict]:
+            return [
+                item for item_date, item in sorted(self.item_by_date.items())
+                if date < item_date <= end_date
+            ]
+
+    def setUp(self):
+        self.source = self.FakeSource()
+        self.server = RatesEventsServer(
+            source=self.source, poll_secs=0.05, heartbeat_secs=0.05, max_clients=3
+        )
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def connect(self, target: str, headers: dict[str, str] = None) -> socket.socket:
+        sock = socket.create_connection(self.server.address, timeout=5)
+        self.addCleanup(sock.close)
+
+        lines = [f"GET {target} HTTP/1.1", "Host: localhost"]
+        lines += [f"{name}: {value}" for name, value in (headers or dict()).items()]
+        sock.sendall(("\r\n".join(lines) + "\r\n\r\n").encode("utf-8"))
+        return sock
+
+    def read_until(self, sock: socket.socket, text: str) -> str:
+        data = b""
+        while text.encode("utf-8") not in data:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        return data.decode("utf-8")
+
+    def read_all(self, sock: socket.socket) -> str:
+        return self.read_until(sock, "\0")
+
+    def wait_clients(self, number: int):
+        end_time = time.monotonic() + 5
+        while self.server.clients != number and time.monotonic() < end_time:
+            time.sleep(0.01)
+        self.assertEqual(self.server.clients, number)
+
+    def get_events(self, data: str) -> list[tuple[str, list[str]]]:
+        items = []
+        for event in data.split("\n\n"):
+            lines = event.strip().splitlines()
+            if lines and lines[0].startswith("id: "):
+                data_items = json.loads(lines[2].removeprefix("data: "))
+                items.append((lines[0].removeprefix("id: "), [item["date_iso"] for item in data_items]))
+        return items
+
+    def test_stream(self):
+        sock = self.connect("/events?last_date=2000-01-03")
+        data = self.read_until(sock, f"retry: {RETRY_MS}\n\n")
+        self.assertTrue(data.startswith("HTTP/1.1 200 OK\r\n"))
+        self.assertIn("Content-Type: text/event-stream", data)
+
+        # Пустые сообщения для поддержания соединения
+        self.read_until(sock, ": ping\n\n")
+
+        self.source.add(DT.date(2000, 1, 4))
+        data = self.read_until(sock, "event: rates")
+        data += self.read_until(sock, "\n\n")
+        self.assertEqual(self.get_events(data), [("2000-01-04", ["2000-01-04"])])
+
+        # Отстающий клиент сразу получает все пропущенные записи
+        sock = self.connect("/events", headers={"Last-Event-ID": "2000-01-01"})
+        data = self.read_until(sock, "event: rates")
+        data += self.read_until(sock, "\n\n")
+        self.assertEqual(
+            self.get_events(data), [("2000-01-04", ["2000-01-03", "2000-01-04"])]
+        )
+
+    def test_bad_requests(self):
+        for target, status in [
+            ("/events?last_date=abc", "400 Bad Request"),
+            ("/unknown", "404 Not Found"),
+        ]:
+            with self.subTest(target=target):
+                data = self.read_all(self.connect(target))
+                self.assertTrue(data.startswith(f"HTTP/1.1 {status}\r\n"))
+
+        self.assertEqual(self.server.clients, 0)
+
+    def test_max_clients(self):
+        socks = [self.connect("/events") for _ in range(self.server.max_clients)]
+        for sock in socks:
+            self.read_until(sock, f"retry: {RETRY_MS}\n\n")
+        self.wait_clients(self.server.max_clients)
+
+        # Лишнее подключение получает пустой поток с увеличенной задержкой переподключения,
+        # ответ с ошибкой EventSource не стал бы повторять
+        data = self.read_all(self.connect("/events"))
+        self.assertTrue(data.startswith("HTTP/1.1 200 OK\r\n"))
+        retry_ms = int(data.split("retry: ")[1].split("\n")[0])
+        self.assertGreaterEqual(retry_ms, RETRY_BUSY_MS)
+        self.assertEqual(self.server.clients, self.server.max_clients)
+
+        # Отключение клиента освобождает место
+        socks.pop().close()
+        self.wait_clients(self.server.max_clients - 1)
+
+        sock = self.connect("/events")
+        self.read_until(sock, f"retry: {RETRY_MS}\n\n")
+        self.wait_clients(self.server.max_clients)
+
+    def test_single_thread(self):
+        self.server.max_clients = 50
+        threads = threading.active_count()
+
+        socks = [self.connect("/events") for _ in range(self.server.max_clients)]
+        self.wait_clients(self.server.max_clients)
+
+        # Все подключения обслуживаются одним потоком сервера
+        self.assertEqual(threading.active_count(), threads)
+
+        self.source.add(DT.date(2000, 1, 4))
+        for sock in socks:
+            data = self.read_until(sock, "event: rates")
+            data += self.read_until(sock, "\n\n")
+            self.assertEqual(self.get_events(data), [("2000-01-04", ["2000-01-04"])])
+
+
+class TestCaseRouter(unittest.TestCase):
+    @staticmethod
+    def get_callback(name: str):
+        return lambda update, context: name
+
+    def test_get_callback_code(self):
+        self.assertEqual(get_callback_code(PATTERN_INLINE_GET_AS_CHART), "c")
+        self.assertEqual(get_callback_code(PATTERN_INLINE_GET_BY_DATE), "d")
+        with self.assertRaises(ValueError):
+            get_callback_code(PATTERN_INLINE_GET_AS_CHART_LEGACY)
+
+    def test_callback_query_router(self):
+        on_chart = self.get_callback("chart")
+        on_date = self.get_callback("date")
+
+        router = CallbackQueryRouter()
+        router.add(PATTERN_INLINE_GET_AS_CHART, on_chart, PATTERN_INLINE_GET_AS_CHART_LEGACY)
+        router.add(PATTERN_INLINE_GET_BY_DATE, on_date)
+        with self.assertRaises(ValueError):
+            router.add(PATTERN_INLINE_GET_BY_DATE, on_date)
+
+        for data, callback, groups in [
+            (fill_string_pattern(PATTERN_INLINE_GET_AS_CHART, 31, "GOLD"), on_chart, ("31", "GOLD")),
+            (fill_string_pattern(PATTERN_INLINE_GET_AS_CHART_LEGACY, 7, "SILVER"), on_chart, ("7", "SILVER")),
+            (fill_string_pattern(PATTERN_INLINE_GET_BY_DATE, "2022-04-01"), on_date, ("2022-04-01",)),
+        ]:
+            with self.subTest(data=data):
+                update = Update.de_json(get_callback_query_update(1, data), bot=None)
+                result = router.check_update(update)
+                self.assertIsNotNone(result)
+                self.assertEqual(result[0], callback)
+                self.assertEqual(result[1].groups(), groups)
+
+        for data in ["unknown:1", "c:31", "get_by_date=2022-04-01", ""]:
+            with self.subTest(data=data):
+                update = Update.de_json(get_callback_query_update(1, data), bot=None)
+                self.assertIsNone(router.check_update(update))
+
+        # Текстовые сообщения обрабатываются другим маршрутизатором
+        update = Update.de_json(get_message_update(1, "c:31:GOLD"), bot=None)
+        self.assertIsNone(router.check_update(update))
+
+    def test_metal_callback_code(self):
+        for metal in MetalEnum:
+            with self.subTest(metal=metal):
+                self.assertEqual(get_metal_by_callback_code(CALLBACK_CODE_BY_METAL[metal]), metal)
+
+                # Кнопки уже отправленных сообщений содержат название металла
+                self.assertEqual(get_metal_by_callback_code(metal.name), metal)
+
+        with self.assertRaises(KeyError):
+            get_metal_by_callback_code("unknown")
+
+        keyboard = get_inline_keyboard_for_metal_switch_in_chart(MetalEnum.GOLD, -1)
+        self.assertEqual(
+            [button.callback_data for row in keyboard.inline_keyboard for button in row],
+            ["c:-1:au", "c:-1:ag", "c:-1:pt", "c:-1:pd", f"c:-1:{CALLBACK_ALL_METALS}"],
+        )
+
+        with mock.patch.object(MetalRateYear, "get_prev_next_years", return_value=(2021, 2023)):
+            keyboard = commands.get_inline_keyboard_for_year_pagination(MetalEnum.PALLADIUM, 2022)
+        for row in keyboard.inline_keyboard:
+            for button in row:
+                match = PATTERN_INLINE_GET_CHART_METAL_BY_YEAR.match(button.callback_data)
+                self.assertIsNotNone(match)
+                self.assertNotIn("PALLADIUM", button.callback_data)
+
+    def test_text_router(self):
+        on_text = self.get_callback("text")
+        on_default = self.get_callback("default")
+
+        router = TextRouter(default_callback=on_default)
+        text = fill_string_pattern(PATTERN_REPLY_GET_AS_TEXT)
+        router.add(PATTERN_REPLY_GET_AS_TEXT, on_text, texts=[text])
+        with self.assertRaises(ValueError):
+            router.add(PATTERN_REPLY_GET_AS_TEXT, on_text, texts=["unknown"])
+
+        for text, callback in [
+            (text, on_text),
+            (text.upper(), on_text),
+            (text + "!", on_default),
+            ("/unknown", on_default),
+        ]:
+            with self.subTest(text=text):
+                update = Update.de_json(get_message_update(1, text), bot=None)
+                result = router.check_update(update)
+                self.assertEqual(result[0], callback)
+
+        update = Update.de_json(get_callback_query_update(1, text), bot=None)
+        self.assertIsNone(router.check_update(update))
+
+    def test_text_router_as_regex_handlers(self):
+        dp = mock.Mock()
+        commands.setup(dp)
+        router = next(
+            call.args[0] for call in dp.add_handler.call_args_list
+            if isinstance(call.args[0], TextRouter)
+        )
+
+        # Обработчики в порядке старых MessageHandler(Filters.regex(...)), последний - для любого текста
+        old_handlers = [
+            (PATTERN_REPLY_ADMIN_STATS, commands.on_admin_stats, commands.FILTER_BY_ADMIN),
+            (PATTERN_REPLY_GET_AS_TEXT, commands.on_get_as_text, None),
+            (PATTERN_REPLY_SELECT_DATE, commands.on_select_date, None),
+            (PATTERN_REPLY_GET_LAST_7_AS_CHART, commands.on_get_last_7_as_chart, None),
+            (PATTERN_REPLY_GET_LAST_31_AS_CHART, commands.on_get_last_31_as_chart, None),
+            (PATTERN_REPLY_GET_ALL_AS_CHART, commands.on_get_all_as_chart, None),
+            (PATTERN_REPLY_SUBSCRIBE, commands.on_subscribe, None),
+            (PATTERN_REPLY_UNSUBSCRIBE, commands.on_unsubscribe, None),
+            (PATTERN_REPLY_ALERTS, commands.on_alerts, None),
+        ]
+
+        def get_old_callback(update: Update):
+            for pattern, callback, filters in old_handlers:
+                if pattern.search(update.effective_message.text) and (not filters or filters(update)):
+                    return callback
+            return commands.on_request
+
+        texts = []
+        for pattern, _, _ in old_handlers[1:]:
+            text = fill_string_pattern(pattern)
+            texts += [text, text.upper(), text.lower(), text + "\n", text + "!", " " + text]
+        texts += [
+            "admin stats", "ADMIN_STATS", "Статистика админа", "admin stats!",
+            "Выбрать дату 📅", "выбрать дату и время", "Подписаться 🔔", "привет", "/unknown",
+        ]
+
+        for username in ["user_1", USER_NAME_ADMINS[0].lstrip("@")]:
+            for text in texts:
+                with self.subTest(username=username, text=text):
+                    data = get_message_update(1, text)
+                    data["message"]["from"]["username"] = username
+                    update = Update.de_json(data, bot=None)
+
+                    callback, match = router.check_update(update)
+                    self.assertEqual(callback, get_old_callback(update))
+                    if callback != commands.on_request:
+                        self.assertIsNotNone(match)
+
+
+class TestCaseSnapshot(unittest.TestCase):
+    def test_publish_snapshot(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            dir_snapshot = Path(dir_name) / "snapshot"
+            self.assertFalse(has_snapshot(dir_snapshot))
+
+            # Повторная публикация должна заменять файлы
+            for _ in range(2):
+                self.assertEqual(publish_snapshot(dir_snapshot), dir_snapshot)
+                self.assertTrue(has_snapshot(dir_snapshot))
+
+            self.assertTrue((dir_snapshot / "static").is_dir())
+            self.assertEqual(
+                sorted(p.name for p in dir_snapshot.iterdir()),
+                sorted(["static", FILE_NAME_DATA, FILE_NAME_INDEX]),
+            )
+
+            data = json.loads((dir_snapshot / FILE_NAME_DATA).read_text("utf-8"))
+            self.assertEqual(data["last_date"], str(MetalRate.get_last_date()))
+            self.assertEqual(len(data["items"]), MetalRate.count())
+
+            html = (dir_snapshot / FILE_NAME_INDEX).read_text("utf-8")
+            self.assertIn("/static/", html)
+            self.assertIn(data["items"][-1]["date_iso"], html)
+
+            # Страница совпадает с той, что рисует веб-сервер без статической копии
+            with mock.patch.object(web_main.config, "SERVE_SNAPSHOT", False):
+                rs = web_main.app.test_client().get("/")
+            self.assertEqual(rs.get_data(as_text=True), html)
+
+    def test_without_web_app(self):
+        # Парсер публикует копию, но не должен загружать Flask-приложение и его логи
+        code = (
+            "import sys; import app_web_server.snapshot; "
+            "print('app_web_server.app' in sys.modules, 'flask' in sys.modules)"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=DIR.parent,
+            env={**os.environ, "PYTHONPATH": str(DIR.parent)},
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        self.assertEqual(result.stdout.strip(), "False False")
+
+
+class TestCaseMetrics(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram("test_seconds", "Тест", buckets=(1, 2, 4))
+        self.assertEqual(histogram.get_count(), 0)
+        self.assertEqual(histogram.get_quantile(0.5), 0.0)
+
+        for value in [0.5, 0.5, 1.5, 1.5]:
+            histogram.observe(value, handler="a")
+        histogram.observe(10, handler="b")
+        self.assertEqual(histogram.get_count(), 5)
+
+        # Корзины накопительные: значение учитывается во всех корзинах с границей не меньше него
+        items = {item["labels"]["handler"]: item for item in histogram.to_dict()["items"]}
+        self.assertEqual(items["a"]["buckets"], {"1": 2, "2": 4, "4": 4})
+        self.assertEqual(items["a"]["count"], 4)
+        self.assertEqual(items["a"]["sum"], 4.0)
+        self.assertEqual(items["a"]["avg"], 1.0)
+        self.assertEqual(items["b"]["buckets"], {"1": 0, "2": 0, "4": 0})
+        self.assertEqual(items["b"]["count"], 1)
+
+    def test_histogram_quantile(self):
+        histogram = Histogram("test_seconds", "Тест", buckets=(1, 2, 4))
+        for value in [0.5, 0.5, 1.5, 1.5]:
+            histogram.observe(value)
+
+        # Линейная интерполяция внутри корзины
+        self.assertAlmostEqual(histogram.get_quantile(0.25), 0.5)
+        self.assertAlmostEqual(histogram.get_quantile(0.5), 1.0)
+        self.assertAlmostEqual(histogram.get_quantile(0.75), 1.5)
+        self.assertAlmostEqual(histogram.get_quantile(1), 2.0)
+
+        # Значения больше последней границы оцениваются этой границей
+        for _ in range(10):
+            histogram.observe(100)
+        self.assertEqual(histogram.get_quantile(0.99), 4)
+
+    def test_histogram_time(self):
+        histogram = Histogram("test_seconds", "Тест", buckets=(1,))
+        with histogram.time(handler="a"):
+            pass
+
+        with self.assertRaises(ValueError):
+            with histogram.time(handler="a"):
+                raise ValueError()
+
+        # Время учитывается и при исключении
+        self.assertEqual(histogram.get_count(), 2)
+
+    def test_counter_gauge(self):
+        counter = Counter("test_total", "Тест")
+        counter.inc()
+        counter.inc(2, lane="chart")
+        counter.inc(lane="chart")
+        self.assertEqual(counter.get(), 1)
+        self.assertEqual(counter.get(lane="chart"), 3)
+        self.assertEqual(counter.get(lane="text"), 0)
+        self.assertEqual(counter.get_total(), 4)
+
+        gauge = Gauge("test_depth", "Тест")
+        gauge.set(5, lane="chart")
+        gauge.set(2, lane="chart")
+        gauge.inc(lane="text")
+        self.assertEqual(gauge.get(lane="chart"), 2)
+        self.assertEqual(gauge.get_total(), 3)
+
+    def test_prometheus(self):
+        self.assertEqual(get_labels_str(dict()), "")
+        self.assertEqual(get_labels_str(dict(a="1", b=2)), '{a="1",b="2"}')
+
+        histogram = Histogram("test_seconds", "Тест", buckets=(1, 2))
+        histogram.observe(1.5, handler="a")
+        self.assertEqual(
+            histogram.to_prometheus().splitlines(),
+            [
+                "# HELP test_seconds Тест",
+                "# TYPE test_seconds histogram",
+                'test_seconds_bucket{handler="a",le="1"} 0',
+                'test_seconds_bucket{handler="a",le="2"} 1',
+                'test_seconds_bucket{handler="a",le="+Inf"} 1',
+                'test_seconds_sum{handler="a"} 1.5',
+                'test_seconds_count{handler="a"} 1',
+            ],
+        )
+
+        counter = Counter("test_total", "Тест")
+        counter.inc(3, lane="chart")
+        self.assertEqual(
+            counter.to_prometheus().splitlines(),
+            [
+                "# HELP test_total Тест",
+                "# TYPE test_total counter",
+                'test_total{lane="chart"} 3',
+            ],
+        )
+
+        gauge = Gauge("test_depth", "Тест")
+        gauge.set(7)
+        self.assertEqual(
+            gauge.to_prometheus().splitlines(),
+            [
+                "# HELP test_depth Тест",
+                "# TYPE test_depth gauge",
+                "test_depth 7",
+            ],
+        )
+
+    def test_exposition(self):
+        text = get_metrics_as_prometheus()
+        self.assertTrue(text.endswith("\n"))
+        for metric in METRICS:
+            self.assertIn(f"# TYPE {metric.name} ", text)
+
+        items = json.loads(get_metrics_as_json())
+        self.assertEqual([item["name"] for item in items], [metric.name for metric in METRICS])
+        for item in items:
+            self.assertIsInstance(item["items"], list)
+
+
+class TestCaseProgressTicker(unittest.TestCase):
+    @staticmethod
+    def get_update(chat_id: int = 1) -> mock.Mock:
+        update = mock.Mock()
+        update.effective_chat.id = chat_id
+        return update
+
+    def get_item(self, chat_id: int = 1, progress_value: ProgressValue = ProgressValue.POINTS) -> _ProgressItem:
+        return _ProgressItem(
+            text="In progress {value}",
+            update=self.get_update(chat_id),
+            progress_value=progress_value,
+        )
+
+    def test_show_delay(self):
+        # Поток не запускается, элементы обрабатываются вручную
+        ticker = ProgressTicker()
+        with mock.patch.object(auto_in_progress_message, "_TICKER", ticker):
+            update = self.get_update()
+
+            # Обработчик завершился раньше задержки - сообщение не отправляется
+            with show_temp_message("...", update, context=None, show_delay=60) as temp_message:
+                self.assertEqual(len(ticker._heap), 1)
+
+            item = temp_message.item
+            self.assertTrue(item.is_stopped())
+
+            # Когда срок элемента наступит, он будет выброшен из очереди без отправки
+            *_, queued_item = ticker._heap.pop()
+            self.assertIs(queued_item, item)
+            ticker._handle(queued_item)
+            update.effective_message.reply_text.assert_not_called()
+            self.assertEqual(ticker._heap, [])
+
+            # Обработчик дольше задержки - сообщение отправит поток и удалит при выходе
+            update = self.get_update()
+            with show_temp_message("...", update, context=None, show_delay=0.001) as temp_message:
+                ticker._handle(ticker._get_next_item())
+                update.effective_message.reply_text.assert_called_once()
+                self.assertTrue(temp_message.item.is_posted())
+                self.assertEqual(ticker._heap, [])  # Без прогресса изменять нечего
+
+            temp_message.message.delete.assert_called_once()
+
+            # Без задержки сообщение отправляется сразу
+            update = self.get_update()
+            with show_temp_message("...", update, context=None):
+                update.effective_message.reply_text.assert_called_once()
+
+    def test_spacing(self):
+        ticker = ProgressTicker(interval=1, chat_interval=100, global_interval=0)
+        item_1 = self.get_item(chat_id=1)
+        item_2 = self.get_item(chat_id=1)
+        item_3 = self.get_item(chat_id=2)
+
+        for item in [item_1, item_2, item_3]:
+            self.assertEqual(ticker._process(item), ticker.interval)
+            self.assertTrue(item.is_posted())
+
+        # Первое изменение в чате выполняется сразу
+        self.assertEqual(ticker._process(item_1), ticker.interval)
+        item_1.message.edit_text.assert_called_once()
+
+        # Следующее изменение в этом же чате, даже другого сообщения, откладывается
+        self.assertGreater(ticker._process(item_1), 99)
+        self.assertGreater(ticker._process(item_2), 99)
+        item_1.message.edit_text.assert_called_once()
+        item_2.message.edit_text.assert_not_called()
+
+        # Другие чаты не ждут
+        self.assertEqual(ticker._process(item_3), ticker.interval)
+        item_3.message.edit_text.assert_called_once()
+
+        # Общий интервал действует на все чаты
+        ticker = ProgressTicker(interval=1, chat_interval=0, global_interval=100)
+        item_1 = self.get_item(chat_id=1)
+        item_2 = self.get_item(chat_id=2)
+        ticker._process(item_1)
+        ticker._process(item_2)
+        self.assertEqual(ticker._process(item_1), ticker.interval)
+        self.assertGreater(ticker._process(item_2), 99)
+        item_2.message.edit_text.assert_not_called()
+
+    def test_remove_finished(self):
+        ticker = ProgressTicker(interval=0, chat_interval=0, global_interval=0)
+        item = self.get_item()
+        ticker.add(item, delay=0)
+
+        ticker._handle(ticker._get_next_item())  # Отправка
+        ticker._handle(ticker._get_next_item())  # Изменение
+        item.message.edit_text.assert_called_once()
+        self.assertEqual(len(ticker._heap), 1)
+
+        item.stop()
+        item.message.delete.assert_called_once()
+
+        ticker._handle(ticker._get_next_item())
+        self.assertEqual(ticker._heap, [])
+        item.message.edit_text.assert_called_once()
+
+        # Без прогресса элемент удаляется после отправки
+        item = self.get_item(progress_value=None)
+        ticker.add(item, delay=0)
+        ticker._handle(ticker._get_next_item())
+        self.assertTrue(item.is_posted())
+        self.assertEqual(ticker._heap, [])
+
+        # Ошибка при обработке тоже удаляет элемент
+        item = self.get_item()
+        item.update.effective_message.reply_text.side_effect = Exception()
+        ticker.add(item, delay=0)
+        ticker._handle(ticker._get_next_item())
+        self.assertEqual(ticker._heap, [])
+
+    def test_chat_by_last_edit_cleanup(self):
+        ticker = ProgressTicker(interval=1, chat_interval=0, global_interval=0)
+        for chat_id in range(1002):
+            item = self.get_item(chat_id=chat_id)
+            ticker._process(item)
+            ticker._process(item)
+
+        # Устаревшие отметки времени по чатам удаляются
+        self.assertLess(len(ticker._chat_by_last_edit), 1000)
+
+
+class TestCaseSingleFlight(unittest.TestCase):
+    class CountingEvent(threading.Event):
+        """
+        Событие, которое считает ожидающие потоки
+        """
+
+        def __init__(self):
+            super().__init__()
+            self.waiters = threading.Semaphore(0)
+
+        def wait(self, timeout=None):
+            self.waiters.release()
+            return super().wait(timeout)
+
+    def run_concurrent(self, single_flight: SingleFlight, func, number: int = 5) -> list:
+        """
+        Первый вызов выполняет func, остальные запускаются, пока он не завершен.
+        Возвращает результаты (или исключения) всех вызовов
+        """
+
+        key = "key"
+        started = threading.Event()
+        release = threading.Event()
+
+        def leader_func():
+            started.set()
+            release.wait(timeout=10)
+            return func()
+
+        results = [None] * number
+
+        def run(i: int, f):
+            try:
+                results[i] = single_flight.do(key, f)
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=run, args=(0, leader_func))]
+        threads[0].start()
+        self.assertTrue(started.wait(timeout=10))
+
+        # Ожидающие вызовы будут ждать на подмененном событии
+        event = single_flight._key_by_call[key].event = self.CountingEvent()
+
+        for i in range(1, number):
+            thread = threading.Thread(target=run, args=(i, self.fail))
+            thread.start()
+            threads.append(thread)
+
+        for _ in range(1, number):
+            self.assertTrue(event.waiters.acquire(timeout=10))
+
+        release.set()
+        for thread in threads:
+            thread.join(timeout=10)
+
+        return results
+
+    def test_shared(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        def func():
+            calls.append(1)
+            return object()
+
+        results = self.run_concurrent(single_flight, func)
+        self.assertEqual(len(calls), 1)
+
+        result = results[0][0]
+        self.assertEqual(results, [(result, False)] + [(result, True)] * 4)
+
+    def test_error(self):
+        single_flight = SingleFlight()
+        error = ValueError("error")
+
+        def func():
+            raise error
+
+        results = self.run_concurrent(single_flight, func)
+        self.assertEqual(results, [error] * 5)
+
+        # После ошибки ключ освобожден и следующий вызов выполняется заново
+        self.assertEqual(single_flight._key_by_call, dict())
+        self.assertEqual(single_flight.do("key", lambda: 1), (1, False))
+
+    def test_release_key(self):
+        single_flight = SingleFlight()
+        self.run_concurrent(single_flight, lambda: 1)
+        self.assertEqual(single_flight._key_by_call, dict())
+
+        # Последовательные вызовы не объединяются
+        self.assertEqual(single_flight.do("key", lambda: 2), (2, False))
+        self.assertEqual(single_flight.do("key", lambda: 3), (3, False))
+
+        # Вызов с другим ключом во время выполнения не ждет
+        def func():
+            return single_flight.do("other", lambda: 4)
+
+        self.assertEqual(single_flight.do("key", func), ((4, False), False))
+        self.assertEqual(single_flight._key_by_call, dict())
+
+
+class TestCaseLatestWins(unittest.TestCase):
+    def test_generations(self):
+        latest_wins = LatestWins()
+
+        generation_1 = latest_wins.start("key")
+        self.assertEqual(generation_1, 1)
+        self.assertTrue(latest_wins.is_latest("key", generation_1))
+        self.assertFalse(latest_wins.wait_superseded("key", generation_1, timeout=0.01))
+
+        generation_2 = latest_wins.start("key")
+        self.assertEqual(generation_2, 2)
+        self.assertFalse(latest_wins.is_latest("key", generation_1))
+        self.assertTrue(latest_wins.is_latest("key", generation_2))
+        self.assertTrue(latest_wins.wait_superseded("key", generation_1, timeout=0))
+
+        # Другие ключи независимы
+        self.assertEqual(latest_wins.start("other"), 1)
+        latest_wins.finish("other", 1)
+
+        # Завершение устаревшего запроса не сбрасывает последний
+        latest_wins.finish("key", generation_1)
+        self.assertTrue(latest_wins.is_latest("key", generation_2))
+
+        latest_wins.finish("key", generation_2)
+        self.assertEqual(latest_wins._key_by_generation, dict())
+        self.assertEqual(latest_wins._key_by_lock, dict())
+        self.assertEqual(latest_wins.start("key"), 1)
+
+    def test_wait_superseded(self):
+        latest_wins = LatestWins()
+        generation = latest_wins.start("key")
+
+        timer = threading.Timer(0.05, latest_wins.start, args=("key",))
+        timer.start()
+
+        # Ожидание прерывается новым запросом, не дожидаясь таймаута
+        start_time = time.monotonic()
+        self.assertTrue(latest_wins.wait_superseded("key", generation, timeout=10))
+        self.assertLess(time.monotonic() - start_time, 5)
+        timer.join()
+
+    @staticmethod
+    def get_update(message_id: int = 1) -> mock.Mock:
+        update = mock.Mock()
+        update.effective_message.chat_id = 1
+        update.effective_message.message_id = message_id
+        update.callback_query.message.reply_markup = InlineKeyboardMarkup([])
+        return update
+
+    @staticmethod
+    def get_reply_markup(text: str) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=text)]])
+
+    def test_single_press_without_delay(self):
+        update = self.get_update()
+        with (
+            mock.patch.object(common, "CHART_DEBOUNCE_DELAY_SECS", 10),
+            mock.patch.object(common, "get_plot_for_metal", return_value=b"1"),
+        ):
+            start_time = time.monotonic()
+            common.reply_or_edit_plot_with_keyboard(
+                update, MetalEnum.GOLD, reply_markup=self.get_reply_markup("1")
+            )
+            self.assertLess(time.monotonic() - start_time, 5)
+
+        update.effective_message.edit_media.assert_called_once()
+        self.assertEqual(common.CHART_LATEST_WINS._key_by_generation, dict())
+
+    def test_superseded_press(self):
+        update = self.get_update()
+        started = threading.Event()
+        release = threading.Event()
+
+        def get_plot_for_metal(metal, **kwargs) -> bytes:
+            # Первый запрос рисуется, пока не придет второй
+            if metal == MetalEnum.GOLD:
+                started.set()
+                self.assertTrue(release.wait(timeout=10))
+            return metal.name.encode()
+
+        with (
+            mock.patch.object(common, "CHART_DEBOUNCE_DELAY_SECS", 0.01),
+            mock.patch.object(common, "get_plot_for_metal", get_plot_for_metal),
+        ):
+            thread = threading.Thread(
+                target=common.reply_or_edit_plot_with_keyboard,
+                args=(update, MetalEnum.GOLD),
+                kwargs=dict(reply_markup=self.get_reply_markup("gold")),
+            )
+            thread.start()
+            self.assertTrue(started.wait(timeout=10))
+
+            common.reply_or_edit_plot_with_keyboard(
+                update, MetalEnum.SILVER, reply_markup=self.get_reply_markup("silver")
+            )
+
+            release.set()
+            thread.join(timeout=10)
+
+        # Сообщение изменено только последним запросом, результат первого отброшен
+        update.effective_message.edit_media.assert_called_once()
+        call_kwargs = update.effective_message.edit_media.call_args.kwargs
+        self.assertEqual(call_kwargs["reply_markup"], self.get_reply_markup("silver"))
+        self.assertEqual(call_kwargs["media"].media.input_file_content, b"SILVER")
+        self.assertEqual(common.CHART_LATEST_WINS._key_by_generation, dict())
+
+    def test_burst(self):
+        update = self.get_update()
+        release = threading.Event()
+        calls = []
+
+        def get_plot_for_metal(metal, **kwargs) -> bytes:
+            calls.append(metal)
+            self.assertTrue(release.wait(timeout=10))
+            return metal.name.encode()
+
+        key = update.effective_message.chat_id, update.effective_message.message_id
+        with (
+            mock.patch.object(common, "CHART_DEBOUNCE_DELAY_SECS", 0.3),
+            mock.patch.object(common, "get_plot_for_metal", get_plot_for_metal),
+        ):
+            threads = []
+            for generation, metal in enumerate(MetalEnum, start=1):
+                thread = threading.Thread(
+                    target=common.reply_or_edit_plot_with_keyboard,
+                    args=(update, metal),
+                    kwargs=dict(reply_markup=self.get_reply_markup(metal.name)),
+                )
+                thread.start()
+                threads.append(thread)
+
+                # Нажатия по порядку: следующее только после начала предыдущего
+                while common.CHART_LATEST_WINS._key_by_generation.get(key) != generation:
+                    time.sleep(0.001)
+
+            # Промежуточные запросы отброшены, пока первый еще рисуется
+            for thread in threads[1:-1]:
+                thread.join(timeout=5)
+                self.assertFalse(thread.is_alive())
+
+            release.set()
+            for thread in threads:
+                thread.join(timeout=15)
+
+        # Рисовались первый запрос (сразу) и последний (после задержки)
+        self.assertEqual(calls, [MetalEnum.GOLD, MetalEnum.PALLADIUM])
+        update.effective_message.edit_media.assert_called_once()
+        self.assertEqual(
+            update.effective_message.edit_media.call_args.kwargs["reply_markup"],
+            self.get_reply_markup(MetalEnum.PALLADIUM.name),
+        )
+
+
+class TestCaseLanes(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+
+    def tearDown(self):
+        # Потоки очередей не должны остаться заблокированными после теста
+        self.release.set()
+
+    @staticmethod
+    def get_lane(title: str, workers: int = 1, queue_size: int = 1) -> Lane:
+        return Lane(SimpleNamespace(title=title, workers=workers, queue_size=queue_size))
+
+    def fill_lane(self, lane: Lane, workers: int = 1, queue_size: int = 1):
+        """
+        Все потоки очереди заняты, очередь заполнена
+        """
+
+        started = threading.Semaphore(0)
+
+        def func():
+            started.release()
+            self.release.wait(timeout=10)
+
+        for _ in range(workers):
+            self.assertTrue(lane.submit(func))
+        for _ in range(workers):
+            self.assertTrue(started.acquire(timeout=10))
+
+        for _ in range(queue_size):
+            self.assertTrue(lane.submit(func))
+
+    def test_bounded_queue(self):
+        title = f"test_{uuid4()}"
+        lane = self.get_lane(title, workers=2, queue_size=3)
+        self.fill_lane(lane, workers=2, queue_size=3)
+
+        self.assertFalse(lane.submit(lambda: None))
+        self.assertFalse(lane.submit(lambda: None))
+        self.assertEqual(metrics.LANE_REJECTED.get(lane=title), 2)
+        self.assertEqual(metrics.LANE_QUEUE_DEPTH.get(lane=title), 3)
+
+        # После освобождения очередь снова принимает задачи
+        self.release.set()
+        done = threading.Event()
+        for _ in range(50):
+            if lane.submit(done.set):
+                break
+            time.sleep(0.01)
+        self.assertTrue(done.wait(timeout=10))
+
+    def test_isolation(self):
+        chart_lane = self.get_lane(f"test_{uuid4()}")
+        text_lane = self.get_lane(f"test_{uuid4()}", queue_size=2)
+        self.fill_lane(chart_lane)
+        self.assertFalse(chart_lane.submit(lambda: None))
+
+        # Заполненная очередь не задерживает обработчики другой очереди
+        done = threading.Event()
+        self.assertTrue(text_lane.submit(done.set))
+        self.assertTrue(done.wait(timeout=10))
+
+        # Ошибка обработчика не останавливает поток очереди
+        def func():
+            raise ValueError()
+
+        done = threading.Event()
+        with self.assertLogs(lanes.log, level=logging.ERROR):
+            self.assertTrue(text_lane.submit(func))
+            self.assertTrue(text_lane.submit(done.set))
+            self.assertTrue(done.wait(timeout=10))
+
+    def test_run_in_lane(self):
+        lane = self.get_lane(f"test_{uuid4()}")
+        error = ValueError()
+        handled = threading.Event()
+
+        @run_in_lane(LaneEnum.CHART)
+        def on_request(update, context):
+            if update == "error":
+                raise error
+            handled.set()
+
+        context = mock.Mock()
+        context.dispatcher.dispatch_error.side_effect = lambda *args: handled.set()
+
+        with mock.patch.dict(lanes._LANE_BY_ENUM, {LaneEnum.CHART: lane}):
+            on_request("update", context)
+            self.assertTrue(handled.wait(timeout=10))
+
+            # Ошибка передается обработчикам ошибок диспетчера
+            handled.clear()
+            on_request("error", context)
+            self.assertTrue(handled.wait(timeout=10))
+            context.dispatcher.dispatch_error.assert_called_once_with("error", error)
+
+            self.fill_lane(lane)
+
+            # Переполненная очередь: ответ на нажатие кнопки
+            update = mock.Mock()
+            on_request(update, context)
+            update.callback_query.answer.assert_called_once_with(BUSY_TEXT)
+
+            # Переполненная очередь: ответ на сообщение
+            update = mock.Mock(callback_query=None)
+            on_request(update, context)
+            update.effective_message.reply_text.assert_called_once()
+            self.assertIn(BUSY_TEXT, update.effective_message.reply_text.call_args.args[0])
+
+    def test_run_in_lane_error_handler(self):
+        lane = self.get_lane(f"test_{uuid4()}")
+        error = ValueError()
+        errors = queue.Queue()
+
+        @run_in_lane(LaneEnum.CHART)
+        def on_request(update, context):
+            raise error
+
+        # Диспетчер как в боте: обработчик в очереди, ошибка в обработчике ошибок диспетчера
+        updater = Updater(bot=Bot(os.environ["TOKEN"]), workers=DISPATCHER_WORKERS)
+        self.addCleanup(updater.dispatcher.stop)
+
+        dp = updater.dispatcher
+        dp.add_handler(MessageHandler(Filters.text, on_request))
+        dp.add_error_handler(lambda update, context: errors.put((update, context.error)))
+
+        update = Update.de_json(get_message_update(1, "text"), bot=dp.bot)
+        with mock.patch.dict(lanes._LANE_BY_ENUM, {LaneEnum.CHART: lane}):
+            dp.process_update(update)
+            self.assertEqual(errors.get(timeout=10), (update, error))
+
+
+class TestCaseWebhook(unittest.TestCase):
+    SECRET_TOKEN = "test_secret-token"
+
+    def setUp(self):
+        self.dispatcher = mock.Mock(bot=None, update_queue=queue.Queue())
+        self.server = WebhookServer(
+            self.dispatcher,
+            listen="127.0.0.1",
+            port=0,
+            url_path="/webhook",
+            secret_token=self.SECRET_TOKEN,
+        )
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        host, port = self.server.server_address
+        self.url = f"http://{host}:{port}/webhook"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, headers: dict, url: str = None, data: bytes = None) -> int:
+        if data is None:
+            data = json.dumps(get_message_update(1, "/start")).encode("utf-8")
+
+        rq = urllib.request.Request(url or self.url, data=data, headers=headers, method="POST")
+        try:
+            with urllib.request.urlopen(rq, timeout=10) as rs:
+                return rs.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_secret_token_required(self):
+        for secret_token in ["", "with space", "ключ", "a" * 257]:
+            with self.subTest(secret_token=secret_token):
+                with self.assertRaises(ValueError):
+                    WebhookServer(self.dispatcher, port=0, secret_token=secret_token)
+
+    def test_secret_token(self):
+        for headers in [
+            dict(),
+            {HEADER_SECRET_TOKEN: ""},
+            {HEADER_SECRET_TOKEN: "wrong"},
+            {HEADER_SECRET_TOKEN: self.SECRET_TOKEN + "_"},
+            {HEADER_SECRET_TOKEN: self.SECRET_TOKEN.upper()},
+        ]:
+            with self.subTest(headers=headers):
+                self.assertEqual(self.post(headers), 403)
+
+        self.assertTrue(self.dispatcher.update_queue.empty())
+
+        headers = {HEADER_SECRET_TOKEN: self.SECRET_TOKEN}
+        self.assertEqual(self.post(headers), 200)
+        update = self.dispatcher.update_queue.get_nowait()
+        self.assertEqual(update.effective_message.text, "/start")
+
+        self.assertEqual(self.post(headers, data=b"{"), 400)
+        self.assertEqual(self.post(headers, url=self.url + "/other"), 404)
+        self.assertTrue(self.dispatcher.update_queue.empty())
+
+
 if __name__ == "__main__":
     unittest.main()